@@ -1,24 +1,24 @@
 import os
 import shutil
 import tempfile
-import glob
 import subprocess
 import json
 import time
+import hashlib
 import logging
-import zipfile
 import html
 import psutil # Added for system stats
 import platform # Added for OS check
-import signal # Needed for checking termination signals
-try:
-    import pynvml
-    pynvml.nvmlInit()
-    GPU_MONITORING_AVAILABLE = True
-except Exception as e:
-    GPU_MONITORING_AVAILABLE = False
-    gpu_error_message = f"无法初始化 NVML 进行 GPU 监控: {e}. 请确保已安装 NVIDIA 驱动和 pynvml 库。"
-    print(f"WARN: {gpu_error_message}")
+import queue
+import collections
+import shlex
+import sys
+import multiprocessing
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
+from olmocr.app_utils import SCRATCH_BASE, iter_zip, link_or_copy, load_conversion_script, write_zip
+import atexit
 
 # --- Configuration (Copied and adapted from app.py) ---
 gradio_workspace_name = "api_workspace" # Use a different name if needed
@@ -26,8 +26,8 @@ GRADIO_WORKSPACE_DIR = os.path.join(os.getcwd(), gradio_workspace_name) # Base A
 PROCESSED_PDF_DIR = os.path.join(GRADIO_WORKSPACE_DIR, "processed_pdfs")
 PROCESSED_JSONL_DIR = os.path.join(GRADIO_WORKSPACE_DIR, "processed_jsonl")
 PROCESSED_PREVIEW_DIR = os.path.join(GRADIO_WORKSPACE_DIR, "html_previews")
-EXPORT_TEMP_DIR_BASE = os.path.join(GRADIO_WORKSPACE_DIR, "export_temp")
 UPLOAD_TEMP_DIR = os.path.join(GRADIO_WORKSPACE_DIR, "uploads") # For temporary uploads via API
+EXPORT_CACHE_DIR = os.path.join(GRADIO_WORKSPACE_DIR, "export_cache") # Last finished zip of each export kind
 
 def ensure_dirs():
     """Ensures all necessary directories exist."""
@@ -35,49 +35,453 @@ def ensure_dirs():
     os.makedirs(PROCESSED_PDF_DIR, exist_ok=True)
     os.makedirs(PROCESSED_JSONL_DIR, exist_ok=True)
     os.makedirs(PROCESSED_PREVIEW_DIR, exist_ok=True)
-    os.makedirs(EXPORT_TEMP_DIR_BASE, exist_ok=True)
     os.makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+
+# --- GPU Monitoring ---
+# NVML is initialised by start_background_services(), not at import (see there)
+pynvml = None
+NVML_HANDLES = []
+GPU_MONITORING_AVAILABLE = False
+GPU_COUNT = 0
+gpu_error_message = "GPU 监控尚未初始化。"
+
+def _init_gpu_monitoring():
+    """Initialises NVML, looks up the device handles and registers NVML's shutdown at exit."""
+    global pynvml, NVML_HANDLES, GPU_MONITORING_AVAILABLE, GPU_COUNT, gpu_error_message
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        # Device handles never change while NVML is initialised; look them up once
+        NVML_HANDLES = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+    except Exception as e:
+        gpu_error_message = f"无法初始化 NVML 进行 GPU 监控: {e}. 请确保已安装 NVIDIA 驱动和 pynvml 库。"
+        print(f"WARN: {gpu_error_message}")
+        return
+    GPU_MONITORING_AVAILABLE = True
+    GPU_COUNT = len(NVML_HANDLES)
+    atexit.register(shutdown_nvml)
+
+def shutdown_nvml():
+    try:
+        pynvml.nvmlShutdown()
+        print("INFO: NVML shut down successfully.")
+    except pynvml.NVMLError as error:
+        print(f"ERROR: Failed to shut down NVML: {error}")
 
-ensure_dirs() # Create directories when the module is imported
+_background_services_started = False
+_background_services_lock = threading.Lock()
+
+def start_background_services():
+    """
+    Creates the workspace directories, initialises NVML and starts the CPU sampler; runs once,
+    when the API starts. None of this happens at import, because the pipeline worker processes
+    import this module too (their target lives here, and forkserver children re-import the main module).
+    Returns the number of GPUs found.
+    """
+    global _background_services_started
+    with _background_services_lock:
+        if not _background_services_started:
+            ensure_dirs()
+            _init_gpu_monitoring()
+            threading.Thread(target=_sample_cpu_percent, name="cpu-sampler", daemon=True).start()
+            _background_services_started = True
+    return GPU_COUNT
 
 # --- Logging Setup ---
 log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, format=log_format)
 logger = logging.getLogger(__name__)
 
+# --- Platform ---
+IS_LINUX = platform.system() == "Linux"
+
+# --- OLMOCR Pipeline Worker Processes ---
+# Pipeline jobs are forked from a small forkserver process that has already imported
+# olmocr.pipeline (torch, boto3, ...), instead of fork+exec'ing a fresh "python -m" from
+# this (large) process for every PDF. Each job still gets its own child process, so the
+# PID-based cancellation in flask_app keeps working without breaking a shared pool.
+PIPELINE_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+PIPELINE_MP_CONTEXT = multiprocessing.get_context(PIPELINE_START_METHOD)
+if PIPELINE_START_METHOD == "forkserver":
+    PIPELINE_MP_CONTEXT.set_forkserver_preload(["olmocr.pipeline", "olmocr.viewer.dolmaviewer"])
+
+# (params key, olmocr.pipeline flag) for arguments only passed when the task sets them
+OPTIONAL_PIPELINE_ARGS = (
+    ("target_dim", "--target_longest_image_dim"),
+    ("anchor_len", "--target_anchor_text_len"),
+    ("max_context", "--model_max_context"),
+)
+VIEWER_TEMPLATE = "dolmaviewer_template.html" # dolmaviewer's default, relative to its module
+# olmocr.pipeline's default SGLang port; a pipeline pinned to GPU i serves on PIPELINE_BASE_PORT + i
+PIPELINE_BASE_PORT = 30024
+
+def _build_pipeline_args(run_dir, pdf_paths, params, gpu_index=None):
+    """Builds the olmocr.pipeline arguments for running pdf_paths into run_dir."""
+    pipeline_args = [
+        run_dir,
+        "--pdfs", *pdf_paths,
+        # Required params (should always be present, validated by flask_app)
+        "--max_page_error_rate", str(params['error_rate']), # error_rate is always set (fast or normal)
+        "--max_page_retries", str(params['max_retries']),   # max_retries is always set (fast or normal)
+        # Add workers (always present, default 1)
+        "--workers", str(params.get('workers', 1)),
+    ]
+    # Optional params (only add if present in the dictionary, e.g., for normal mode)
+    for param_key, flag in OPTIONAL_PIPELINE_ARGS:
+        if param_key in params:
+            pipeline_args += (flag, str(params[param_key]))
+    if gpu_index is not None:
+        pipeline_args += ("--port", str(PIPELINE_BASE_PORT + gpu_index)) # SGLang servers on other GPUs use the default port too
+    return pipeline_args
+
+def _run_pipeline_inproc(pipeline_args, output_path, gpu_index=None):
+    """
+    Runs olmocr.pipeline inside a pipeline worker process.
+
+    stdout and stderr are both redirected to output_path at the file descriptor level, so
+    output from the pipeline's own subprocesses (e.g. the SGLang server) is captured as well.
+    With gpu_index set, the pipeline (and the SGLang server it starts) only sees that GPU.
+    """
+    import asyncio
+    from olmocr import pipeline
+
+    if gpu_index is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_index)
+    with open(output_path, 'ab') as out_f:
+        os.dup2(out_f.fileno(), 1)
+        os.dup2(out_f.fileno(), 2)
+        sys.argv = ["olmocr.pipeline", *pipeline_args]
+        try:
+            asyncio.run(pipeline.main())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+def _run_viewer_inproc(jsonl_path, output_dir, output_filename, output_path):
+    """Runs olmocr.viewer.dolmaviewer inside a pipeline worker process, output redirected like _run_pipeline_inproc."""
+    from olmocr.viewer import dolmaviewer
+
+    with open(output_path, 'ab') as out_f:
+        os.dup2(out_f.fileno(), 1)
+        os.dup2(out_f.fileno(), 2)
+        try:
+            dolmaviewer.main([jsonl_path], output_dir, VIEWER_TEMPLATE, None, output_filename=output_filename)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+OUTPUT_TAIL_LINES = 200 # Lines of pipeline output kept for the task record
+
+def _follow_output(path, finished, on_line, poll_interval=0.2, chunk_size=1 << 16):
+    """
+    Follows a growing output file line by line (like tail -f) until `finished` is set,
+    then drains what is left. Each complete line is passed to on_line without its newline.
+
+    The file is read in large binary chunks and split on b"\n" by hand; only whole lines
+    are decoded, which avoids TextIOWrapper's per-readline overhead.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        partial = b""
+        while True:
+            chunk = os.read(fd, chunk_size)
+            if chunk:
+                lines = (partial + chunk).split(b"\n")
+                partial = lines.pop()
+                for line in lines:
+                    on_line(line.rstrip(b"\r").decode("utf-8", "replace"))
+                continue
+            if finished.is_set():
+                break
+            finished.wait(poll_interval)
+        if partial:
+            on_line(partial.rstrip(b"\r").decode("utf-8", "replace"))
+    finally:
+        os.close(fd)
+
+# --- Status Caching ---
+# NVML refreshes utilisation at roughly 10 Hz, so querying more often only returns stale values
+STATUS_CACHE_TTL = 0.1 # seconds
+
+def ttl_cache(ttl_seconds):
+    """Caches the result of a zero-argument function for ttl_seconds (monotonic clock)."""
+    def decorator(func):
+        cached = {"value": None, "expires_at": 0.0}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper():
+            with lock:
+                if time.monotonic() < cached["expires_at"]:
+                    return cached["value"]
+            value = func()
+            with lock:
+                cached["value"] = value
+                cached["expires_at"] = time.monotonic() + ttl_seconds
+            return value
+        return wrapper
+    return decorator
+
+CPU_SAMPLE_INTERVAL = 1.0 # seconds
+_cpu_percent = 0.0
+
+def _sample_cpu_percent():
+    """
+    Keeps _cpu_percent at the usage over the last CPU_SAMPLE_INTERVAL. The blocking measurement
+    runs here, so status requests read a steady 1 s average instead of the delta since whichever
+    poll came last (which is noisy when several clients poll).
+    """
+    global _cpu_percent
+    while True:
+        _cpu_percent = psutil.cpu_percent(interval=CPU_SAMPLE_INTERVAL)
+
+# CPU and NUMA topology do not change at runtime
+LOGICAL_CPUS = psutil.cpu_count(logical=True)
+PHYSICAL_CPUS = psutil.cpu_count(logical=False) # Parses /proc/cpuinfo on Linux
+
+# --- Task Update Coalescing ---
+TERMINAL_TASK_STATES = frozenset(("completed", "failed", "completed_with_warnings", "cancelled"))
+UPDATE_FLUSH_INTERVAL = 0.1 # seconds
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class _UpdateCoalescer:
+    """Merges task updates per task and writes them through the update callback from one background thread.
+
+    Scalar fields are last-writer-wins and 'append_log' lines are collected into a list.
+    Log lines are submitted as (timestamp, message) and only formatted when they are flushed.
+    Pending updates are flushed every UPDATE_FLUSH_INTERVAL seconds, or immediately when a
+    task reaches a terminal state.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = {} # task_id -> (update_callback, merged updates); only touched by the worker thread
+        self._last_log_second = None # (int seconds, formatted) so lines within the same second share one strftime
+        self._thread = None # Started by the first submit or flush, so importing this module starts nothing
+        self._thread_lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="task-update-coalescer", daemon=True)
+                self._thread.start()
+
+    def submit(self, task_id, updates, update_callback):
+        self._ensure_started()
+        self._queue.put((task_id, updates, update_callback))
+
+    def flush(self, timeout=None):
+        """Blocks until everything submitted so far has been written."""
+        self._ensure_started()
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _loop(self):
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush_all()
+                deadline = None
+                continue
+
+            if isinstance(item, threading.Event):
+                self._flush_all()
+                deadline = None
+                item.set()
+                continue
+
+            task_id, updates, update_callback = item
+            merged = self._pending.setdefault(task_id, (update_callback, {}))[1]
+            for key, value in updates.items():
+                if key == "append_log":
+                    merged.setdefault("append_log", []).append(value)
+                else:
+                    merged[key] = value
+
+            if updates.get("status") in TERMINAL_TASK_STATES:
+                self._flush_task(task_id)
+            elif deadline is None:
+                deadline = time.monotonic() + UPDATE_FLUSH_INTERVAL
+
+    def _flush_all(self):
+        for task_id in list(self._pending):
+            self._flush_task(task_id)
+
+    def _format_log_line(self, timestamp, message):
+        second = int(timestamp)
+        if self._last_log_second is None or self._last_log_second[0] != second:
+            self._last_log_second = (second, time.strftime(LOG_TIME_FORMAT, time.localtime(second)))
+        return f"{self._last_log_second[1]} - {message}"
+
+    def _flush_task(self, task_id):
+        update_callback, updates = self._pending.pop(task_id)
+        if "append_log" in updates:
+            updates["append_log"] = [self._format_log_line(ts, msg) for ts, msg in updates["append_log"]]
+        try:
+            update_callback(task_id, updates)
+        except Exception as db_err:
+            logger.error(f"[Task {task_id}] Failed to update task status in DB: {db_err}", exc_info=True)
+            # Continue processing if possible, but status might be stale in DB
+
+_UPDATE_COALESCER = _UpdateCoalescer()
+
+# --- Task Cancellation ---
+CANCEL_POLL_INTERVAL = 0.5 # seconds between cancellation checks while the pipeline runs
+# HTML previews are generated here rather than on the task worker, so the worker can start the next
+# PDF's OCR (GPU-bound) while the viewer renders this one's pages (CPU-bound, in its own process)
+PREVIEW_WORKERS = min(os.cpu_count() or 1, 4)
+_PREVIEW_EXECUTOR = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="olmocr-preview")
+_RUNNING_TASKS = {} # task_id -> (cancel requested event, finished event) for tasks running in this process (shared within a batch)
+_RUNNING_TASKS_LOCK = threading.Lock()
+
+def request_task_cancel(task_id, timeout=10):
+    """
+    Asks a task running in this process to stop and waits up to `timeout` seconds for it to
+    finish (status 'cancelled' written to the DB). Returns False if the task is not running here.
+    """
+    with _RUNNING_TASKS_LOCK:
+        events = _RUNNING_TASKS.get(task_id)
+    if events is None:
+        return False
+    cancel_requested, finished = events
+    cancel_requested.set()
+    finished.wait(timeout)
+    return True
+
+def terminate_process_tree(pid, timeout=1):
+    """Sends SIGTERM to a process and all of its descendants, then SIGKILL to any still alive after `timeout`."""
+    try:
+        parent = psutil.Process(pid)
+        procs = parent.children(recursive=True) + [parent]
+    except psutil.NoSuchProcess:
+        return
+    for proc in procs:
+        try:
+            proc.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    _, alive = psutil.wait_procs(procs, timeout=timeout)
+    for proc in alive:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+# --- Output Name Claims ---
+# Tasks write processed_pdfs/<name>.pdf, processed_jsonl/<name>_output.jsonl and html_previews/<name>.html.
+# With a worker per GPU, two uploads of the same file name could otherwise run at once and overwrite
+# each other's files; the second one waits until the first (including its preview) has finished.
+_CLAIMED_BASE_NAMES = set()
+_CLAIMED_BASE_NAMES_CONDITION = threading.Condition()
+
+def _claim_base_names(names, cancel_requested):
+    """
+    Claims the output names for the calling task, waiting while another task holds any of them.
+    Returns False, claiming nothing, if cancel_requested is set while waiting.
+    """
+    names = set(names)
+    with _CLAIMED_BASE_NAMES_CONDITION:
+        while not _CLAIMED_BASE_NAMES.isdisjoint(names):
+            if cancel_requested.is_set():
+                return False
+            _CLAIMED_BASE_NAMES_CONDITION.wait(CANCEL_POLL_INTERVAL)
+        _CLAIMED_BASE_NAMES.update(names)
+        return True
+
+def _release_base_names(names):
+    """Releases names claimed with _claim_base_names and wakes the tasks waiting for them."""
+    with _CLAIMED_BASE_NAMES_CONDITION:
+        _CLAIMED_BASE_NAMES.difference_update(names)
+        _CLAIMED_BASE_NAMES_CONDITION.notify_all()
+
 # --- Core Processing Logic (Adapted from app.py) ---
 
-def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
+def _split_upload_name(pdf_filepath, task_id):
+    """Returns (safe base name, extension) of an upload saved as <safe base name>_<task_id><ext>."""
+    base_name_with_uuid, ext = os.path.splitext(os.path.basename(pdf_filepath))
+    uuid_suffix = f"_{task_id}"
+    if base_name_with_uuid.endswith(uuid_suffix):
+        return base_name_with_uuid[:-len(uuid_suffix)], ext # Extract original safe base
+    logger.warning(f"[Task {task_id}] Could not strip UUID suffix '{uuid_suffix}' from base name '{base_name_with_uuid}'. Using full base name for persistent files.")
+    return base_name_with_uuid, ext # Fallback
+
+def _render_preview(jsonl_path, safe_base_name, log_dir, task_id):
+    """
+    Renders the HTML preview of jsonl_path to PROCESSED_PREVIEW_DIR/<safe_base_name>.html.
+
+    Returns (exit code, viewer output, whether the preview file was written). The viewer
+    output is kept in log_dir.
+    """
+    # Written by the viewer straight to the simple name (no search or rename)
+    simple_html_filename = safe_base_name + ".html"
+    simple_html_path = os.path.join(PROCESSED_PREVIEW_DIR, simple_html_filename)
+
+    def preview_mtime():
+        try:
+            return os.stat(simple_html_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # An older preview of the same file is overwritten in place; its mtime tells the two apart
+    mtime_before = preview_mtime()
+    # Forked from the same preloaded forkserver as the pipeline, so the viewer's imports are already done
+    viewer_output_path = os.path.join(log_dir, f"viewer_output_{task_id}.log")
+    viewer_process = PIPELINE_MP_CONTEXT.Process(
+        target=_run_viewer_inproc,
+        args=(jsonl_path, PROCESSED_PREVIEW_DIR, simple_html_filename, viewer_output_path),
+        name=f"olmocr-viewer-{task_id}",
+    )
+    viewer_process.start()
+    viewer_process.join()
+    try:
+        with open(viewer_output_path, 'rb') as f:
+            viewer_output = f.read().decode("utf-8", "replace")
+    except FileNotFoundError:
+        viewer_output = ""
+    mtime_after = preview_mtime()
+    return viewer_process.exitcode, viewer_output, mtime_after is not None and mtime_after != mtime_before
+
+def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback, gpu_index=None):
     """
     Runs OLMOCR on a single PDF file and updates the task status via callback.
     This function is intended to be run in a separate thread.
 
+    It returns once OCR is done and the JSONL is saved; the HTML preview and the final status
+    follow on _PREVIEW_EXECUTOR, so the caller can start the next PDF meanwhile.
+    Tasks for the same file name run one after the other, as they write the same output files.
+
     Args:
         pdf_filepath (str): Absolute path to the PDF file to process.
         task_id (str): The ID of the task for status updates.
         params (dict): Dictionary containing OLMOCR parameters.
         update_callback (callable): Function to call for updating task status in DB.
                                    Expected signature: update_callback(task_id, updates_dict)
+        gpu_index (int, optional): Pin the pipeline to this GPU, with its own SGLang port, so
+                                   several tasks can run at once (one per GPU). None uses every GPU.
     """
     run_dir = None
     persistent_pdf_path = None
     persistent_jsonl_path = None
     # current_file_name_with_uuid = os.path.basename(pdf_filepath) # e.g., safe_base_uuid.ext
-    current_logs = [] # Keep track of logs for this run to update DB at once
     # safe_base_name = "" # Will be extracted later
     start_time = time.time() # Record start time for calculating final duration
     olmocr_process = None # Initialize process variable
+    output_finished = None # Set to stop following the pipeline output
     actual_processing_start_time = None # Added to store the actual start time
 
     def update_task_status(status, log_message=None, result_updates=None, stdout=None, stderr=None, error_msg=None, process_pid=None, processing_start_time=None):
         """Internal helper to prepare update dict and call the callback."""
         updates = {"status": status}
         if log_message:
-            # Append log to current list for this run
-            log_entry = f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {log_message}"
-            current_logs.append(log_entry)
+            # Raw timestamp; the coalescer formats it once when the line is written to the DB,
+            # which keeps only the newest lines per task (nothing is retained here)
+            log_entry = (time.time(), log_message)
             logger.info(f"[Task {task_id}][{current_file_name_with_uuid}] {log_message}")
-            updates["logs"] = json.dumps(current_logs) # Update with full log list (as JSON)
+            updates["append_log"] = log_entry # Append just this line; re-serialising the full list is quadratic
         
         if result_updates: # Should be a dict like {'jsonl_path': path, 'html_path': path}
              # We need to update specific keys, not overwrite the whole result
@@ -100,8 +504,7 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
             updates["processing_start_time"] = processing_start_time
 
         # Calculate and add final elapsed time when task reaches a terminal state
-        terminal_states = ["completed", "failed", "completed_with_warnings", "cancelled"] # Add cancelled state
-        if status in terminal_states:
+        if status in TERMINAL_TASK_STATES:
              # Calculate final time based on actual processing start if available
              if actual_processing_start_time:
                  final_time = time.time() - actual_processing_start_time
@@ -112,31 +515,53 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
              updates["final_elapsed_time"] = final_time
              logger.info(f"[Task {task_id}][{current_file_name_with_uuid}] Recorded final elapsed time: {final_time:.2f} seconds (Based on {'processing start' if actual_processing_start_time else 'queue start'})" )
         
-        # Call the provided callback function to update the database
-        try:
-            update_callback(task_id, updates)
-        except Exception as db_err:
-            logger.error(f"[Task {task_id}] Failed to update task status in DB: {db_err}", exc_info=True)
-            # Continue processing if possible, but status might be stale in DB
+        # Hand the update to the coalescer; it batches DB writes through update_callback
+        _UPDATE_COALESCER.submit(task_id, updates, update_callback)
 
     # --- Extract Original Filename Base --- 
     current_file_name_with_uuid = os.path.basename(pdf_filepath) 
-    base_name_with_uuid, ext = os.path.splitext(current_file_name_with_uuid)
-    uuid_suffix = f"_{task_id}"
-    if base_name_with_uuid.endswith(uuid_suffix):
-        safe_base_name = base_name_with_uuid[:-len(uuid_suffix)] # Extract original safe base
-    else:
-        logger.warning(f"[Task {task_id}] Could not strip UUID suffix '{uuid_suffix}' from base name '{base_name_with_uuid}'. Using full base name for persistent files.")
-        safe_base_name = base_name_with_uuid # Fallback
+    safe_base_name, ext = _split_upload_name(pdf_filepath, task_id)
     # Log the extraction result
     logger.info(f"[Task {task_id}] Extracted safe_base_name '{safe_base_name}' and ext '{ext}' from '{current_file_name_with_uuid}'")
     update_task_status("processing", f"开始处理文件: {safe_base_name}{ext} (UUID: {task_id})") # Use extracted name in log
     # --- End Extraction ---
 
+    cancel_requested = threading.Event()
+    task_finished = threading.Event()
+    with _RUNNING_TASKS_LOCK:
+        _RUNNING_TASKS[task_id] = (cancel_requested, task_finished)
+    preview_handed_off = False # Once True, the preview job owns run_dir and finish_task()
+    base_name_claimed = False
+
+    def finish_task():
+        """Removes the run directory and marks the task finished; called once, by whichever thread ends the task."""
+        # Cleanup the temporary run directory for this file
+        if run_dir and os.path.exists(run_dir):
+            try:
+                shutil.rmtree(run_dir)
+                logger.info(f"[Task {task_id}][{current_file_name_with_uuid}] Cleaned up temporary run directory: {run_dir}")
+            except OSError as e:
+                logger.error(f"[Task {task_id}][{current_file_name_with_uuid}] Failed to remove temporary run directory {run_dir}: {e}")
+                update_task_status("warning", f"无法删除临时运行目录 {run_dir}: {e}")
+
+        if base_name_claimed:
+            _release_base_names([safe_base_name])
+        # Make sure every update for this task has reached the DB before the caller moves on
+        _UPDATE_COALESCER.flush()
+        with _RUNNING_TASKS_LOCK:
+            _RUNNING_TASKS.pop(task_id, None)
+        task_finished.set()
+
     try:
+        # 0. Wait for any other task writing the same output names (see _claim_base_names)
+        if not _claim_base_names([safe_base_name], cancel_requested):
+            update_task_status("cancelled", f"等待同名文件 {safe_base_name}{ext} 的任务完成时已按请求取消。")
+            return
+        base_name_claimed = True
+
         # 1. Create unique temporary directory for this file's OLMOCR output
         # Use task_id for better tracking in API context
-        run_dir = tempfile.mkdtemp(dir=GRADIO_WORKSPACE_DIR, prefix=f"olmocr_run_{task_id}_")
+        run_dir = tempfile.mkdtemp(dir=SCRATCH_BASE, prefix=f"olmocr_run_{task_id}_")
         update_task_status("processing", f"创建临时 OLMOCR 工作区: {run_dir}")
 
         # 2. Prepare paths and ensure input PDF is accessible
@@ -144,44 +569,42 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
         persistent_pdf_filename = safe_base_name + ext # Use extracted extension
         persistent_pdf_path = os.path.join(PROCESSED_PDF_DIR, persistent_pdf_filename)
 
-        # Ensure the target directory exists before copying
-        os.makedirs(PROCESSED_PDF_DIR, exist_ok=True)
-
-        shutil.copy(pdf_filepath, persistent_pdf_path)
+        # PROCESSED_* directories are created by ensure_dirs() at import (and recreated by clear_all_processed_data)
+        link_or_copy(pdf_filepath, persistent_pdf_path)
         update_task_status("processing", f"已缓存上传的文件到: {persistent_pdf_path}")
 
         olmocr_results_dir = os.path.join(run_dir, "results")
         # Ensure the results directory will be created by OLMOCR, or create if needed
         # os.makedirs(olmocr_results_dir, exist_ok=True)
 
-        # 3. Construct OLMOCR Command conditionally based on params
-        cmd = [
-            "python", "-m", "olmocr.pipeline",
-            run_dir,
-            "--pdfs", persistent_pdf_path,
-            # Required params (should always be present, validated by flask_app)
-            "--max_page_error_rate", str(params['error_rate']), # error_rate is always set (fast or normal)
-            "--max_page_retries", str(params['max_retries']),   # max_retries is always set (fast or normal)
-            # Optional params (only add if present in the dictionary, e.g., for normal mode)
-        ]
-        if 'target_dim' in params:
-            cmd.extend(["--target_longest_image_dim", str(params['target_dim'])])
-        if 'anchor_len' in params:
-            cmd.extend(["--target_anchor_text_len", str(params['anchor_len'])])
-        if 'max_context' in params:
-            cmd.extend(["--model_max_context", str(params['max_context'])])
+        # 3. Construct OLMOCR arguments conditionally based on params
+        pipeline_args = _build_pipeline_args(run_dir, [persistent_pdf_path], params, gpu_index)
 
-        # Add workers (always present, default 1)
-        cmd.extend(["--workers", str(params.get('workers', 1))])
+        cmd_str = shlex.join(["olmocr.pipeline", *pipeline_args])
+        update_task_status("processing", f"准备执行 OLMOCR ({PIPELINE_START_METHOD} 工作进程): {cmd_str}")
+
+        # 4. Run OLMOCR in a pipeline worker process (PID is needed for cancellation)
+        output_path = os.path.join(run_dir, "olmocr_output.log")
+        open(output_path, 'wb').close() # Create it up front so it can be followed right away
+        output_tail = collections.deque(maxlen=OUTPUT_TAIL_LINES) # Bounded; the full output stays on disk
+        output_finished = threading.Event()
 
-        cmd_str = ' '.join(cmd)
-        update_task_status("processing", f"准备执行命令: {cmd_str}")
+        def on_output_line(line):
+            output_tail.append(line)
+            if line.strip():
+                update_task_status("processing", f"[OLMOCR] {line}")
 
-        # 4. Run OLMOCR using Popen to get PID
+        output_follower = threading.Thread(target=_follow_output, args=(output_path, output_finished, on_output_line),
+                                           name=f"olmocr-output-{task_id}", daemon=True)
         process_start_time = time.time()
         try:
-            # Use Popen instead of run
-            olmocr_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', bufsize=1, universal_newlines=True)
+            olmocr_process = PIPELINE_MP_CONTEXT.Process(
+                target=_run_pipeline_inproc,
+                args=(pipeline_args, output_path, gpu_index),
+                name=f"olmocr-pipeline-{task_id}",
+            )
+            olmocr_process.start()
+            output_follower.start()
             
             # Update status with PID immediately and record processing start time
             current_time = time.time()
@@ -191,14 +614,24 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
                                process_pid=olmocr_process.pid, 
                                processing_start_time=actual_processing_start_time)
 
-            # Communicate to get output and wait for process completion
-            stdout, stderr = olmocr_process.communicate()
-            return_code = olmocr_process.returncode
+            # Wait for the worker to finish, checking for a cancellation request in between
+            while olmocr_process.exitcode is None and not cancel_requested.is_set():
+                olmocr_process.join(CANCEL_POLL_INTERVAL)
+            if olmocr_process.exitcode is None:
+                # Cancelled: stop the worker together with anything it started (e.g. the SGLang server)
+                terminate_process_tree(olmocr_process.pid)
+                olmocr_process.join()
+            return_code = olmocr_process.exitcode
+            output_finished.set()
+            output_follower.join()
+            # stderr is merged into stdout; only the tail is kept for the task record
+            stdout = "\n".join(output_tail)
+            stderr = None
             
         except Exception as popen_err:
-             # Handle potential errors during Popen execution itself
-             error_message = f"执行 OLMOCR Popen 时出错: {popen_err}"
-             logger.exception(f"[Task {task_id}] Error during OLMOCR Popen for {current_file_name_with_uuid}")
+             # Handle potential errors while starting/joining the worker process itself
+             error_message = f"执行 OLMOCR 工作进程时出错: {popen_err}"
+             logger.exception(f"[Task {task_id}] Error during OLMOCR worker process for {current_file_name_with_uuid}")
              update_task_status("failed", error_message, error_msg=str(popen_err))
              return # Exit processing for this file
         
@@ -207,149 +640,75 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
         # Log final status based on return code
         log_msg_base = f"OLMOCR 进程完成，耗时: {process_duration:.2f} 秒, 返回码: {return_code}"
         
-        # Check for cancellation signal on Linux
-        was_cancelled = False
-        if platform.system() == "Linux" and return_code < 0:
-            try:
-                # Negative return code on Linux often means termination by signal
-                sig = signal.Signals(-return_code)
-                log_msg_base += f" (被信号 {sig.name} 终止)"
-                # Assume cancellation if terminated by common signals
-                if sig in (signal.SIGTERM, signal.SIGINT, signal.SIGKILL):
-                     was_cancelled = True
-                     update_task_status("cancelled", f"OLMOCR 进程被外部信号 ({sig.name}) 终止。", stdout=stdout, stderr=stderr)
-                     # Don't proceed further if cancelled
-                     return 
-            except ValueError:
-                 log_msg_base += f" (被未知信号 {-return_code} 终止)"
-                 # Treat unknown signals potentially as cancellation too for safety
-                 was_cancelled = True
-                 update_task_status("cancelled", f"OLMOCR 进程被未知信号 ({-return_code}) 终止。", stdout=stdout, stderr=stderr)
-                 return
-
-        # If not cancelled, proceed with regular status update
-        if not was_cancelled:
-            update_task_status("processing", log_msg_base, stdout=stdout, stderr=stderr)
-
-        # Raise error only if return code is non-zero AND it wasn't detected as cancelled
-        if return_code != 0 and not was_cancelled:
-            raise RuntimeError(f"OLMOCR failed (Code: {return_code}). STDERR: {stderr}")
+        if cancel_requested.is_set():
+            update_task_status("cancelled", f"OLMOCR 进程已按请求取消。{log_msg_base}", stdout=stdout, stderr=stderr)
+            return # Don't proceed further if cancelled
+
+        update_task_status("processing", log_msg_base, stdout=stdout, stderr=stderr)
+
+        if return_code != 0:
+            raise RuntimeError(f"OLMOCR failed (Code: {return_code}). Output: {stdout}")
 
         # --- If we reach here, OLMOCR finished successfully (return code 0) ---
 
         # 5. Process Result File (JSONL)
-        jsonl_files_temp = glob.glob(os.path.join(olmocr_results_dir, "output_*.jsonl"))
-        if not jsonl_files_temp:
-            # Check if the process might have created the directory but not the file
-            if not os.path.exists(olmocr_results_dir):
-                 raise FileNotFoundError(f"OLMOCR 结果目录 {olmocr_results_dir} 未创建。")
-            else:
-                 raise FileNotFoundError(f"在 OLMOCR 结果目录 {olmocr_results_dir} 中未找到输出 JSONL 文件。检查 OLMOCR 日志了解详情。")
+        # Check if the process might have created the directory but not the file
+        # scandir itself reports a missing directory, so no separate isdir stat is needed
+        try:
+            with os.scandir(olmocr_results_dir) as it:
+                jsonl_entries = [entry for entry in it
+                                 if entry.name.startswith("output_") and entry.name.endswith(".jsonl") and entry.is_file()]
+        except FileNotFoundError:
+             raise FileNotFoundError(f"OLMOCR 结果目录 {olmocr_results_dir} 未创建。") from None
+        if not jsonl_entries:
+             raise FileNotFoundError(f"在 OLMOCR 结果目录 {olmocr_results_dir} 中未找到输出 JSONL 文件。检查 OLMOCR 日志了解详情。")
 
-        temp_jsonl_path = jsonl_files_temp[0]
+        temp_jsonl_path = jsonl_entries[0].path
 
-        if os.path.getsize(temp_jsonl_path) == 0:
+        # is_file() above already stat'ed the entry on filesystems without d_type; DirEntry caches it
+        if jsonl_entries[0].stat().st_size == 0:
             update_task_status("warning", f"OLMOCR 为 {current_file_name_with_uuid} 生成了空的 JSONL 文件。跳过文本提取和 HTML 预览。")
             # Mark as complete with warning, but don't proceed further for this file
             update_task_status("completed_with_warnings", f"处理 {current_file_name_with_uuid} 完成，但输出为空。")
             # No result path to add in this case for JSONL/HTML
             return # Exit the function for this file
 
-        # Ensure persistent JSONL directory exists
-        os.makedirs(PROCESSED_JSONL_DIR, exist_ok=True)
         persistent_jsonl_filename = f"{safe_base_name}_output.jsonl"
         persistent_jsonl_path = os.path.join(PROCESSED_JSONL_DIR, persistent_jsonl_filename)
-        shutil.copy(temp_jsonl_path, persistent_jsonl_path)
+        link_or_copy(temp_jsonl_path, persistent_jsonl_path)
         update_task_status("processing", f"结果 JSONL 文件已保存到: {persistent_jsonl_path}",
                            result_updates={"jsonl_path": persistent_jsonl_path})
 
-        # 6. Generate HTML Preview (Robust Logic with Rename)
-        # Ensure persistent preview directory exists
-        os.makedirs(PROCESSED_PREVIEW_DIR, exist_ok=True)
-
-        # --- Define expected and desired HTML filenames --- 
-        # Predict the potentially long/ugly filename the viewer *might* create based on PDF path
-        # Replace separators and dots, common behavior for path-to-filename conversion
-        long_html_filename_pattern = persistent_pdf_path.replace(os.sep, '_').replace('.', '_') + ".html" 
-        # Handle potential drive letter colon removal on Windows if applicable (basic example)
-        if ':' in long_html_filename_pattern:
-            long_html_filename_pattern = long_html_filename_pattern.split(':', 1)[-1]
-        long_html_path_expected = os.path.join(PROCESSED_PREVIEW_DIR, long_html_filename_pattern)
-        
-        # Define the simple, desired filename 
-        simple_html_filename = safe_base_name + ".html"
-        simple_html_path = os.path.join(PROCESSED_PREVIEW_DIR, simple_html_filename)
-        # --- End Filename Definitions --- 
-
-        viewer_cmd = [
-            "python", "-m", "olmocr.viewer.dolmaviewer",
-            persistent_jsonl_path,
-            "--output_dir", PROCESSED_PREVIEW_DIR
-        ]
-        update_task_status("processing", f"执行预览生成命令 (目标目录: {PROCESSED_PREVIEW_DIR}): {' '.join(viewer_cmd)}")
-        viewer_process = subprocess.run(viewer_cmd, capture_output=True, text=True, check=False, encoding='utf-8')
-        update_task_status("processing", f"HTML 预览生成完成。STDOUT: {viewer_process.stdout} STDERR: {viewer_process.stderr}")
-
-        if viewer_process.returncode == 0:
-            # --- Find and Rename HTML File --- 
-            update_task_status("processing", f"检查 viewer 生成的 HTML 文件 (预期长名称): {long_html_path_expected} 或 (简洁名称): {simple_html_path}")
-
-            html_found_and_renamed = False
-            max_wait_html = 5 # Seconds to wait for file system changes
-            wait_interval_html = 0.5
-            start_wait_html = time.time()
-            final_html_path = None # Store the path we eventually use
-
-            while time.time() - start_wait_html < max_wait_html:
-                # Prioritize checking for the long/ugly name first
-                if os.path.exists(long_html_path_expected):
-                    update_task_status("processing", f"找到 viewer 生成的长名称 HTML 文件: {long_html_path_expected}")
-                    try:
-                        # Rename the long-named file to the simple name
-                        if os.path.exists(simple_html_path):
-                            # If simple name already exists, remove the long one to avoid conflict? Or just use the existing simple one.
-                            # Let's favour using the existing simple one and remove the long one.
-                            logger.warning(f"简洁 HTML 文件 {simple_html_path} 已存在。删除 viewer 生成的长文件名版本 {long_html_path_expected}")
-                            os.remove(long_html_path_expected)
-                            final_html_path = simple_html_path
-                        else:
-                            os.rename(long_html_path_expected, simple_html_path)
-                            final_html_path = simple_html_path
-                        update_task_status("processing", f"HTML 文件路径确定为 (简洁名称): {final_html_path}",
-                                           result_updates={"html_path": final_html_path})
-                        html_found_and_renamed = True
-                        break # Exit loop after successful rename/confirmation
-                    except OSError as rename_err:
-                        update_task_status("warning", f"重命名/删除 HTML 文件失败 从 {long_html_path_expected} 到 {simple_html_path}: {rename_err}")
-                        # Fallback: Try to use the long name if rename fails?
-                        if os.path.exists(long_html_path_expected):
-                             final_html_path = long_html_path_expected
-                             update_task_status("warning", f"无法重命名，将使用长名称HTML路径: {final_html_path}", result_updates={"html_path": final_html_path})
-                             html_found_and_renamed = True # Mark as found even if not renamed
-                        break # Exit loop even if rename fails 
-                
-                # If long name not found, check if the simple name *already* exists
-                elif os.path.exists(simple_html_path):
-                    update_task_status("processing", f"找到已存在的简洁名称 HTML 文件: {simple_html_path}",
+        # 6. Generate the HTML preview on the preview executor and finish the task there
+        def generate_preview_and_finish():
+            try:
+                simple_html_path = os.path.join(PROCESSED_PREVIEW_DIR, safe_base_name + ".html")
+                update_task_status("processing", f"生成 HTML 预览: {simple_html_path}")
+                exitcode, viewer_output, html_written = _render_preview(persistent_jsonl_path, safe_base_name, run_dir, task_id)
+                update_task_status("processing", f"HTML 预览生成完成。输出: {viewer_output}")
+
+                if exitcode != 0:
+                    update_task_status("warning", f"生成 HTML 预览失败。返回码: {exitcode}")
+                elif html_written:
+                    update_task_status("processing", f"HTML 文件路径确定为: {simple_html_path}",
                                        result_updates={"html_path": simple_html_path})
-                    final_html_path = simple_html_path
-                    html_found_and_renamed = True
-                    break
-                    
-                time.sleep(wait_interval_html)
-
-            if not html_found_and_renamed:
-            # --- End Find and Rename --- 
-
-            # Log a warning if neither file was found after viewer success
-                update_task_status("warning", f"未找到预期的 HTML 文件...")
-        else:
-            update_task_status("warning", f"生成 HTML 预览失败。返回码: {viewer_process.returncode}")
-
-        # Mark task as completed successfully 
-        # If we reached here without exceptions or specific non-completed statuses set earlier,
-        # then it's considered completed.
-        update_task_status("completed", f"文件 {current_file_name_with_uuid} 处理成功。")
+                else:
+                    # The viewer exited cleanly but wrote nothing (e.g. it could not render the PDF)
+                    update_task_status("warning", f"未找到预期的 HTML 文件...")
+
+                # Mark task as completed successfully 
+                # If we reached here without exceptions or specific non-completed statuses set earlier,
+                # then it's considered completed.
+                update_task_status("completed", f"文件 {current_file_name_with_uuid} 处理成功。")
+            except Exception as e:
+                logger.exception(f"[Task {task_id}] Error generating HTML preview for {current_file_name_with_uuid}")
+                update_task_status("failed", f"生成 HTML 预览时发生错误: {e}", error_msg=str(e))
+            finally:
+                finish_task()
+
+        update_task_status("processing", "OCR 完成，HTML 预览已排队生成。") # Before submit, so it cannot land after "completed"
+        _PREVIEW_EXECUTOR.submit(generate_preview_and_finish)
+        preview_handed_off = True
 
     except Exception as e:
         error_message = f"处理文件 {current_file_name_with_uuid} 时发生错误: {e}"
@@ -369,13 +728,15 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
         update_task_status("failed", error_message, error_msg=str(e))
 
     finally:
-        # Ensure the process is cleaned up if it's still somehow alive (shouldn't be if communicate finished)
-        if olmocr_process and olmocr_process.poll() is None:
-            logger.warning(f"[Task {task_id}] OLMOCR process (PID: {olmocr_process.pid}) still alive after communicate? Attempting termination.")
+        if output_finished:
+            output_finished.set()
+        # Ensure the process is cleaned up if it's still somehow alive (shouldn't be if join finished)
+        if olmocr_process and olmocr_process.is_alive():
+            logger.warning(f"[Task {task_id}] OLMOCR process (PID: {olmocr_process.pid}) still alive after join? Attempting termination.")
             try:
                 olmocr_process.terminate()
-                olmocr_process.wait(timeout=1) # Short wait
-                if olmocr_process.poll() is None:
+                olmocr_process.join(timeout=1) # Short wait
+                if olmocr_process.is_alive():
                     olmocr_process.kill()
                     logger.info(f"[Task {task_id}] OLMOCR process (PID: {olmocr_process.pid}) killed.")
                 else:
@@ -383,27 +744,234 @@ def run_olmocr_on_single_pdf(pdf_filepath, task_id, params, update_callback):
             except Exception as term_err:
                 logger.error(f"[Task {task_id}] Error terminating lingering OLMOCR process {olmocr_process.pid}: {term_err}")
 
-        # Cleanup the temporary run directory for this file
+        if not preview_handed_off:
+            finish_task()
+
+def _route_result_rows(results_dir):
+    """
+    Groups the rows of the pipeline's output_*.jsonl files in results_dir by their Source-File
+    (the PDF path the pipeline was given). Returns {source_file: [row line, ...]}, every line
+    newline-terminated. Rows that are not valid JSON or have no Source-File are skipped with a
+    warning, as the conversion scripts do, so one bad row cannot fail every file of a batch.
+    """
+    rows_by_source = collections.defaultdict(list)
+    try:
+        with os.scandir(results_dir) as it:
+            result_paths = [entry.path for entry in it
+                            if entry.name.startswith("output_") and entry.name.endswith(".jsonl") and entry.is_file()]
+    except FileNotFoundError:
+        return rows_by_source
+    for result_path in result_paths:
+        with open(result_path, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    source_file = json.loads(line)["metadata"]["Source-File"]
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning(f"Skipping unusable row {i + 1} in {result_path}: {e!r}")
+                    continue
+                rows_by_source[source_file].append(line if line.endswith("\n") else line + "\n")
+    return rows_by_source
+
+def run_olmocr_batch(items, params, update_callback, gpu_index=None):
+    """
+    Processes several uploaded PDFs with a single OLMOCR pipeline run.
+
+    The pipeline (and its SGLang server) starts once for the whole batch instead of once per
+    file. Every PDF keeps its own task record; the pipeline's rows are routed back to their
+    task by the Source-File of each row. Cancelling any task of the batch cancels the whole
+    batch, since they share one pipeline process.
+    Like single tasks, a batch waits for running tasks with any of its file names.
+
+    Args:
+        items (list): (pdf_filepath, task_id) pairs, as saved by the API.
+        params (dict): Processing parameters shared by every file, as for run_olmocr_on_single_pdf.
+        update_callback (function): Callback to update a task's status in the DB.
+                                   Expected signature: update_callback(task_id, updates_dict)
+        gpu_index (int, optional): Pin the pipeline to this GPU, as for run_olmocr_on_single_pdf.
+    """
+    start_time = time.time()
+    actual_processing_start_time = None
+    run_dir = None
+    olmocr_process = None
+    output_finished = None
+    batch_tasks = [] # (task_id, safe_base_name, persistent_pdf_path) of the files handed to the pipeline
+    finished_task_ids = set() # Tasks that reached a terminal state
+
+    def update_task_status(task_id, status, log_message=None, **fields):
+        """Prepares the update dict for one task of the batch and hands it to the coalescer."""
+        updates = {"status": status, **fields}
+        if log_message:
+            logger.info(f"[Task {task_id}][batch] {log_message}")
+            updates["append_log"] = (time.time(), log_message)
+        if status in TERMINAL_TASK_STATES:
+            updates["final_elapsed_time"] = time.time() - (actual_processing_start_time or start_time)
+            finished_task_ids.add(task_id)
+        _UPDATE_COALESCER.submit(task_id, updates, update_callback)
+
+    def update_batch_status(status, log_message=None, **fields):
+        """Applies the same update to every task of the batch that is still running."""
+        for _, task_id in items:
+            if task_id not in finished_task_ids:
+                update_task_status(task_id, status, log_message, **fields)
+
+    # Every task of the batch shares the events, so cancelling any of them stops the pipeline
+    cancel_requested = threading.Event()
+    batch_finished = threading.Event()
+    with _RUNNING_TASKS_LOCK:
+        for _, task_id in items:
+            _RUNNING_TASKS[task_id] = (cancel_requested, batch_finished)
+    claimed_base_names = []
+
+    def generate_preview_and_finish(task_id, safe_base_name, persistent_jsonl_path, return_code):
+        try:
+            simple_html_path = os.path.join(PROCESSED_PREVIEW_DIR, safe_base_name + ".html")
+            update_task_status(task_id, "processing", f"生成 HTML 预览: {simple_html_path}")
+            exitcode, viewer_output, html_written = _render_preview(persistent_jsonl_path, safe_base_name, run_dir, task_id)
+            update_task_status(task_id, "processing", f"HTML 预览生成完成。输出: {viewer_output}")
+
+            if exitcode != 0:
+                update_task_status(task_id, "warning", f"生成 HTML 预览失败。返回码: {exitcode}")
+            elif html_written:
+                update_task_status(task_id, "processing", f"HTML 文件路径确定为: {simple_html_path}", html_path=simple_html_path)
+            else:
+                update_task_status(task_id, "warning", f"未找到预期的 HTML 文件...")
+
+            if return_code == 0:
+                update_task_status(task_id, "completed", f"文件 {safe_base_name} 处理成功。")
+            else:
+                # The pipeline failed part way, but this file's pages made it out
+                update_task_status(task_id, "completed_with_warnings", f"文件 {safe_base_name} 已处理，但 OLMOCR 返回码为 {return_code}。")
+        except Exception as e:
+            logger.exception(f"[Task {task_id}] Error generating HTML preview for {safe_base_name}")
+            update_task_status(task_id, "failed", f"生成 HTML 预览时发生错误: {e}", error=str(e))
+
+    try:
+        # 0. Wait for any other task writing the same output names (see _claim_base_names)
+        base_names = [_split_upload_name(pdf_filepath, task_id)[0] for pdf_filepath, task_id in items]
+        if not _claim_base_names(base_names, cancel_requested):
+            update_batch_status("cancelled", "等待同名文件的任务完成时已按请求取消。")
+            return
+        claimed_base_names = base_names
+
+        run_dir = tempfile.mkdtemp(dir=SCRATCH_BASE, prefix=f"olmocr_run_batch_{items[0][1]}_")
+
+        # 1. Cache every upload; a file that cannot be cached fails on its own
+        for pdf_filepath, task_id in items:
+            safe_base_name, ext = _split_upload_name(pdf_filepath, task_id)
+            update_task_status(task_id, "processing", f"开始处理文件: {safe_base_name}{ext} (UUID: {task_id}，批处理共 {len(items)} 个文件)")
+            persistent_pdf_path = os.path.join(PROCESSED_PDF_DIR, safe_base_name + ext)
+            try:
+                link_or_copy(pdf_filepath, persistent_pdf_path)
+            except OSError as e:
+                logger.exception(f"[Task {task_id}] Failed to cache upload {pdf_filepath}")
+                update_task_status(task_id, "failed", f"无法缓存上传的文件: {e}", error=str(e))
+                continue
+            update_task_status(task_id, "processing", f"已缓存上传的文件到: {persistent_pdf_path}")
+            batch_tasks.append((task_id, safe_base_name, persistent_pdf_path))
+
+        if not batch_tasks:
+            return
+
+        # 2. One pipeline run for every cached file
+        pipeline_args = _build_pipeline_args(run_dir, [path for _, _, path in batch_tasks], params, gpu_index)
+        cmd_str = shlex.join(["olmocr.pipeline", *pipeline_args])
+        update_batch_status("processing", f"准备执行 OLMOCR ({PIPELINE_START_METHOD} 工作进程): {cmd_str}")
+
+        output_path = os.path.join(run_dir, "olmocr_output.log")
+        open(output_path, 'wb').close() # Create it up front so it can be followed right away
+        # Only the tail is kept (and stored on every task at the end); logging each line to every task would multiply DB writes
+        output_tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        output_finished = threading.Event()
+        output_follower = threading.Thread(target=_follow_output, args=(output_path, output_finished, output_tail.append),
+                                           name=f"olmocr-output-batch-{batch_tasks[0][0]}", daemon=True)
+        process_start_time = time.time()
+        olmocr_process = PIPELINE_MP_CONTEXT.Process(
+            target=_run_pipeline_inproc,
+            args=(pipeline_args, output_path, gpu_index),
+            name=f"olmocr-pipeline-batch-{batch_tasks[0][0]}",
+        )
+        olmocr_process.start()
+        output_follower.start()
+        actual_processing_start_time = time.time()
+        update_batch_status("processing", f"OLMOCR 进程已启动 (PID: {olmocr_process.pid})",
+                            process_pid=olmocr_process.pid, processing_start_time=actual_processing_start_time)
+
+        while olmocr_process.exitcode is None and not cancel_requested.is_set():
+            olmocr_process.join(CANCEL_POLL_INTERVAL)
+        if olmocr_process.exitcode is None:
+            terminate_process_tree(olmocr_process.pid)
+            olmocr_process.join()
+        return_code = olmocr_process.exitcode
+        output_finished.set()
+        output_follower.join()
+        stdout = "\n".join(output_tail)
+
+        log_msg_base = f"OLMOCR 进程完成，耗时: {time.time() - process_start_time:.2f} 秒, 返回码: {return_code}"
+        if cancel_requested.is_set():
+            update_batch_status("cancelled", f"OLMOCR 进程已按请求取消。{log_msg_base}", olmocr_stdout=stdout)
+            return
+        update_batch_status("processing", log_msg_base, olmocr_stdout=stdout)
+
+        # 3. Route the result rows back to their files by Source-File
+        rows_by_source = _route_result_rows(os.path.join(run_dir, "results"))
+
+        # 4. Save each file's rows and render the previews in parallel
+        preview_futures = []
+        for task_id, safe_base_name, persistent_pdf_path in batch_tasks:
+            rows = rows_by_source.get(persistent_pdf_path)
+            if not rows:
+                if return_code != 0:
+                    update_task_status(task_id, "failed", f"OLMOCR 失败 (返回码: {return_code})，未生成 {safe_base_name} 的结果。",
+                                       error=f"OLMOCR failed (Code: {return_code}). Output: {stdout}")
+                else:
+                    update_task_status(task_id, "completed_with_warnings", f"处理 {safe_base_name} 完成，但输出为空。")
+                continue
+            persistent_jsonl_path = os.path.join(PROCESSED_JSONL_DIR, f"{safe_base_name}_output.jsonl")
+            with open(persistent_jsonl_path, 'w', encoding='utf-8') as f:
+                f.writelines(rows)
+            update_task_status(task_id, "processing", f"结果 JSONL 文件已保存到: {persistent_jsonl_path}", jsonl_path=persistent_jsonl_path)
+            preview_futures.append(_PREVIEW_EXECUTOR.submit(
+                generate_preview_and_finish, task_id, safe_base_name, persistent_jsonl_path, return_code))
+        # run_dir holds the viewer logs, so the previews must be done before it is removed
+        wait(preview_futures)
+
+    except Exception as e:
+        logger.exception(f"[Batch {items[0][1]}] Error processing batch")
+        update_batch_status("failed", f"批处理时发生错误: {e}", error=str(e))
+
+    finally:
+        if output_finished:
+            output_finished.set()
+        if olmocr_process and olmocr_process.is_alive():
+            terminate_process_tree(olmocr_process.pid)
+            olmocr_process.join(timeout=1)
         if run_dir and os.path.exists(run_dir):
             try:
                 shutil.rmtree(run_dir)
-                logger.info(f"[Task {task_id}][{current_file_name_with_uuid}] Cleaned up temporary run directory: {run_dir}")
             except OSError as e:
-                logger.error(f"[Task {task_id}][{current_file_name_with_uuid}] Failed to remove temporary run directory {run_dir}: {e}")
-                update_task_status("warning", f"无法删除临时运行目录 {run_dir}: {e}")
+                logger.error(f"[Batch {items[0][1]}] Failed to remove temporary run directory {run_dir}: {e}")
+        _release_base_names(claimed_base_names)
+        _UPDATE_COALESCER.flush()
+        with _RUNNING_TASKS_LOCK:
+            for _, task_id in items:
+                _RUNNING_TASKS.pop(task_id, None)
+        batch_finished.set()
 
 # --- System Status Function ---
+@ttl_cache(STATUS_CACHE_TTL)
 def get_system_status():
     """Gathers system status including CPU, Memory, and GPU (if available)."""
     status = {}
 
     # CPU Info
     try:
-        # Get CPU usage percentage over 1 second interval
+        # Latest sample from the background sampler; never blocks
         status['cpu'] = {
-            "logical_count": psutil.cpu_count(logical=True),
-            "physical_count": psutil.cpu_count(logical=False),
-            "percent_usage": psutil.cpu_percent(interval=0.5) # Use a short interval
+            "logical_count": LOGICAL_CPUS,
+            "physical_count": PHYSICAL_CPUS,
+            "percent_usage": _cpu_percent
         }
     except Exception as e:
         logger.error(f"Failed to get CPU stats: {e}")
@@ -426,8 +994,15 @@ def get_system_status():
     status['gpu'] = get_gpu_stats() # This already returns a dict with an 'error' key if failed
 
     # NUMA Info
+    status['numa'] = get_numa_info()
+
+    return status
+
+@functools.cache
+def get_numa_info():
+    """Reports NUMA topology via 'numactl --hardware' (Linux only); runs once, the topology is static."""
     numa_info = {}
-    if platform.system() == "Linux":
+    if IS_LINUX:
         try:
             # Try to run numactl to get hardware info
             process = subprocess.run(
@@ -473,26 +1048,34 @@ def get_system_status():
         numa_info["available"] = False
         numa_info["info"] = f"NUMA details via numactl are only attempted on Linux. Current OS: {platform.system()}"
 
-    status['numa'] = numa_info
-
-    return status
+    return numa_info
 
 # --- GPU Stats Function (Copied from app.py) ---
+@ttl_cache(STATUS_CACHE_TTL)
 def get_gpu_stats():
     # ... (Keep the implementation from app.py)
     if not GPU_MONITORING_AVAILABLE:
         return {"error": gpu_error_message}
     try:
-        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-        util = pynvml.nvmlDeviceGetUtilizationRates(handle)
-        mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-        stats = {
-            "gpu_utilization_percent": util.gpu,
-            "memory_controller_utilization_percent": util.memory,
-            "memory_used_gb": mem_info.used / (1024**3),
-            "memory_total_gb": mem_info.total / (1024**3),
-            "memory_used_percent": mem_info.used * 100 / mem_info.total if mem_info.total > 0 else 0
-        }
+        devices = []
+        for index, handle in enumerate(NVML_HANDLES):
+            util = pynvml.nvmlDeviceGetUtilizationRates(handle)
+            mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
+            devices.append({
+                "index": index,
+                "gpu_utilization_percent": util.gpu,
+                "memory_controller_utilization_percent": util.memory,
+                "memory_used_gb": mem_info.used / (1024**3),
+                "memory_total_gb": mem_info.total / (1024**3),
+                "memory_used_percent": mem_info.used * 100 / mem_info.total if mem_info.total > 0 else 0
+            })
+        if not devices:
+            return {"error": "未检测到 GPU。"}
+        # GPU 0 stays at the top level for existing clients; "devices" has every GPU
+        stats = dict(devices[0])
+        del stats["index"]
+        stats["gpu_count"] = len(devices)
+        stats["devices"] = devices
         return stats
     except pynvml.NVMLError as error:
         error_msg = f"获取 GPU 状态失败: {error}"
@@ -509,25 +1092,41 @@ def clear_temp_workspace():
     cleared_count = 0
     error_count = 0
     messages = []
-    logger.info(f"Attempting to clear temporary run directories in: {GRADIO_WORKSPACE_DIR}")
+    # Run directories live in SCRATCH_BASE; older ones may still be in the workspace itself
+    scan_dirs = [SCRATCH_BASE] if SCRATCH_BASE == GRADIO_WORKSPACE_DIR else [SCRATCH_BASE, GRADIO_WORKSPACE_DIR]
+    logger.info(f"Attempting to clear temporary run directories in: {scan_dirs}")
 
-    try:
-        for item in os.listdir(GRADIO_WORKSPACE_DIR):
-            item_path = os.path.join(GRADIO_WORKSPACE_DIR, item)
-            if os.path.isdir(item_path) and item.startswith("olmocr_run_"): # Specific prefix
-                try:
-                    shutil.rmtree(item_path)
+    targets = []
+    for scan_dir in scan_dirs:
+        try:
+            # scandir carries the entry type from getdents, so no extra stat per entry
+            with os.scandir(scan_dir) as it:
+                targets.extend(entry.path for entry in it
+                               if entry.name.startswith("olmocr_run_") and entry.is_dir(follow_symlinks=False)) # Specific prefix
+        except Exception as e:
+            messages.append(f"清理临时目录时发生错误: {e}")
+            logger.exception(f"Error during temporary workspace cleanup of {scan_dir}")
+            error_count += 1
+
+    def remove_dir(item_path):
+        try:
+            shutil.rmtree(item_path)
+            return None
+        except OSError as e:
+            return e
+
+    # Remove run directories in parallel; rmtree is dominated by per-file unlink syscalls
+    if targets:
+        with ThreadPoolExecutor(max_workers=min(8, len(targets))) as executor:
+            for item_path, err in zip(targets, executor.map(remove_dir, targets)):
+                if err is None:
                     messages.append(f"已删除: {item_path}")
                     logger.info(f"Removed directory: {item_path}")
                     cleared_count += 1
-                except OSError as e:
-                    messages.append(f"错误：无法删除 {item_path}: {e}")
-                    logger.error(f"Failed to remove directory {item_path}: {e}")
+                else:
+                    messages.append(f"错误：无法删除 {item_path}: {err}")
+                    logger.error(f"Failed to remove directory {item_path}: {err}")
                     error_count += 1
-    except Exception as e:
-        messages.append(f"清理临时目录时发生错误: {e}")
-        logger.exception(f"Error during temporary workspace cleanup of {GRADIO_WORKSPACE_DIR}")
-        error_count += 1
 
     final_message = f"清理完成。删除 {cleared_count} 个临时运行目录。" + (f" {error_count} 个无法删除。" if error_count > 0 else "")
     messages.append(final_message)
@@ -540,44 +1139,79 @@ def clear_all_processed_data():
     messages = []
     cleared_dirs = []
     skipped_dirs = []
-    dirs_to_clear = [PROCESSED_PDF_DIR, PROCESSED_JSONL_DIR, PROCESSED_PREVIEW_DIR]
+    dirs_to_clear = [PROCESSED_PDF_DIR, PROCESSED_JSONL_DIR, PROCESSED_PREVIEW_DIR, EXPORT_CACHE_DIR]
     logger.info(f"Attempting to clear processed data directories: {dirs_to_clear}")
 
-    for dir_path in dirs_to_clear:
+    def clear_one(dir_path):
+        """Clears and recreates one directory; returns (outcome, message) where outcome is 'cleared', 'skipped' or 'error'."""
         if os.path.exists(dir_path):
             try:
                 shutil.rmtree(dir_path)
                 os.makedirs(dir_path, exist_ok=True) # Recreate
-                messages.append(f"已清空目录: {dir_path}")
                 logger.info(f"Successfully cleared and recreated directory: {dir_path}")
-                cleared_dirs.append(dir_path)
+                result = ("cleared", f"已清空目录: {dir_path}")
             except OSError as e:
-                messages.append(f"错误：无法清空目录 {dir_path}: {e}")
                 logger.error(f"Failed to clear directory {dir_path}: {e}")
-                error_count += 1
+                result = ("error", f"错误：无法清空目录 {dir_path}: {e}")
         else:
-            messages.append(f"目录不存在，无需清理: {dir_path}")
             logger.info(f"Directory does not exist, skipping cleanup: {dir_path}")
-            skipped_dirs.append(dir_path)
+            result = ("skipped", f"目录不存在，无需清理: {dir_path}")
+        # Processing relies on these directories existing, so make sure they are back even after a failed rmtree
+        try:
+            os.makedirs(dir_path, exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to recreate directory {dir_path}: {e}")
+        return result
+
+    # The directories are independent, and rmtree spends its time in unlink syscalls (GIL released)
+    with ThreadPoolExecutor(max_workers=len(dirs_to_clear)) as executor:
+        for dir_path, (outcome, message) in zip(dirs_to_clear, executor.map(clear_one, dirs_to_clear)):
+            messages.append(message)
+            if outcome == "cleared":
+                cleared_dirs.append(dir_path)
+            elif outcome == "skipped":
+                skipped_dirs.append(dir_path)
+            else:
+                error_count += 1
 
     final_message = "已处理文件缓存清理完成。" + (" 清理过程中出现错误。" if error_count > 0 else "")
     messages.append(final_message)
     return {"cleared_dirs": cleared_dirs, "skipped_dirs": skipped_dirs, "error_count": error_count, "messages": messages}
 
 # --- Listing Functions (Adapted from app.py) ---
+# (directory, extension) -> (directory st_mtime_ns, sorted filenames)
+_FILE_LIST_INDEX = {}
+_FILE_LIST_INDEX_LOCK = threading.Lock()
+
 def list_files(directory, extension):
-    """Lists files with a specific extension in a directory."""
+    """
+    Lists files with a specific extension in a directory.
+
+    The listing is kept in memory and only rebuilt when the directory's mtime changes
+    (any create/rename/delete inside it bumps it), so repeated calls cost one stat.
+    """
+    try:
+        dir_mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return []
+    key = (directory, extension)
+    with _FILE_LIST_INDEX_LOCK:
+        cached = _FILE_LIST_INDEX.get(key)
+        if cached and cached[0] == dir_mtime:
+            return list(cached[1])
+
     files = []
-    if os.path.exists(directory):
-        try:
-            for filename in os.listdir(directory):
-                if filename.lower().endswith(extension):
-                    files.append(filename)
-            # Sort alphabetically for consistency
-            files.sort()
-        except Exception as e:
-            logger.error(f"Error listing files in {directory}: {e}")
-    return files
+    try:
+        with os.scandir(directory) as it:
+            files = [entry.name for entry in it if entry.name.lower().endswith(extension)]
+        # Sort alphabetically for consistency
+        files.sort()
+    except Exception as e:
+        logger.error(f"Error listing files in {directory}: {e}")
+        return files
+    with _FILE_LIST_INDEX_LOCK:
+        _FILE_LIST_INDEX[key] = (dir_mtime, files)
+    return list(files)
 
 def list_preview_files():
     return list_files(PROCESSED_PREVIEW_DIR, ".html")
@@ -586,139 +1220,244 @@ def list_jsonl_files():
     return list_files(PROCESSED_JSONL_DIR, ".jsonl")
 
 # --- Helper function for zipping (Copied from app.py) ---
+def _walk_files(base_dir):
+    """Yields (path, arcname) for every file under base_dir, using scandir's cached entry types."""
+    stack = [(base_dir, "")]
+    while stack:
+        current_dir, rel_prefix = stack.pop()
+        with os.scandir(current_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, rel_prefix + entry.name + "/"))
+                else:
+                    yield entry.path, rel_prefix + entry.name
+
 def create_zip_from_dir(dir_path, zip_path):
+    """Zips everything under dir_path into zip_path."""
+    return create_zip_from_files(_walk_files(dir_path), zip_path)
+
+def create_zip_from_files(sources, zip_path):
+    """
+    Zips (source, arcname) pairs into zip_path, so files can be added from several
+    directories without copying them into one first. A source is a file path or the entry's bytes.
+    """
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(dir_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, start=dir_path)
-                    zipf.write(file_path, arcname=arcname)
+        write_zip(sources, zip_path)
         logger.info(f"Successfully created zip file: {zip_path}")
         return True
     except Exception as e:
-        logger.error(f"Error creating zip file {zip_path} from {dir_path}: {e}")
+        logger.error(f"Error creating zip file {zip_path}: {e}")
         return False
 
+def iter_zip_from_files(sources):
+    """
+    Generates a zip of (source, arcname) pairs chunk by chunk as entries finish, so a response
+    can start sending before the archive is complete and nothing is written to disk.
+    """
+    return iter_zip(sources)
+
+# --- Export Cache ---
+# A finished export zip is kept in EXPORT_CACHE_DIR under a fingerprint of its inputs and sent again
+# as is until one of them changes; only the newest zip of each export kind is kept
+EXPORT_CACHE_CHUNK_SIZE = 1 << 20 # Read size when streaming a cached zip
+
+def _export_fingerprint(kind, input_dirs, input_files=()):
+    """Digest of the path, size and mtime of every input file; any change to an export's inputs changes it."""
+    digest = hashlib.blake2b(kind.encode(), digest_size=16)
+    paths = list(input_files)
+    for input_dir in input_dirs:
+        try:
+            paths.extend(path for path, _ in _walk_files(input_dir))
+        except FileNotFoundError:
+            pass
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue # Removed while listing
+        digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def _read_file_chunks(f):
+    with f:
+        while True:
+            chunk = f.read(EXPORT_CACHE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def _cached_export(kind, fingerprint):
+    """
+    Returns (path, chunks) of the cached zip of kind built from inputs with this fingerprint,
+    or None if there is none. The path lets a response hand the file to a reverse proxy instead.
+    """
+    path = os.path.join(EXPORT_CACHE_DIR, f"{kind}_{fingerprint}.zip")
+    try:
+        # Opened here, so replacing the cache entry meanwhile cannot cut the download short
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    return path, _read_file_chunks(f)
+
+def _store_export(part_path, kind, fingerprint):
+    """Makes part_path the cached zip of kind, replacing the previous one."""
+    with os.scandir(EXPORT_CACHE_DIR) as it:
+        stale = [entry.path for entry in it if entry.name.startswith(f"{kind}_") and entry.name.endswith(".zip")]
+    for path in stale:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    os.replace(part_path, os.path.join(EXPORT_CACHE_DIR, f"{kind}_{fingerprint}.zip"))
+
+def _tee_to_export_cache(chunks, kind, fingerprint, current_fingerprint):
+    """
+    Passes the zip chunks through while writing them to EXPORT_CACHE_DIR. The copy becomes the
+    cached export only once the zip is complete and if current_fingerprint() still matches
+    fingerprint (no input changed while it was built). Cache errors never affect the download.
+    """
+    try:
+        fd, part_path = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, prefix=f".{kind}_", suffix=".part")
+        part = os.fdopen(fd, 'wb')
+    except OSError as e:
+        logger.warning(f"Export cache unavailable, {kind} export not cached: {e}")
+        yield from chunks
+        return
+    try:
+        for chunk in chunks:
+            if part:
+                try:
+                    part.write(chunk)
+                except OSError as e:
+                    logger.warning(f"Failed to write {kind} export to cache: {e}")
+                    part.close()
+                    part = None
+            yield chunk
+        if part:
+            part.close()
+            if current_fingerprint() == fingerprint:
+                _store_export(part_path, kind, fingerprint)
+    except OSError as e:
+        logger.warning(f"Failed to store {kind} export in cache: {e}")
+    finally:
+        # Also runs when the client disconnects mid-download (GeneratorExit)
+        if part and not part.closed:
+            part.close()
+        try:
+            os.unlink(part_path)
+        except FileNotFoundError:
+            pass
+
 # --- Export Functions (Adapted from app.py) ---
+def _is_empty_dir(path):
+    """True if path has no entries; stops after the first one instead of listing the whole directory."""
+    with os.scandir(path) as it:
+        return next(it, None) is None
+
 def export_html_archive():
-    if not os.listdir(PROCESSED_PREVIEW_DIR):
-         return {"status": "error", "message": "没有 HTML 预览文件可打包。", "zip_path": None}
+    """
+    Returns the HTML previews as a streamed zip: "chunks" yields the archive bytes and
+    "filename" is the suggested download name. Nothing is written to disk.
+    """
+    if _is_empty_dir(PROCESSED_PREVIEW_DIR):
+         return {"status": "error", "message": "没有 HTML 预览文件可打包。", "filename": None, "chunks": None}
 
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     zip_filename = f"olmocr_html_export_{timestamp}.zip"
-    # Ensure export base exists
-    os.makedirs(EXPORT_TEMP_DIR_BASE, exist_ok=True)
-    zip_file_path = os.path.join(EXPORT_TEMP_DIR_BASE, zip_filename)
 
-    if create_zip_from_dir(PROCESSED_PREVIEW_DIR, zip_file_path):
-        return {"status": "success", "message": f"HTML 文件已成功打包到 {zip_filename}。", "zip_path": zip_file_path}
-    else:
-        return {"status": "error", "message": "打包 HTML 文件时出错。", "zip_path": None}
-
-def run_conversion_script(script_name, input_dir, output_dir):
-    # Construct the path relative to the location of api_utils.py
-    # Go up one level ('..'), then into 'scripts'
-    script_path = os.path.join(os.path.dirname(__file__), "..", "scripts", script_name)
-    script_path = os.path.abspath(script_path) # Ensure it's an absolute path for robustness
-
-    if not os.path.exists(script_path):
-        raise FileNotFoundError(f"转换脚本未找到: {script_path}")
-
-    cmd = ["python", script_path, input_dir, output_dir]
-    logger.info(f"运行转换脚本: {' '.join(cmd)}")
-    process = subprocess.run(cmd, capture_output=True, text=True, check=False, encoding='utf-8')
-    logger.info(f"脚本 {script_name} STDOUT:\n{process.stdout}")
-    logger.error(f"脚本 {script_name} STDERR:\n{process.stderr}")
-    if process.returncode != 0:
-        raise RuntimeError(f"脚本 {script_name} 执行失败 (Code: {process.returncode}): {process.stderr}")
+    def current_fingerprint():
+        return _export_fingerprint("html", [PROCESSED_PREVIEW_DIR])
+
+    fingerprint = current_fingerprint()
+    cached = _cached_export("html", fingerprint)
+    if cached is not None:
+        return {"status": "success", "message": f"HTML 预览未变化，发送缓存的压缩包 {zip_filename}。",
+                "filename": zip_filename, "path": cached[0], "chunks": cached[1]}
+    chunks = iter_zip_from_files(_walk_files(PROCESSED_PREVIEW_DIR))
+    return {"status": "success", "message": f"HTML 文件正在打包为 {zip_filename}。",
+            "filename": zip_filename, "chunks": _tee_to_export_cache(chunks, "html", fingerprint, current_fingerprint)}
+
+# Conversion scripts live in ../scripts relative to this file; resolved once at import
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts"))
+# Worker processes per conversion: each one pays the converter's imports, and per-file
+# conversion is short, so returns flatten out after a few workers
+CONVERSION_WORKERS = min(os.cpu_count() or 1, 4)
+
+def run_conversion_script(script_name, input_dir):
+    """Converts every JSONL file in input_dir in memory; returns [(output_filename, data), ...]."""
+    conversion_module = load_conversion_script(SCRIPTS_DIR, script_name)
+
+    # Run the script in-process instead of starting a new interpreter per export
+    logger.info(f"运行转换脚本: {script_name} {input_dir}")
+    try:
+        generated = conversion_module.convert_to_memory(input_dir, workers=CONVERSION_WORKERS)
+    except Exception as e:
+        raise RuntimeError(f"脚本 {script_name} 执行失败: {e}") from e
     logger.info(f"脚本 {script_name} 执行成功。")
-    # Return the list of generated files for further processing
-    return glob.glob(os.path.join(output_dir, "*"))
+    return generated
 
 def export_combined_archive(export_format):
+    """
+    Converts the processed JSONL to export_format and returns the result, together with the
+    matching HTML previews, as a streamed zip ("chunks" / "filename", see export_html_archive).
+    The converted files are kept in memory and the previews are read in place, so nothing
+    is written to disk.
+    """
     if export_format not in ['md', 'docx']:
-        return {"status": "error", "message": "无效的导出格式。", "zip_path": None}
+        return {"status": "error", "message": "无效的导出格式。", "filename": None, "chunks": None}
 
-    if not os.listdir(PROCESSED_JSONL_DIR):
-        return {"status": "error", "message": "没有 JSONL 文件可供转换。", "zip_path": None}
+    if _is_empty_dir(PROCESSED_JSONL_DIR):
+        return {"status": "error", "message": "没有 JSONL 文件可供转换。", "filename": None, "chunks": None}
 
-    export_temp_dir = None
-    zip_file_path = None
     logs = []
 
     try:
-        export_temp_dir = tempfile.mkdtemp(dir=EXPORT_TEMP_DIR_BASE, prefix=f"{export_format}_export_")
-        logs.append(f"创建临时导出目录: {export_temp_dir}")
-
         script_name = "local_jsonl_to_md.py" if export_format == 'md' else "jsonl_to_docx.py"
-        logs.append(f"运行 {script_name}...")
-        generated_files = run_conversion_script(script_name, PROCESSED_JSONL_DIR, export_temp_dir)
-        logs.append(f"{export_format.upper()} 文件已生成 ({len(generated_files)} 个)。")
-
-        copied_html_count = 0
-        logs.append("复制 HTML 预览文件...")
-        for gen_file_path in generated_files:
-            # base_name now comes from the MD/DOCX file, should match safe_base_name used earlier
-            base_name = os.path.splitext(os.path.basename(gen_file_path))[0]
-            
-            # Construct the simple HTML filename to look for (should match the name used earlier)
-            simple_html_filename_to_find = base_name + ".html"
-            html_src_path = os.path.join(PROCESSED_PREVIEW_DIR, simple_html_filename_to_find)
 
-            if os.path.exists(html_src_path):
-                # Destination filename is also the simple name
-                html_dest_path = os.path.join(export_temp_dir, simple_html_filename_to_find)
-                try:
-                    shutil.copy(html_src_path, html_dest_path)
-                    copied_html_count += 1
-                    # Update log message to reflect simple name being copied
-                    logger.info(f"Copied HTML: {simple_html_filename_to_find}") 
-                except Exception as copy_e:
-                    logger.warning(f"无法复制 HTML 文件 {html_src_path}: {copy_e}")
-                    # Log the simple name we tried to find
-                    logs.append(f"警告：无法复制 {simple_html_filename_to_find}") 
-            else:
-                 # Log the simple name we tried to find
-                 logger.warning(f"未找到对应的 HTML 文件: {simple_html_filename_to_find} at path {html_src_path}") 
-                 logs.append(f"警告：未找到 {simple_html_filename_to_find}")
+        # The converted files depend on the JSONL and the script, the previews on themselves
+        def current_fingerprint():
+            return _export_fingerprint(export_format, [PROCESSED_JSONL_DIR, PROCESSED_PREVIEW_DIR],
+                                       [os.path.join(SCRIPTS_DIR, script_name)])
 
-        logs.append(f"已复制 {copied_html_count} 个 HTML 文件。")
+        fingerprint = current_fingerprint()
+        cached = _cached_export(export_format, fingerprint)
+        if cached is not None:
+            zip_filename = f"olmocr_{export_format}_export_{time.strftime('%Y%m%d_%H%M%S')}.zip"
+            logs.append(f"处理结果未变化，发送缓存的压缩包: {zip_filename}")
+            return {"status": "success", "message": "\n".join(logs), "filename": zip_filename,
+                    "path": cached[0], "chunks": cached[1]}
+
+        logs.append(f"运行 {script_name}...")
+        generated = run_conversion_script(script_name, PROCESSED_JSONL_DIR)
+        logs.append(f"{export_format.upper()} 文件已生成 ({len(generated)} 个)。")
+
+        # Zip the generated bytes together with their HTML previews straight from PROCESSED_PREVIEW_DIR (no copy)
+        zip_sources = [(data, output_filename) for output_filename, data in generated]
+        logs.append("查找 HTML 预览文件...")
+        # One directory listing (served from the list_files cache) instead of a stat per generated file
+        available_html = set(list_preview_files())
+        # The HTML preview shares the generated file's stem (safe_base_name used when processing)
+        wanted_html = [arcname.rpartition(".")[0] + ".html" for _, arcname in zip_sources]
+        found_html = [name for name in wanted_html if name in available_html]
+        zip_sources.extend((os.path.join(PROCESSED_PREVIEW_DIR, name), name) for name in found_html)
+        found_html_count = len(found_html)
+
+        if found_html_count < len(wanted_html):
+            missing_html = [name for name in wanted_html if name not in available_html]
+            logger.warning(f"未找到对应的 HTML 文件 ({len(missing_html)} 个) in {PROCESSED_PREVIEW_DIR}: {', '.join(missing_html)}")
+            logs.extend(f"警告：未找到 {name}" for name in missing_html)
+
+        logs.append(f"找到 {found_html_count} 个 HTML 文件。")
 
         timestamp = time.strftime("%Y%m%d_%H%M%S")
         zip_filename = f"olmocr_{export_format}_export_{timestamp}.zip"
-        os.makedirs(EXPORT_TEMP_DIR_BASE, exist_ok=True)
-        zip_file_path = os.path.join(EXPORT_TEMP_DIR_BASE, zip_filename)
-        logs.append(f"创建 Zip 文件: {zip_filename}...")
+        logs.append(f"开始流式传输 Zip 文件: {zip_filename}...")
 
-        if create_zip_from_dir(export_temp_dir, zip_file_path):
-            logs.append("导出成功完成。")
-            return {"status": "success", "message": "\n".join(logs), "zip_path": zip_file_path}
-        else:
-            logs.append("错误：创建 Zip 文件失败。")
-            return {"status": "error", "message": "\n".join(logs), "zip_path": None}
+        return {"status": "success", "message": "\n".join(logs), "filename": zip_filename,
+                "chunks": _tee_to_export_cache(iter_zip_from_files(zip_sources), export_format, fingerprint, current_fingerprint)}
 
     except Exception as e:
         error_msg = f"导出过程中发生错误: {e}"
         logs.append(error_msg)
         logger.exception(f"Error during {export_format} export.")
-        return {"status": "error", "message": "\n".join(logs), "zip_path": None}
-    finally:
-        if export_temp_dir and os.path.exists(export_temp_dir):
-            try:
-                shutil.rmtree(export_temp_dir)
-                logger.info(f"Cleaned up temporary export directory: {export_temp_dir}")
-            except OSError as e:
-                logger.error(f"Failed to remove temporary export directory {export_temp_dir}: {e}")
-
-
-# Shutdown NVML on exit (if initialized)
-if GPU_MONITORING_AVAILABLE:
-    import atexit
-    def shutdown_nvml():
-        try:
-            pynvml.nvmlShutdown()
-            print("INFO: NVML shut down successfully.")
-        except pynvml.NVMLError as error:
-            print(f"ERROR: Failed to shut down NVML: {error}")
-    atexit.register(shutdown_nvml) 
\ No newline at end of file
+        return {"status": "error", "message": "\n".join(logs), "filename": None, "chunks": None}
@@ -1,5 +1,10 @@
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, Request, request, jsonify, send_file, abort, Response, stream_with_context
 import os
+import re
+import hmac
+import tempfile
+import mimetypes
+from urllib.parse import quote
 import uuid
 import threading
 import time
@@ -15,6 +20,7 @@ import psutil # Needed for process termination
 # Import utility functions from api_utils
 from api_utils import (
     run_olmocr_on_single_pdf,
+    run_olmocr_batch,
     get_system_status,
     clear_temp_workspace,
     clear_all_processed_data,
@@ -24,16 +30,23 @@ from api_utils import (
     export_combined_archive,
     PROCESSED_PREVIEW_DIR,
     PROCESSED_JSONL_DIR,
-    EXPORT_TEMP_DIR_BASE,
     UPLOAD_TEMP_DIR,
-    ensure_dirs,
-    GRADIO_WORKSPACE_DIR
+    GRADIO_WORKSPACE_DIR,
+    TERMINAL_TASK_STATES,
+    start_background_services,
+    request_task_cancel
 )
 
-# Ensure directories exist at startup
-ensure_dirs()
+class UploadRequest(Request):
+    """
+    Spools uploaded files into UPLOAD_TEMP_DIR (instead of memory or an anonymous temp file),
+    so save_upload() can hard-link the upload into place rather than copy it a second time.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile("wb+", dir=UPLOAD_TEMP_DIR, prefix=".upload_", suffix=".part")
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 # Configure logging to match api_utils
@@ -41,8 +54,19 @@ log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, format=log_format)
 logger = logging.getLogger(__name__)
 
+# Characters replaced with "_" in file names: anything but word characters (Unicode letters/digits, "_") and "-"
+UNSAFE_FILENAME_CHARS = re.compile(r"[^\w-]")
+
 # --- Database Setup ---
 DATABASE_PATH = os.path.join(GRADIO_WORKSPACE_DIR, 'tasks.db')
+# Finished tasks beyond the newest MAX_TASK_RECORDS, or finished more than TASK_RETENTION_SECONDS ago,
+# are dropped from the DB (their files stay on disk)
+MAX_TASK_RECORDS = 1000
+TASK_RETENTION_SECONDS = 24 * 3600
+# Only the newest MAX_TASK_LOG_LINES appended log lines are kept per task (the pipeline can print thousands)
+MAX_TASK_LOG_LINES = 200
+# Seconds a connection waits for another writer's lock before raising "database is locked"
+DB_BUSY_TIMEOUT = 30
 
 def get_db_conn():
     """Establishes a connection to the SQLite database."""
@@ -50,14 +74,20 @@ def get_db_conn():
     # might be used by the background worker thread.
     # For more complex apps, a connection pool or passing 
     # connection per request/task would be better.
-    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DATABASE_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
     conn.row_factory = sqlite3.Row # Return rows as dictionary-like objects
+    # WAL (set once in init_db) makes a commit an append to the log; NORMAL skips the fsync per
+    # commit, which WAL keeps crash-safe (at worst the last commits before a power loss are lost)
+    conn.execute("PRAGMA synchronous=NORMAL")
     return conn
 
 def init_db():
     """Initializes the database and creates the tasks table if it doesn't exist."""
     try:
         conn = get_db_conn()
+        # Persistent on the database file: readers (status polls, GET /tasks) no longer block the
+        # worker's and the update coalescer's writes, and other processes can share the file
+        conn.execute("PRAGMA journal_mode=WAL")
         cursor = conn.cursor()
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS tasks (
@@ -78,7 +108,20 @@ def init_db():
             processing_start_time REAL -- Added column for actual processing start time
         )
         ''')
+        # Append-only log lines; one row per event so logging a line never rewrites the task row
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS task_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL,
+            message TEXT NOT NULL
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_logs_task_id ON task_logs (task_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_start_time ON tasks (start_time)")
+        pruned = prune_finished_tasks(cursor) # Expired while the server was down
         conn.commit()
+        if pruned:
+            logger.info(f"Pruned {pruned} old finished task records from database.")
         logger.info(f"Database initialized successfully at {DATABASE_PATH}")
     except sqlite3.Error as e:
         logger.error(f"Database initialization failed: {e}", exc_info=True)
@@ -87,6 +130,28 @@ def init_db():
         if conn:
             conn.close()
 
+def prune_finished_tasks(cursor):
+    """
+    Deletes the records and log lines of finished tasks that are not among the newest
+    MAX_TASK_RECORDS tasks or finished more than TASK_RETENTION_SECONDS ago, so the database
+    and GET /tasks stay bounded. Returns the count.
+    """
+    # Finish time, approximated as processing start (or submission, for tasks that never started)
+    # plus the recorded elapsed time; a task that sat in the queue for a day is not dropped the
+    # moment it finishes
+    terminal_placeholders = ",".join("?" * len(TERMINAL_TASK_STATES))
+    cursor.execute(f'''
+    SELECT task_id FROM tasks
+    WHERE status IN ({terminal_placeholders})
+      AND (COALESCE(processing_start_time, start_time) + COALESCE(final_elapsed_time, 0) < ?
+           OR task_id NOT IN (SELECT task_id FROM tasks ORDER BY start_time DESC LIMIT ?))
+    ''', (*TERMINAL_TASK_STATES, time.time() - TASK_RETENTION_SECONDS, MAX_TASK_RECORDS))
+    stale = cursor.fetchall()
+    if stale:
+        cursor.executemany("DELETE FROM task_logs WHERE task_id = ?", stale)
+        cursor.executemany("DELETE FROM tasks WHERE task_id = ?", stale)
+    return len(stale)
+
 def add_task_to_db(task_id, task_data):
     """Adds a new task record to the database."""
     conn = None
@@ -117,8 +182,11 @@ def add_task_to_db(task_id, task_data):
             task_data.get('process_pid'), # Added value (will be None initially)
             task_data.get('processing_start_time') # Added value (will be None initially)
         ))
+        pruned = prune_finished_tasks(cursor)
         conn.commit()
         logger.info(f"Task {task_id} added to database.")
+        if pruned:
+            logger.info(f"Pruned {pruned} old finished task records from database.")
     except sqlite3.Error as e:
         logger.error(f"Failed to add task {task_id} to DB: {e}", exc_info=True)
         # Optionally re-raise or handle specific errors (e.g., UNIQUE constraint)
@@ -127,7 +195,11 @@ def add_task_to_db(task_id, task_data):
             conn.close()
 
 def update_task_in_db(task_id, updates):
-    """Updates specific fields of a task record in the database."""
+    """Updates specific fields of a task record in the database.
+
+    The special key 'append_log' (a line or a list of lines) is appended to the
+    task's log (stored in task_logs) instead of rewriting the whole log column.
+    """
     conn = None
     try:
         conn = get_db_conn()
@@ -136,6 +208,16 @@ def update_task_in_db(task_id, updates):
         set_clauses = []
         values = []
         for key, value in updates.items():
+            if key == "append_log":
+                log_lines = [value] if isinstance(value, str) else value
+                cursor.executemany("INSERT INTO task_logs (task_id, message) VALUES (?, ?)",
+                                   [(task_id, line) for line in log_lines])
+                # Drop everything older than the newest MAX_TASK_LOG_LINES lines (a capped list)
+                cursor.execute('''
+                DELETE FROM task_logs WHERE task_id = ? AND id <= (
+                    SELECT id FROM task_logs WHERE task_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)
+                ''', (task_id, task_id, MAX_TASK_LOG_LINES))
+                continue
             # Ensure the key is a valid column name to prevent SQL injection risk if keys were dynamic
             # (Here keys are controlled internally, so less risk, but good practice)
             valid_columns = ["status", "mode", "start_time", "original_filename", "logs", 
@@ -153,7 +235,10 @@ def update_task_in_db(task_id, updates):
                 logger.warning(f"Attempted to update invalid column '{key}' for task {task_id}")
 
         if not set_clauses: # No valid updates provided
-            logger.warning(f"No valid fields to update for task {task_id}")
+            if "append_log" in updates:
+                conn.commit()
+            else:
+                logger.warning(f"No valid fields to update for task {task_id}")
             return
 
         sql = f"UPDATE tasks SET { ', '.join(set_clauses)} WHERE task_id = ?"
@@ -185,6 +270,9 @@ def get_task_from_db(task_id):
             except (json.JSONDecodeError, TypeError):
                 logger.warning(f"Could not decode logs JSON for task {task_id}")
                 task_dict['logs'] = [] # Provide default
+            # Append lines logged after creation
+            cursor.execute("SELECT message FROM task_logs WHERE task_id = ? ORDER BY id", (task_id,))
+            task_dict['logs'] = (task_dict.get('logs') or []) + [log_row['message'] for log_row in cursor.fetchall()]
             try:
                 if task_dict.get('params'): task_dict['params'] = json.loads(task_dict['params'])
             except (json.JSONDecodeError, TypeError):
@@ -218,6 +306,7 @@ def delete_task_from_db(task_id):
     try:
         conn = get_db_conn()
         cursor = conn.cursor()
+        cursor.execute("DELETE FROM task_logs WHERE task_id = ?", (task_id,))
         cursor.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
         conn.commit()
         if cursor.rowcount > 0:
@@ -242,6 +331,11 @@ def get_all_tasks_from_db():
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM tasks ORDER BY start_time DESC") # Order by start time, newest first
         rows = cursor.fetchall()
+        # Fetch all appended log lines in one query and group them by task
+        appended_logs = {}
+        cursor.execute("SELECT task_id, message FROM task_logs ORDER BY id")
+        for log_row in cursor.fetchall():
+            appended_logs.setdefault(log_row['task_id'], []).append(log_row['message'])
         for row in rows:
             # Convert row object to a dictionary
             task_dict = dict(row)
@@ -252,6 +346,7 @@ def get_all_tasks_from_db():
             except (json.JSONDecodeError, TypeError):
                 logger.warning(f"Could not decode logs JSON for task {task_dict.get('task_id')}")
                 task_dict['logs'] = [] # Provide default
+            task_dict['logs'] += appended_logs.get(task_dict['task_id'], [])
             try:
                 if task_dict.get('params'): task_dict['params'] = json.loads(task_dict['params'])
                 else: task_dict['params'] = {} # Default if NULL
@@ -283,40 +378,96 @@ def get_all_tasks_from_db():
 
 # --- Task Queue Setup ---
 task_queue = queue.Queue()
-MAX_WORKERS = 1 # Limit to 1 concurrent OLMOCR process for now
 
-def processing_worker():
-    """Worker thread function to process tasks from the queue."""
+def processing_worker(gpu_index=None):
+    """Worker thread function to process tasks from the queue (on GPU gpu_index, if given)."""
     while True:
+        task_ids = [] # Set before anything can fail, so the error handler never sees a previous task's IDs
+        logger.info(f"Worker waiting for task... Queue size: {task_queue.qsize()}")
+        queued = task_queue.get() # Blocks until a task (or a batch from /batch) is available
         try:
-            logger.info(f"Worker waiting for task... Queue size: {task_queue.qsize()}")
-            upload_path, task_id, params = task_queue.get() # Blocks until a task is available
-            logger.info(f"Worker picked up task {task_id} for file: {upload_path}")
-            
+            items, params = queued
+            task_ids = [task_id for _, task_id in items]
+            logger.info(f"Worker picked up task(s) {', '.join(task_ids)} for file(s): {', '.join(path for path, _ in items)}")
+
             # --- Pass the DB update function as the callback ---
-            run_olmocr_on_single_pdf(upload_path, task_id, params, update_callback=update_task_in_db)
+            if len(items) == 1:
+                upload_path, task_id = items[0]
+                run_olmocr_on_single_pdf(upload_path, task_id, params, update_callback=update_task_in_db, gpu_index=gpu_index)
+            else:
+                run_olmocr_batch(items, params, update_callback=update_task_in_db, gpu_index=gpu_index)
             # --- End modification ---
 
-            logger.info(f"Worker finished task {task_id}")
-            task_queue.task_done() # Signal that the task is complete
+            logger.info(f"Worker finished task(s) {', '.join(task_ids)}")
         except Exception as e:
             logger.error(f"Error in processing worker: {e}", exc_info=True)
             # If a critical error happens here, the task state in DB might remain 'processing'
             # Consider adding logic here to update the task to 'failed' in DB
+            for task_id in task_ids:
+                try:
+                     update_task_in_db(task_id, {"status": "failed", "error": f"Worker thread error: {e}"})
+                except Exception as db_update_err:
+                     logger.error(f"[Task {task_id}] Failed to update task status to FAILED in DB after worker error: {db_update_err}")
+        finally:
+            task_queue.task_done() # Signal that the task is complete, even if it failed
+
+def requeue_pending_tasks():
+    """
+    Restores the in-memory queue from the database at startup, so accepted uploads survive a restart.
+    'queued' tasks are put back in submission order; tasks that were 'processing' lost their
+    OLMOCR process with the old server and are marked failed instead of being rerun blindly.
+    """
+    # Uploads are named {safe_base}_{task_id}{ext}; map task_id -> path with one directory listing
+    uploads = {}
+    with os.scandir(UPLOAD_TEMP_DIR) as it:
+        for entry in it:
+            stem = os.path.splitext(entry.name)[0]
+            uploads[stem[-36:]] = entry.path # task_id is a uuid4 string (36 chars)
+
+    conn = None
+    try:
+        conn = get_db_conn()
+        rows = conn.execute(
+            "SELECT task_id, status, params FROM tasks WHERE status IN ('queued', 'processing') ORDER BY start_time"
+        ).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load pending tasks from DB: {e}", exc_info=True)
+        return
+    finally:
+        if conn:
+            conn.close()
+
+    requeued = 0
+    for row in rows:
+        task_id = row['task_id']
+        upload_path = uploads.get(task_id)
+        if row['status'] == 'queued' and upload_path:
             try:
-                 update_task_in_db(task_id, {"status": "failed", "error": f"Worker thread error: {e}"})
-            except Exception as db_update_err:
-                 logger.error(f"[Task {task_id}] Failed to update task status to FAILED in DB after worker error: {db_update_err}")
+                params = json.loads(row['params']) if row['params'] else {}
+            except (json.JSONDecodeError, TypeError):
+                params = {}
+            task_queue.put(([(upload_path, task_id)], params)) # Batches are requeued file by file
+            update_task_in_db(task_id, {"append_log": f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Task re-queued after server restart"})
+            requeued += 1
+        else:
+            reason = "interrupted by server restart" if row['status'] == 'processing' else "uploaded file missing after server restart"
+            update_task_in_db(task_id, {"status": "failed", "error": f"Task {reason}"})
+            logger.warning(f"[Task {task_id}] Marked failed: {reason}")
+    if rows:
+        logger.info(f"Re-queued {requeued} of {len(rows)} pending tasks from the database.")
 
 # --- API Key Authentication ---
 # IMPORTANT: Set this environment variable in production!
 API_KEY = os.environ.get("API_SECRET_KEY", "default_secret_key_change_me")
+API_KEY_BYTES = API_KEY.encode() # Compared with hmac.compare_digest, which needs bytes for non-ASCII keys
 
 def require_api_key(f):
     """Decorator to require API key in request header."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if request.headers.get('X-API-Key') and request.headers.get('X-API-Key') == API_KEY:
+        provided_key = request.headers.get('X-API-Key')
+        # Constant-time comparison: the time taken does not reveal how much of the key matched
+        if provided_key and hmac.compare_digest(provided_key.encode(), API_KEY_BYTES):
             return f(*args, **kwargs)
         else:
             logger.warning("Unauthorized access attempt.")
@@ -325,18 +476,12 @@ def require_api_key(f):
 
 # --- API Endpoints ---
 
-@app.route('/process', methods=['POST'])
-@require_api_key
-def start_processing():
-    """Endpoint to upload a PDF, add to DB & queue."""
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part in the request"}), 400
-    file = request.files['file']
-    if file.filename == '' or not file.filename.lower().endswith('.pdf'):
-        return jsonify({"error": "No selected file or invalid file type (must be .pdf)"}), 400
-
-    # --- Parameter Handling with Modes ---
-    mode = request.form.get('mode', 'normal')
+def parse_processing_params(form):
+    """
+    Reads the processing mode and parameters from a request form.
+    Returns (mode, params); raises ValueError with a client-facing message on invalid input.
+    """
+    mode = form.get('mode', 'normal')
     params = {}
     if mode == 'fast':
         # Fast mode: Only requires the file. Use fixed error_rate and retries.
@@ -349,7 +494,7 @@ def start_processing():
         required_params_normal = ['target_dim', 'anchor_len', 'error_rate', 'max_context', 'max_retries']
         missing_params = [] # Reset missing_params for normal mode
         for p in required_params_normal:
-            value = request.form.get(p)
+            value = form.get(p)
             if value is None:
                 missing_params.append(p)
             else:
@@ -360,36 +505,54 @@ def start_processing():
                     elif p == 'error_rate':
                         params[p] = float(value)
                 except ValueError:
-                     return jsonify({"error": f"Invalid value type for parameter '{p}'. Expected numeric."}), 400
+                     raise ValueError(f"Invalid value type for parameter '{p}'. Expected numeric.") from None
 
         if missing_params:
-            return jsonify({"error": f"Missing required parameters for mode '{mode}': {', '.join(missing_params)}"}), 400
+            raise ValueError(f"Missing required parameters for mode '{mode}': {', '.join(missing_params)}")
 
     # Add fixed worker count
     params['workers'] = 1
-    # --- End Parameter Handling ---
+    return mode, params
 
-    task_id = str(uuid.uuid4())
-    
-    # --- New Filename Logic --- 
-    original_filename = file.filename
-    base_name, ext = os.path.splitext(original_filename)
+def upload_filename_for(filename, task_id):
+    """Returns the upload file name for a client file name: {safe_base}_{task_id}{ext}."""
+    base_name, ext = os.path.splitext(filename)
     # Sanitize the base name
-    safe_base_name = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in base_name)
+    safe_base_name = UNSAFE_FILENAME_CHARS.sub('_', base_name)
     # Keep the original extension (lowercase, ensure leading dot if exists)
     safe_ext = ext.lower() if ext else ''
     if safe_ext and not safe_ext.startswith('.'):
         safe_ext = '.' + safe_ext
-    # Construct the unique upload filename: {safe_base}_{task_id}{ext}
-    upload_filename = f"{safe_base_name}_{task_id}{safe_ext}" 
-    upload_path = os.path.join(UPLOAD_TEMP_DIR, upload_filename)
-    # --- End New Filename Logic ---
+    return f"{safe_base_name}_{task_id}{safe_ext}"
+
+def save_upload(file, upload_path):
+    """
+    Places an uploaded file at upload_path. Uploads spooled by UploadRequest are hard-linked (the
+    spool file is removed when the request ends), so the body is written to disk only once.
+    """
+    spool_path = getattr(file.stream, "name", None)
+    if isinstance(spool_path, str) and os.path.dirname(spool_path) == UPLOAD_TEMP_DIR:
+        file.stream.flush()
+        try:
+            os.link(spool_path, upload_path)
+            return
+        except OSError:
+            pass # Filesystem without hard links; copy instead
+    file.save(upload_path)
+
+def create_task(file, mode, params):
+    """
+    Adds a queued task for an uploaded file to the DB and saves the file.
+    Returns (task_id, upload_path); on error the task and the file are removed again and the error is re-raised.
+    """
+    task_id = str(uuid.uuid4())
+    upload_path = os.path.join(UPLOAD_TEMP_DIR, upload_filename_for(file.filename, task_id))
 
     try:
         # 1. Prepare task data for DB insertion FIRST
         task_data = {
             "status": "queued",
-            "mode": mode, # Get mode again here
+            "mode": mode,
             "start_time": time.time(),
             "original_filename": file.filename,
             "logs": [f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Task created and queued"],
@@ -408,25 +571,90 @@ def start_processing():
         add_task_to_db(task_id, task_data)
 
         # 3. Save the file
-        file.save(upload_path)
+        save_upload(file, upload_path)
         logger.info(f"File uploaded to: {upload_path}")
-
-        # 4. Put the task details (needed by worker) into the queue
-        task_queue.put((upload_path, task_id, params))
-        logger.info(f"Task {task_id} added to queue. Queue size: {task_queue.qsize()}")
-
-        return jsonify({"message": "Processing task added to queue", "task_id": task_id}), 202 # Accepted
+        return task_id, upload_path
 
     except Exception as e:
-        logger.error(f"Error starting processing task {task_id}: {e}", exc_info=True)
+        logger.error(f"Error creating task {task_id}: {e}", exc_info=True)
         # Attempt cleanup
+        delete_task_files([(upload_path, task_id)])
+        raise
+
+def delete_task_files(items):
+    """Removes the uploads and DB records of tasks that could not be queued."""
+    for upload_path, task_id in items:
         if os.path.exists(upload_path):
-            try: os.remove(upload_path) 
+            try: os.remove(upload_path)
             except OSError as rm_err: logger.error(f"Failed to remove uploaded file {upload_path} after error: {rm_err}")
         # Also attempt to delete from DB if it was added
         delete_task_from_db(task_id)
+
+@app.route('/process', methods=['POST'])
+@require_api_key
+def start_processing():
+    """Endpoint to upload a PDF, add to DB & queue."""
+    if 'file' not in request.files:
+        return jsonify({"error": "No file part in the request"}), 400
+    file = request.files['file']
+    if file.filename == '' or not file.filename.lower().endswith('.pdf'):
+        return jsonify({"error": "No selected file or invalid file type (must be .pdf)"}), 400
+
+    try:
+        mode, params = parse_processing_params(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        task_id, upload_path = create_task(file, mode, params)
+    except Exception as e:
         return jsonify({"error": f"Failed to start processing: {e}"}), 500
 
+    # Put the task details (needed by worker) into the queue
+    task_queue.put(([(upload_path, task_id)], params))
+    logger.info(f"Task {task_id} added to queue. Queue size: {task_queue.qsize()}")
+
+    return jsonify({"message": "Processing task added to queue", "task_id": task_id}), 202 # Accepted
+
+@app.route('/batch', methods=['POST'])
+@require_api_key
+def start_batch_processing():
+    """
+    Endpoint to upload several PDFs ('files' form field) that are OCR'd by a single pipeline run.
+    Each file gets its own task (queried and cancelled through the usual task endpoints); cancelling
+    one task cancels the whole batch.
+    """
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({"error": "No 'files' part in the request"}), 400
+    for file in files:
+        if file.filename == '' or not file.filename.lower().endswith('.pdf'):
+            return jsonify({"error": f"Invalid file '{file.filename}' (must be .pdf)"}), 400
+    # The pipeline's rows are matched back to their file by name, so names must be unique within the batch
+    safe_names = [upload_filename_for(file.filename, "") for file in files]
+    if len(set(safe_names)) != len(safe_names):
+        return jsonify({"error": "File names in a batch must be unique"}), 400
+
+    try:
+        mode, params = parse_processing_params(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    items = []
+    try:
+        for file in files:
+            task_id, upload_path = create_task(file, mode, params)
+            items.append((upload_path, task_id))
+    except Exception as e:
+        delete_task_files(items) # Queue all of the batch or none of it
+        return jsonify({"error": f"Failed to start batch processing: {e}"}), 500
+
+    task_queue.put((items, params))
+    task_ids = [task_id for _, task_id in items]
+    logger.info(f"Batch of {len(task_ids)} tasks added to queue. Queue size: {task_queue.qsize()}")
+
+    return jsonify({"message": "Batch processing task added to queue", "task_ids": task_ids}), 202 # Accepted
+
 @app.route('/process/<task_id>', methods=['GET'])
 @require_api_key
 def get_task_status(task_id):
@@ -441,7 +669,6 @@ def get_task_status(task_id):
     task_info = task_dict # Use the dictionary fetched from DB
 
     # --- Determine elapsed time based on status and stored values ---
-    terminal_states = ["completed", "failed", "completed_with_warnings", "cancelled"]
     current_status = task_info.get("status")
     final_elapsed = task_info.get("final_elapsed_time")
     processing_start_val = task_info.get("processing_start_time")
@@ -450,7 +677,7 @@ def get_task_status(task_id):
         task_info["elapsed_time_seconds"] = 0
     elif current_status == 'processing' and processing_start_val is not None:
         task_info["elapsed_time_seconds"] = time.time() - processing_start_val
-    elif current_status in terminal_states and final_elapsed is not None:
+    elif current_status in TERMINAL_TASK_STATES and final_elapsed is not None:
         task_info["elapsed_time_seconds"] = final_elapsed
     else:
         task_info["elapsed_time_seconds"] = 0 # Fallback
@@ -476,17 +703,62 @@ def get_task_status(task_id):
 
     return jsonify(task_info), 200
 
+def file_listing_response(field, directory, list_func):
+    """
+    Returns the JSON listing {field: list_func()} with the directory's mtime as its ETag. A poll
+    that sends it back in If-None-Match gets an empty 304 until a file is added or removed.
+    """
+    try:
+        etag = str(os.stat(directory).st_mtime_ns)
+    except OSError:
+        etag = None
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({field: list_func()})
+    if etag:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache" # Clients may keep it, but must revalidate
+    return response
+
 @app.route('/files/previews', methods=['GET'])
 @require_api_key
 def get_preview_files():
     """Endpoint to list available HTML preview files."""
     try:
-        files = list_preview_files()
-        return jsonify({"preview_files": files}), 200
+        return file_listing_response("preview_files", PROCESSED_PREVIEW_DIR, list_preview_files)
     except Exception as e:
         logger.error(f"Error listing preview files: {e}")
         return jsonify({"error": f"Could not list preview files: {e}"}), 500
 
+# --- File Download Offloading ---
+# Behind a reverse proxy the proxy can send file bodies itself, so downloads don't occupy a Python thread:
+# - nginx: set X_ACCEL_REDIRECT_PREFIX (e.g. /_olmocr_files) and map it to the API workspace with
+#   location /_olmocr_files/ { internal; alias <GRADIO_WORKSPACE_DIR>/; }
+# - Apache mod_xsendfile / lighttpd: set USE_X_SENDFILE=1 (Flask then sends the path in X-Sendfile)
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
+
+def send_workspace_file(path, download_name, mimetype=None):
+    """
+    Sends a file under GRADIO_WORKSPACE_DIR as an attachment: as an X-Accel-Redirect for nginx
+    when configured, otherwise with send_file (which honours use_x_sendfile).
+    Raises FileNotFoundError if the file does not exist.
+    """
+    if not X_ACCEL_REDIRECT_PREFIX:
+        return send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    relative_path = os.path.relpath(path, GRADIO_WORKSPACE_DIR).replace(os.sep, "/")
+    response = Response(mimetype=mimetype or mimetypes.guess_type(download_name)[0] or "application/octet-stream")
+    response.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT_PREFIX}/{quote(relative_path)}"
+    try:
+        download_name.encode("ascii")
+        response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+    except UnicodeEncodeError: # RFC 5987 form for non-ASCII names, as send_file does
+        response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(download_name, safe='')}"
+    return response
+
 @app.route('/files/previews/<filename>', methods=['GET'])
 @require_api_key
 def download_preview_file(filename):
@@ -495,8 +767,8 @@ def download_preview_file(filename):
     if '..' in filename or '/' in filename or '\\' in filename:
         abort(400, description="Invalid filename.")
     try:
-        # Use send_from_directory for safer file serving
-        return send_from_directory(PROCESSED_PREVIEW_DIR, filename, as_attachment=True)
+        # filename was checked for path separators above, so the join stays inside the directory
+        return send_workspace_file(os.path.join(PROCESSED_PREVIEW_DIR, filename), filename)
     except FileNotFoundError:
         abort(404, description="File not found.")
     except Exception as e:
@@ -508,8 +780,7 @@ def download_preview_file(filename):
 def get_jsonl_files():
     """Endpoint to list available JSONL files."""
     try:
-        files = list_jsonl_files()
-        return jsonify({"jsonl_files": files}), 200
+        return file_listing_response("jsonl_files", PROCESSED_JSONL_DIR, list_jsonl_files)
     except Exception as e:
         logger.error(f"Error listing jsonl files: {e}")
         return jsonify({"error": f"Could not list jsonl files: {e}"}), 500
@@ -521,23 +792,32 @@ def download_jsonl_file(filename):
     if '..' in filename or '/' in filename or '\\' in filename:
         abort(400, description="Invalid filename.")
     try:
-        return send_from_directory(PROCESSED_JSONL_DIR, filename, as_attachment=True)
+        return send_workspace_file(os.path.join(PROCESSED_JSONL_DIR, filename), filename)
     except FileNotFoundError:
         abort(404, description="File not found.")
     except Exception as e:
         logger.error(f"Error sending jsonl file {filename}: {e}")
         abort(500, description="Could not send file.")
 
+def _zip_stream_response(result):
+    """
+    Sends an export's zip chunks as they are produced instead of serving a finished file. A cached
+    export ("path") is handed to the reverse proxy instead when download offloading is configured.
+    """
+    if result.get("path") and (X_ACCEL_REDIRECT_PREFIX or app.use_x_sendfile):
+        result["chunks"].close()
+        return send_workspace_file(result["path"], result["filename"], mimetype='application/zip')
+    return Response(stream_with_context(result["chunks"]), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={result["filename"]}'})
+
 @app.route('/export/html', methods=['GET'])
 @require_api_key
 def download_html_export():
     """Endpoint to export all HTML files as a zip archive."""
     try:
         result = export_html_archive()
-        if result["status"] == "success" and result["zip_path"]:
-            zip_filename = os.path.basename(result["zip_path"])
-            # Serve from the EXPORT_TEMP_DIR_BASE directory
-            return send_from_directory(EXPORT_TEMP_DIR_BASE, zip_filename, as_attachment=True)
+        if result["status"] == "success" and result["chunks"]:
+            return _zip_stream_response(result)
         else:
             return jsonify({"error": result["message"]}), 404 # Or 500 if error during creation
     except Exception as e:
@@ -553,9 +833,8 @@ def download_combined_export(export_format):
 
     try:
         result = export_combined_archive(export_format)
-        if result["status"] == "success" and result["zip_path"]:
-            zip_filename = os.path.basename(result["zip_path"])
-            return send_from_directory(EXPORT_TEMP_DIR_BASE, zip_filename, as_attachment=True)
+        if result["status"] == "success" and result["chunks"]:
+            return _zip_stream_response(result)
         elif result["status"] == "error" and "没有 JSONL 文件" in result["message"]:
              return jsonify({"error": result["message"]}), 404
         else:
@@ -610,7 +889,6 @@ def get_all_tasks():
         # For simplicity, let's return the raw data for now.
         # Frontend can calculate elapsed time for non-terminal states if needed.
         for task_info in all_tasks:
-            terminal_states = ["completed", "failed", "completed_with_warnings", "cancelled"]
             current_status = task_info.get("status")
             final_elapsed = task_info.get("final_elapsed_time")
             processing_start_val = task_info.get("processing_start_time")
@@ -619,7 +897,7 @@ def get_all_tasks():
                 task_info["elapsed_time_seconds"] = 0
             elif current_status == 'processing' and processing_start_val is not None:
                 task_info["elapsed_time_seconds"] = time.time() - processing_start_val
-            elif current_status in terminal_states and final_elapsed is not None:
+            elif current_status in TERMINAL_TASK_STATES and final_elapsed is not None:
                 task_info["elapsed_time_seconds"] = final_elapsed
             else:
                 task_info["elapsed_time_seconds"] = 0 # Fallback
@@ -658,9 +936,14 @@ def delete_task(task_id):
     pid_to_terminate = task.get('process_pid')
     current_status = task.get('status')
 
-    # 2. Attempt to terminate the OLMOCR process (Linux only, if running)
+    # 2. Stop the OLMOCR process if the task is running
     process_terminated = False
-    if platform.system() == "Linux" and pid_to_terminate and current_status == 'processing':
+    if current_status == 'processing' and request_task_cancel(task_id):
+        # Running in this server: the worker terminates the OLMOCR process tree and records 'cancelled' itself
+        process_terminated = True
+        messages.append(f"Cancelled running task {task_id} (OLMOCR process tree terminated by its worker).")
+    # Fallback for a PID recorded by another process (Linux only)
+    elif platform.system() == "Linux" and pid_to_terminate and current_status == 'processing':
         logger.info(f"[Task {task_id}] Attempting to terminate OLMOCR process with PID: {pid_to_terminate}")
         try:
             parent = psutil.Process(pid_to_terminate)
@@ -770,27 +1053,53 @@ def delete_task(task_id):
     else:
         return jsonify({"message": f"Task {task_id} deleted successfully (process termination attempted/verified, files cleaned, DB record removed).", "details": messages}), 200
 
+_service_started = False
+_service_lock = threading.Lock()
+
+def create_app():
+    """
+    Initializes the database, re-queues pending tasks and starts the processing workers (once),
+    then returns the app. Entry point for WSGI servers, e.g. gunicorn's gthread worker, which
+    keeps idle and keep-alive connections on its event loop and runs handlers on a bounded
+    thread pool instead of a thread per connection:
+
+        gunicorn -w 1 -k gthread --threads 32 -b 0.0.0.0:7860 'flask_app:create_app()'
+
+    Use a single worker process: the task queue and the running-task registry live in it.
+    """
+    global _service_started
+    with _service_lock:
+        if _service_started:
+            return app
+        # Workspace directories (including UPLOAD_TEMP_DIR), GPU monitoring and the CPU sampler
+        gpu_count = start_background_services()
+        # --- Initialize Database ---
+        init_db()
+        requeue_pending_tasks()
+        # --- End DB Init ---
+
+        # --- Start Worker Threads ---
+        # One OLMOCR process per GPU, each pinned to its own device; a single worker (GPU-less host or
+        # one GPU) leaves the pipeline unpinned, as before
+        max_workers = max(gpu_count, 1)
+        logger.info(f"Starting {max_workers} processing worker threads...")
+        for i in range(max_workers):
+            worker_thread = threading.Thread(target=processing_worker, args=(i if max_workers > 1 else None,), daemon=True)
+            worker_thread.start()
+            logger.info(f"Worker thread {i+1} started.")
+
+        print(f"INFO: Using API Key: {API_KEY[:4]}...{API_KEY[-4:] if len(API_KEY) > 8 else ''}") # Print partial key for verification
+        _service_started = True
+    return app
+
 if __name__ == '__main__':
-    # Ensure UPLOAD_TEMP_DIR exists before running
-    os.makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
-    
-    # --- Initialize Database ---
-    init_db()
-    # --- End DB Init ---
-
-    # --- Start Worker Threads ---
-    logger.info(f"Starting {MAX_WORKERS} processing worker threads...")
-    for i in range(MAX_WORKERS):
-        worker_thread = threading.Thread(target=processing_worker, daemon=True)
-        worker_thread.start()
-        logger.info(f"Worker thread {i+1} started.")
-
-    print(f"INFO: Using API Key: {API_KEY[:4]}...{API_KEY[-4:] if len(API_KEY) > 8 else ''}") # Print partial key for verification
     # Run Flask app (use 0.0.0.0 to be accessible on network)
     # Set debug=True for development only, disable in production
-    app.run(host='0.0.0.0', port=7860, debug=False)
+    # OCR runs on the worker threads, never in a request; threaded serving keeps status polls
+    # and uploads answered while a handler streams a large export
+    create_app().run(host='0.0.0.0', port=7860, debug=False, threaded=True)
 
 # Note: When running with a production server like Gunicorn with multiple workers,
 # this simple in-memory queue and worker thread approach will NOT work correctly,
-# as each worker process would have its own queue and threads.
-# A shared queue (like Redis) and dedicated worker processes (like Celery) would be needed. 
\ No newline at end of file
+# as each worker process would have its own queue and threads. Run one worker process
+# (with threads, see create_app) instead.
@@ -1,5 +1,6 @@
 from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, abort
 import os
+import hmac
 import json
 import time
 import uuid
@@ -23,21 +24,21 @@ logger = logging.getLogger(__name__)
 
 # --- API Key Authentication (Reuse from the other app) ---
 API_KEY = os.environ.get("OPENAI_API_SECRET_KEY", "default_openai_secret_key_change_me")
+API_KEY_BYTES = API_KEY.encode() # Compared with hmac.compare_digest, which needs bytes for non-ASCII keys
 # NOTE: Using a *different* environment variable name to avoid conflicts if run in same env
 
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         auth_header = request.headers.get('Authorization')
-        key_from_header = request.headers.get('X-Api-Key') # Also check direct header if needed
 
-        provided_key = None
         if auth_header and auth_header.startswith('Bearer '):
             provided_key = auth_header.split(' ')[1]
-        elif key_from_header:
-            provided_key = key_from_header
+        else:
+            provided_key = request.headers.get('X-Api-Key') # Also check direct header if needed
 
-        if provided_key and provided_key == API_KEY:
+        # Constant-time comparison: the time taken does not reveal how much of the key matched
+        if provided_key and hmac.compare_digest(provided_key.encode(), API_KEY_BYTES):
             return f(*args, **kwargs)
         else:
             logger.warning(f"Unauthorized access attempt to OpenAI compat API. Provided key: {provided_key[:5] if provided_key else 'None'}...")
@@ -84,7 +85,7 @@ def chat_completions():
     elif not os.path.isabs(pdf_file_path):
         logger.warning(f"Request {request_id}: pdf_file_path is not absolute: {pdf_file_path}")
         should_use_fixed_reply = True # Treat non-absolute paths as invalid for this case
-    elif not os.path.exists(pdf_file_path) or not os.path.isfile(pdf_file_path):
+    elif not os.path.isfile(pdf_file_path): # False for missing paths too; one stat instead of two
         logger.warning(f"Request {request_id}: PDF file not found or not a file: {pdf_file_path}")
         should_use_fixed_reply = True # Treat non-existent files as needing the fixed reply
 
@@ -371,4 +372,6 @@ if __name__ == '__main__':
     print(f"INFO: HTML files served from: {PROCESSED_PREVIEW_DIR}")
     print(f"INFO: DOCX files served from: {OPENAI_DOCX_OUTPUT_DIR}")
     # Use debug=False for production
-    app.run(host='0.0.0.0', port=port, debug=False) 
\ No newline at end of file
+    # A completion request waits for the whole OLMOCR run (it returns the result); one thread per
+    # request keeps the file endpoints and other requests answered meanwhile
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True) 
\ No newline at end of file
@@ -1,12 +1,16 @@
 import os
+import re
 import shutil
 import tempfile
-import glob
 import subprocess
 import json
 import time
 import logging
 import uuid
+import collections
+import threading
+
+from olmocr.app_utils import SCRATCH_BASE, fast_copy, link_or_copy, load_conversion_script, run_viewer
 
 # --- Configuration ---
 WORKSPACE_NAME = "openai_api_workspace"
@@ -31,6 +35,9 @@ def ensure_openai_dirs():
 
 ensure_openai_dirs()
 
+# Characters replaced with "_" in generated file names: anything but Unicode letters, digits and "_"
+NON_WORD_CHARS = re.compile(r"\W")
+
 # --- Logging Setup ---
 log_format = '%(asctime)s - %(name)s - %(levelname)s - [OpenAICompat] - %(message)s'
 # Avoid duplicate handlers if basicConfig was called elsewhere (e.g., by the other app if run in same process)
@@ -38,45 +45,57 @@ if not logging.getLogger().handlers:
     logging.basicConfig(level=logging.INFO, format=log_format)
 logger = logging.getLogger(__name__)
 
-# --- Conversion Script Helper (Adapted) ---
-def run_conversion_script(script_name, input_path, output_dir):
-    """Runs a conversion script, handling potential path issues."""
-    # Try finding scripts relative to this file's location first
-    script_dir_rel = os.path.join(os.path.dirname(__file__), "..", "scripts")
-    # Then try finding scripts relative to CWD (if run from top level)
-    script_dir_cwd = os.path.join("scripts")
-
-    script_path_rel = os.path.join(script_dir_rel, script_name)
-    script_path_cwd = os.path.join(script_dir_cwd, script_name)
-
-    if os.path.exists(script_path_rel):
-        script_path = script_path_rel
-    elif os.path.exists(script_path_cwd):
-        script_path = script_path_cwd
-    else:
-        raise FileNotFoundError(f"转换脚本未找到: 尝试了 {script_path_rel} 和 {script_path_cwd}")
-
-    cmd = ["python", script_path, input_path, output_dir]
-    logger.info(f"运行转换脚本: {' '.join(cmd)}")
+def find_output_jsonl(results_dir):
+    """
+    Returns the os.DirEntry of the pipeline's output_*.jsonl in results_dir, or None if there is none
+    (or the directory was never created). The entry's stat() is cached, so the size check needs no path lookup.
+    """
     try:
-        process = subprocess.run(
-            cmd, capture_output=True, text=True, check=True, encoding='utf-8', timeout=120
-        )
-        logger.info(f"脚本 {script_name} STDOUT:\n{process.stdout}")
-        if process.stderr:
-             logger.warning(f"脚本 {script_name} STDERR:\n{process.stderr}")
-        logger.info(f"脚本 {script_name} 执行成功。")
-        # Return list of ALL files potentially created in the output dir
-        return glob.glob(os.path.join(output_dir, "*"))
-    except subprocess.CalledProcessError as e:
-        logger.error(f"脚本 {script_name} 执行失败 (Code: {e.returncode}). STDOUT: {e.stdout} STDERR: {e.stderr}")
-        raise RuntimeError(f"脚本 {script_name} 执行失败 (Code: {e.returncode}): {e.stderr.strip() if e.stderr else '(No stderr)'}") from e
-    except subprocess.TimeoutExpired as e:
-         logger.error(f"脚本 {script_name} 执行超时.")
-         raise TimeoutError(f"脚本 {script_name} 执行超时.") from e
-    except Exception as e:
-        logger.exception(f"运行转换脚本时发生意外错误: {script_name}")
-        raise e
+        with os.scandir(results_dir) as it:
+            return next((entry for entry in it if entry.name.startswith("output_") and entry.name.endswith(".jsonl")), None)
+    except FileNotFoundError:
+        return None
+
+# --- Subprocess Output Helper ---
+OUTPUT_TAIL_LINES = 20 # Lines of OLMOCR output kept per stream for the <think> log
+
+def run_with_output_tail(cmd):
+    """
+    Runs cmd, draining stdout and stderr line by line on reader threads into bounded deques,
+    so a verbose OLMOCR run never holds its whole output in memory. Lines are kept as bytes;
+    only the tails are decoded. Returns (returncode, stdout_tail, stderr_tail), the tails as strings.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    tails = (collections.deque(maxlen=OUTPUT_TAIL_LINES), collections.deque(maxlen=OUTPUT_TAIL_LINES))
+    readers = [threading.Thread(target=tail.extend, args=(stream,), daemon=True)
+               for stream, tail in zip((process.stdout, process.stderr), tails)]
+    for reader in readers:
+        reader.start()
+    returncode = process.wait()
+    for reader in readers:
+        reader.join()
+    return returncode, *(b"".join(tail).decode("utf-8", "replace") for tail in tails)
+
+# --- Conversion Script Helper (Adapted) ---
+# Conversion scripts live in ../scripts relative to this file; resolved once at import
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+def run_conversion_script(script_name, jsonl_path, output_dir):
+    """
+    Converts one JSONL file in-process with the script's render_one() and writes the result to
+    output_dir. Returns the written file's path, or None if the script produced nothing (no text).
+    """
+    conversion_module = load_conversion_script(SCRIPTS_DIR, script_name)
+    logger.info(f"运行转换脚本: {script_name} {jsonl_path}")
+    rendered = conversion_module.render_one(jsonl_path)
+    if rendered is None:
+        return None
+    output_filename, data = rendered
+    output_path = os.path.join(output_dir, output_filename)
+    with open(output_path, "wb") as f:
+        f.write(data)
+    logger.info(f"脚本 {script_name} 执行成功: {output_path}")
+    return output_path
 
 
 # --- Core Processing Logic --- 
@@ -114,16 +133,15 @@ def process_pdf_openai_style(pdf_filepath):
 
     try:
         # 1. Create temp dir
-        run_dir = tempfile.mkdtemp(dir=WORKSPACE_DIR, prefix=f"openai_run_{run_uuid}_")
+        run_dir = tempfile.mkdtemp(dir=SCRATCH_BASE, prefix=f"openai_run_{run_uuid}_")
         log_and_accumulate(f"创建临时工作区: {run_dir}")
 
         # 2. Copy PDF
         base_name, _ = os.path.splitext(current_file_name)
-        safe_base_name = f"openai_{run_uuid}_{''.join(c if c.isalnum() else '_' for c in base_name[:30])}"
+        safe_base_name = f"openai_{run_uuid}_{NON_WORD_CHARS.sub('_', base_name[:30])}"
         persistent_pdf_filename = safe_base_name + ".pdf"
         persistent_pdf_path = os.path.join(PROCESSED_PDF_DIR, persistent_pdf_filename)
-        os.makedirs(PROCESSED_PDF_DIR, exist_ok=True)
-        shutil.copy(pdf_filepath, persistent_pdf_path)
+        fast_copy(pdf_filepath, persistent_pdf_path)
         log_and_accumulate(f"缓存 PDF 到: {persistent_pdf_path}")
 
         # 3. Run OLMOCR
@@ -137,43 +155,36 @@ def process_pdf_openai_style(pdf_filepath):
         ]
         cmd_str = ' '.join(cmd)
         log_and_accumulate(f"执行 OLMOCR 命令: {cmd_str}")
-        process = subprocess.run(cmd, capture_output=True, text=True, check=False, encoding='utf-8')
-        log_and_accumulate(f"OLMOCR 进程完成 (返回码: {process.returncode})")
-        if process.stdout: log_and_accumulate(f"OLMOCR STDOUT [截断]:\n{process.stdout.strip()[:500]}...")
-        if process.stderr: log_and_accumulate(f"OLMOCR STDERR [截断]:\n{process.stderr.strip()[:500]}...")
-        if process.returncode != 0:
-            raise RuntimeError(f"OLMOCR failed (Code: {process.returncode}). Check logs for details.")
+        returncode, stdout_tail, stderr_tail = run_with_output_tail(cmd)
+        log_and_accumulate(f"OLMOCR 进程完成 (返回码: {returncode})")
+        if stdout_tail: log_and_accumulate(f"OLMOCR STDOUT [最后 {OUTPUT_TAIL_LINES} 行]:\n{stdout_tail.strip()}")
+        if stderr_tail: log_and_accumulate(f"OLMOCR STDERR [最后 {OUTPUT_TAIL_LINES} 行]:\n{stderr_tail.strip()}")
+        if returncode != 0:
+            raise RuntimeError(f"OLMOCR failed (Code: {returncode}). Check logs for details.")
 
         # 4. Process JSONL
-        jsonl_files_temp = glob.glob(os.path.join(olmocr_results_dir, "output_*.jsonl"))
-        if not jsonl_files_temp:
+        jsonl_entry = find_output_jsonl(olmocr_results_dir)
+        if jsonl_entry is None:
             raise FileNotFoundError(f"OLMOCR output JSONL not found in {olmocr_results_dir}")
-        temp_jsonl_path = jsonl_files_temp[0]
-        if os.path.getsize(temp_jsonl_path) == 0:
+        temp_jsonl_path = jsonl_entry.path
+        if jsonl_entry.stat().st_size == 0:
              log_and_accumulate("警告 - OLMOCR 生成了空的 JSONL 文件。")
              raise RuntimeError("OLMOCR generated empty JSONL file.")
-        os.makedirs(PROCESSED_JSONL_DIR, exist_ok=True)
         persistent_jsonl_filename = f"{safe_base_name}_output.jsonl"
         persistent_jsonl_path = os.path.join(PROCESSED_JSONL_DIR, persistent_jsonl_filename)
-        shutil.copy(temp_jsonl_path, persistent_jsonl_path)
+        link_or_copy(temp_jsonl_path, persistent_jsonl_path) # run_dir is removed afterwards, so a link is safe
         log_and_accumulate(f"JSONL 文件已保存到: {persistent_jsonl_path}")
 
-        # 5. Generate HTML Preview
-        os.makedirs(PROCESSED_PREVIEW_DIR, exist_ok=True)
-        viewer_cmd = [
-            "python", "-m", "olmocr.viewer.dolmaviewer",
-            persistent_jsonl_path, "--output_dir", PROCESSED_PREVIEW_DIR
-        ]
+        # 5. Generate HTML Preview, named after the run's unique base name (independent of the workspace location)
+        expected_html_filename = safe_base_name + ".html"
+        expected_html_path = os.path.join(PROCESSED_PREVIEW_DIR, expected_html_filename)
         log_and_accumulate("执行 HTML 预览生成...")
-        viewer_process = subprocess.run(viewer_cmd, capture_output=True, text=True, check=False, encoding='utf-8')
-        log_and_accumulate(f"HTML 预览生成完成 (Code: {viewer_process.returncode})")
-        if viewer_process.stdout: log_and_accumulate(f"Viewer STDOUT [截断]:\n{viewer_process.stdout.strip()[:500]}...")
-        if viewer_process.stderr: log_and_accumulate(f"Viewer STDERR [截断]:\n{viewer_process.stderr.strip()[:500]}...")
+        viewer_returncode, viewer_stdout, viewer_stderr = run_viewer(persistent_jsonl_path, PROCESSED_PREVIEW_DIR, expected_html_filename)
+        log_and_accumulate(f"HTML 预览生成完成 (Code: {viewer_returncode})")
+        if viewer_stdout: log_and_accumulate(f"Viewer STDOUT [截断]:\n{viewer_stdout.strip()[:500]}...")
+        if viewer_stderr: log_and_accumulate(f"Viewer STDERR [截断]:\n{viewer_stderr.strip()[:500]}...")
         generated_html_path = None
-        if viewer_process.returncode == 0:
-            path_for_html_name = persistent_pdf_path.replace(os.sep, '_').replace('.', '_')
-            expected_html_filename = path_for_html_name + ".html"
-            expected_html_path = os.path.join(PROCESSED_PREVIEW_DIR, expected_html_filename)
+        if viewer_returncode == 0:
             if os.path.exists(expected_html_path):
                 generated_html_path = expected_html_path
                 log_and_accumulate(f"HTML 预览文件找到: {os.path.basename(generated_html_path)}")
@@ -182,28 +193,19 @@ def process_pdf_openai_style(pdf_filepath):
                 logger.warning(f"[OpenAI:{task_id_for_logs}] Expected HTML file not found: {expected_html_path}")
         else:
             log_and_accumulate("警告 - 生成 HTML 预览失败。")
-            logger.warning(f"[OpenAI:{task_id_for_logs}] HTML preview generation failed. Code: {viewer_process.returncode}")
+            logger.warning(f"[OpenAI:{task_id_for_logs}] HTML preview generation failed. Code: {viewer_returncode}")
 
         # 6. Convert to DOCX
         log_and_accumulate("开始转换为 DOCX...")
         script_name = "jsonl_to_docx.py"
-        os.makedirs(OPENAI_DOCX_OUTPUT_DIR, exist_ok=True)
         try:
-            generated_files = run_conversion_script(script_name, persistent_jsonl_path, OPENAI_DOCX_OUTPUT_DIR)
+            generated_docx_path = run_conversion_script(script_name, persistent_jsonl_path, OPENAI_DOCX_OUTPUT_DIR)
             log_and_accumulate("DOCX 转换脚本执行完成。")
-            docx_filename = f"{os.path.splitext(os.path.basename(persistent_jsonl_path))[0]}.docx"
-            possible_docx_path = os.path.join(OPENAI_DOCX_OUTPUT_DIR, docx_filename)
-            if os.path.exists(possible_docx_path):
-                generated_docx_path = possible_docx_path
+            if generated_docx_path:
                 log_and_accumulate(f"DOCX 文件找到: {os.path.basename(generated_docx_path)}")
             else:
-                 docx_files_in_list = [f for f in generated_files if f.endswith('.docx')]
-                 if docx_files_in_list:
-                      generated_docx_path = docx_files_in_list[0]
-                      log_and_accumulate(f"DOCX 文件找到 (来自脚本): {os.path.basename(generated_docx_path)}")
-                 else:
-                    log_and_accumulate(f"警告 - 未找到生成的 DOCX 文件 ({docx_filename})。")
-                    logger.warning(f"[OpenAI:{task_id_for_logs}] Could not find generated DOCX file: {docx_filename} or in {generated_files}")
+                log_and_accumulate("警告 - 未生成 DOCX 文件 (JSONL 中没有文本或转换出错，请查看日志)。")
+                logger.warning(f"[OpenAI:{task_id_for_logs}] No DOCX generated for {persistent_jsonl_path}")
         except FileNotFoundError as script_e:
              log_and_accumulate(f"错误 - DOCX 转换脚本 ({script_name}) 未找到: {script_e}")
         except Exception as docx_e:
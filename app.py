@@ -1,17 +1,21 @@
 import gradio as gr
 import subprocess
 import os
+import re
 import tempfile
 import shutil
 import json
-import glob
 import time
 import logging
 import html # For escaping HTML content for srcdoc
-import zipfile # For creating zip archives
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from olmocr.app_utils import SCRATCH_BASE, link_or_copy, load_conversion_script, run_viewer, write_zip
 try:
     import pynvml
     pynvml.nvmlInit()
+    # Device handles never change while NVML is initialised; look them up once
+    NVML_HANDLES = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
     GPU_MONITORING_AVAILABLE = True
 except Exception as e:
     GPU_MONITORING_AVAILABLE = False
@@ -29,6 +33,15 @@ os.makedirs(PROCESSED_PDF_DIR, exist_ok=True)
 os.makedirs(PROCESSED_JSONL_DIR, exist_ok=True)
 os.makedirs(PROCESSED_PREVIEW_DIR, exist_ok=True)
 os.makedirs(EXPORT_TEMP_DIR_BASE, exist_ok=True) # Ensure export base exists
+OLMOCR_OUTPUT_TAIL_LINES = 1000 # Lines of pipeline output kept per file for the log box
+OLMOCR_LIVE_LOG_INTERVAL = 1.0 # seconds between live log updates while the pipeline runs
+RUN_DIR_PREFIX = "gradio_olmocr_run_" # Distinct from the Flask API's olmocr_run_*, which may share SCRATCH_BASE
+# Characters replaced with "_" in file names: anything but word characters (Unicode letters/digits, "_") and "-"
+UNSAFE_FILENAME_CHARS = re.compile(r"[^\w-]")
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts") # Conversion scripts, imported in-process
+# Worker processes per conversion: each one pays the converter's imports, and per-file
+# conversion is short, so returns flatten out after a few workers
+CONVERSION_WORKERS = min(os.cpu_count() or 1, 4)
 
 # --- Logging Setup ---
 # Basic logging setup for Gradio app itself
@@ -37,6 +50,19 @@ logging.basicConfig(level=logging.INFO, format=log_format)
 logger = logging.getLogger(__name__)
 # --------------------
 
+# --- Output Helper ---
+def decode_output(lines):
+    """Decodes captured output lines (bytes) for display; undecodable bytes are replaced."""
+    return b"".join(lines).decode("utf-8", "replace")
+
+# --- Viewer Helper ---
+def preview_filename(safe_base_name):
+    """
+    Name of the HTML preview of a processed PDF: its sanitized base name, like its JSONL and
+    exported files, so the name does not depend on where the workspace lives.
+    """
+    return safe_base_name + ".html"
+
 # <<< --- GPU Stats Function --- >>>
 def get_gpu_stats():
     """获取 GPU 使用率和显存信息"""
@@ -46,24 +72,27 @@ def get_gpu_stats():
         return gpu_error_message # Return the stored error message
 
     try:
-        # Assuming a single GPU system for simplicity (device index 0)
-        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-        # Utilization rates (GPU and Memory I/O)
-        util = pynvml.nvmlDeviceGetUtilizationRates(handle)
-        gpu_util = f"{util.gpu}%"
-        mem_util = f"{util.memory}%" # Memory Controller Util
-
-        # Memory info
-        mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-        mem_used_gb = f"{mem_info.used / (1024**3):.2f} GB"
-        mem_total_gb = f"{mem_info.total / (1024**3):.2f} GB"
-        mem_percent = f"{mem_info.used * 100 / mem_info.total:.1f}%"
-
-        stats_str = (
-            f"GPU 使用率: {gpu_util}\n"
-            f"显存使用率 (控制器): {mem_util}\n"
-            f"已用显存: {mem_used_gb} / {mem_total_gb} ({mem_percent})"
-        )
+        lines = []
+        for index, handle in enumerate(NVML_HANDLES):
+            # Utilization rates (GPU and Memory I/O)
+            util = pynvml.nvmlDeviceGetUtilizationRates(handle)
+            gpu_util = f"{util.gpu}%"
+            mem_util = f"{util.memory}%" # Memory Controller Util
+
+            # Memory info
+            mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
+            mem_used_gb = f"{mem_info.used / (1024**3):.2f} GB"
+            mem_total_gb = f"{mem_info.total / (1024**3):.2f} GB"
+            mem_percent = f"{mem_info.used * 100 / mem_info.total:.1f}%"
+
+            # Label each GPU only when there is more than one, so single-GPU output is unchanged
+            prefix = f"GPU {index} " if len(NVML_HANDLES) > 1 else "GPU "
+            lines.append(
+                f"{prefix}使用率: {gpu_util}\n"
+                f"显存使用率 (控制器): {mem_util}\n"
+                f"已用显存: {mem_used_gb} / {mem_total_gb} ({mem_percent})"
+            )
+        stats_str = "\n".join(lines) if lines else "未检测到 GPU。"
         print(f"DEBUG: get_gpu_stats() success. Returning:\n{stats_str}") # <<< 添加调试打印
         return stats_str
     except pynvml.NVMLError as error:
@@ -80,7 +109,10 @@ def get_gpu_stats():
 
 def run_olmocr_on_pdf(pdf_file_list, target_dim, anchor_len, error_rate, max_context, max_retries, workers):
     """
-    Runs OLMOCR sequentially on a list of uploaded PDF files, yielding status updates.
+    Runs OLMOCR on a list of uploaded PDF files, yielding status updates.
+
+    All PDFs go through a single pipeline run, so the SGLang server and model are started once per
+    batch rather than once per PDF; the output rows are then split per PDF by their Source-File.
     """
     if not pdf_file_list: # Check if list is empty or None
         yield "", "错误：请先上传至少一个 PDF 文件。", "", [], "### 无文件处理"
@@ -97,43 +129,43 @@ def run_olmocr_on_pdf(pdf_file_list, target_dim, anchor_len, error_rate, max_con
     total_files = len(pdf_file_list)
     processed_files_count = 0
     failed_files_count = 0
+    run_dir = None
 
-    for i, pdf_file_obj in enumerate(pdf_file_list):
-        run_dir = None
-        persistent_pdf_path = None
-        persistent_jsonl_path = None
-        current_file_name = os.path.basename(pdf_file_obj.name)
-        current_file_status_md = f"### 处理中 ({i+1}/{total_files}):\n{current_file_name}"
-        logs += f"\n===== 开始处理文件 {i+1}/{total_files}: {current_file_name} =====\n"
-
-        # Yield status update before starting the file processing
-        yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
+    try:
+        # 1. Create one temporary directory for the batch's OLMOCR output
+        run_dir = tempfile.mkdtemp(dir=SCRATCH_BASE, prefix=f"{RUN_DIR_PREFIX}batch_")
+        logs += f"创建临时 OLMOCR 工作区: {run_dir}\n"
+        logger.info(f"Created temporary run directory: {run_dir}")
+        olmocr_results_dir = os.path.join(run_dir, "results")
+
+        # 2. Save every input PDF persistently; these paths are what the pipeline records as Source-File
+        batch_files = [] # (index, uploaded file name, safe base name, persistent PDF path)
+        for i, pdf_file_obj in enumerate(pdf_file_list):
+            current_file_name = os.path.basename(pdf_file_obj.name)
+            try:
+                base_name, _ = os.path.splitext(current_file_name)
+                safe_base_name = UNSAFE_FILENAME_CHARS.sub('_', base_name)
+                persistent_pdf_path = os.path.join(PROCESSED_PDF_DIR, safe_base_name + ".pdf")
+                link_or_copy(pdf_file_obj.name, persistent_pdf_path) # Gradio's upload cache never rewrites its files in place
+                logs += f"已缓存上传的文件到: {persistent_pdf_path}\n"
+                logger.info(f"[{current_file_name}] Copied uploaded file to persistent storage: {persistent_pdf_path}")
+                batch_files.append((i, current_file_name, safe_base_name, persistent_pdf_path))
+            except Exception as e:
+                failed_files_count += 1
+                logs += f"\n**处理文件 {current_file_name} 时发生错误:** {e}\n"
+                logger.exception(f"Error caching file {current_file_name}")
+                current_file_status_md = f"### ✗ 失败 ({i+1}/{total_files}):\n{current_file_name} - 跳过"
+                yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
 
-        try:
-            # 1. Create unique temporary directory for this file's OLMOCR output
-            run_dir = tempfile.mkdtemp(dir=GRADIO_WORKSPACE_DIR, prefix=f"olmocr_run_{i}_")
-            logs += f"创建临时 OLMOCR 工作区: {run_dir}\n"
-            logger.info(f"[{current_file_name}] Created temporary run directory: {run_dir}")
-            # No yield here, part of setup
-
-            # 2. Prepare paths and save input PDF persistently
-            base_name, _ = os.path.splitext(current_file_name)
-            safe_base_name = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in base_name)
-            persistent_pdf_filename = safe_base_name + ".pdf"
-            persistent_pdf_path = os.path.join(PROCESSED_PDF_DIR, persistent_pdf_filename)
-
-            shutil.copy(pdf_file_obj.name, persistent_pdf_path)
-            logs += f"已缓存上传的文件到: {persistent_pdf_path}\n"
-            logger.info(f"[{current_file_name}] Copied uploaded file to persistent storage: {persistent_pdf_path}")
-            # No yield here
-
-            olmocr_results_dir = os.path.join(run_dir, "results")
-
-            # 3. Construct OLMOCR Command
+        rows_by_source = {} # Source-File -> [(raw JSONL line, parsed record), ...]
+        process_returncode = None
+        if batch_files:
+            # 3. Construct OLMOCR Command (dict.fromkeys: uploads with the same name share one persistent path)
+            batch_pdf_paths = list(dict.fromkeys(path for _, _, _, path in batch_files))
             cmd = [
                 "python", "-m", "olmocr.pipeline",
                 run_dir,
-                "--pdfs", persistent_pdf_path,
+                "--pdfs", *batch_pdf_paths,
                 "--target_longest_image_dim", str(target_dim),
                 "--target_anchor_text_len", str(anchor_len),
                 "--max_page_error_rate", str(error_rate),
@@ -141,193 +173,183 @@ def run_olmocr_on_pdf(pdf_file_list, target_dim, anchor_len, error_rate, max_con
                 "--max_page_retries", str(max_retries),
                 "--workers", str(workers)
             ]
+            current_file_status_md = f"### 处理中 (批量 {len(batch_pdf_paths)} 个文件)"
+            logs += f"\n===== 开始批量处理 {len(batch_pdf_paths)} 个文件 =====\n"
             logs += f"执行命令: {' '.join(cmd)}\n"
-            logger.info(f"[{current_file_name}] Executing command: {' '.join(cmd)}")
+            logger.info(f"Executing command: {' '.join(cmd)}")
             yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
 
             # 4. Run OLMOCR
             process_start_time = time.time()
-            process = subprocess.run(cmd, capture_output=True, text=True, check=False)
+            # Stream the output (stderr merged in) instead of buffering all of it: the UI gets the live tail
+            # at most every OLMOCR_LIVE_LOG_INTERVAL, and only the last OLMOCR_OUTPUT_TAIL_LINES are kept.
+            # Lines stay bytes; only the tail is decoded, when it is shown
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output_tail = collections.deque(maxlen=OLMOCR_OUTPUT_TAIL_LINES)
+            try:
+                last_live_update = time.monotonic()
+                for line in process.stdout:
+                    output_tail.append(line)
+                    if time.monotonic() - last_live_update >= OLMOCR_LIVE_LOG_INTERVAL:
+                        last_live_update = time.monotonic()
+                        live_logs = logs + f"--- OLMOCR 输出 (运行中) ---\n{decode_output(output_tail)}"
+                        yield all_extracted_text, live_logs, last_successful_html, list_processed_files(), current_file_status_md
+                process.wait()
+            finally:
+                if process.poll() is None: # The UI closed the generator mid-run; don't leave OLMOCR running
+                    process.kill()
+                    process.wait()
+            process_returncode = process.returncode
             process_duration = time.time() - process_start_time
-            logs += f"--- OLMOCR 日志 [{current_file_name}] 开始 ---\nSTDOUT:\n{process.stdout}\nSTDERR:\n{process.stderr}\n--- OLMOCR 日志结束 ---\n"
-            logs += f"OLMOCR 进程完成 [{current_file_name}]，耗时: {process_duration:.2f} 秒, 返回码: {process.returncode}\n"
-            logger.info(f"[{current_file_name}] OLMOCR process finished in {process_duration:.2f}s with code {process.returncode}")
+            logs += f"--- OLMOCR 日志开始 (最后 {len(output_tail)} 行) ---\n{decode_output(output_tail)}--- OLMOCR 日志结束 ---\n"
+            logs += f"OLMOCR 进程完成，耗时: {process_duration:.2f} 秒, 返回码: {process_returncode}\n"
+            logger.info(f"OLMOCR process finished in {process_duration:.2f}s with code {process_returncode}")
+            if process_returncode != 0:
+                # Keep going: whatever documents were finished before the failure are still routed below
+                logs += f"**错误**：OLMOCR failed (Code: {process_returncode})，仅处理已生成的结果。\n"
             # Yield after OLMOCR run completes
             yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
 
-            if process.returncode != 0:
-                raise RuntimeError(f"OLMOCR failed (Code: {process.returncode})")
-
-            # 5. Process Result File (JSONL)
-            jsonl_files_temp = glob.glob(os.path.join(olmocr_results_dir, "output_*.jsonl"))
-            if not jsonl_files_temp:
-                # This case means OLMOCR didn't even create an output file structure
-                logs += f"**错误**：在临时目录 {olmocr_results_dir} 中未找到 OLMOCR 输出 JSONL 文件。\n"
-                logger.error(f"[{current_file_name}] OLMOCR output JSONL file not found in {olmocr_results_dir}.")
-                raise FileNotFoundError(f"在临时目录 {olmocr_results_dir} 中未找到 OLMOCR 输出文件。") # Re-raise to trigger the main exception handler
-
-            temp_jsonl_path = jsonl_files_temp[0] # Assume only one
-
-            # <<< START: NEW CHECK - Verify if the found JSONL file is empty >>>
-            if os.path.getsize(temp_jsonl_path) == 0:
-                logs += f"**警告**：OLMOCR 为 {current_file_name} 生成了空的 JSONL 文件 ({os.path.basename(temp_jsonl_path)})。可能由于处理错误（请查看 OLMOCR 日志）。跳过此文件的文本提取和 HTML 预览。\n"
-                logger.warning(f"[{current_file_name}] OLMOCR generated an empty JSONL file: {temp_jsonl_path}. Skipping text/HTML steps.")
-                # Update status and continue to the next file in the main loop
-                processed_files_count += 1 # Count as processed but with warnings.
-                current_file_status_md = f"### ✓ 已完成 (有警告) ({i+1}/{total_files}):\n{current_file_name}"
-                # Yield status but don't update text/HTML outputs
-                yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
-                continue # Skip to the next file in the loop
-            # <<< END: NEW CHECK >>>
-
-            # --- If file exists and is not empty, proceed ---
-            persistent_jsonl_filename = f"{safe_base_name}_output.jsonl"
-            persistent_jsonl_path = os.path.join(PROCESSED_JSONL_DIR, persistent_jsonl_filename)
-            shutil.copy(temp_jsonl_path, persistent_jsonl_path)
-            logs += f"结果 JSONL 文件已保存到: {persistent_jsonl_path}\n"
-            logger.info(f"[{current_file_name}] Copied JSONL file to persistent storage: {persistent_jsonl_path}")
-
-            # Extract text
-            file_extracted_text = ""
-            try: # Add try-except around file reading
-                with open(persistent_jsonl_path, 'r', encoding='utf-8') as f:
+            # 5. Split the result files (one per work item, each holding several PDFs) by Source-File
+            try:
+                with os.scandir(olmocr_results_dir) as it:
+                    result_paths = [entry.path for entry in it if entry.name.startswith("output_") and entry.name.endswith(".jsonl")]
+            except FileNotFoundError:
+                result_paths = []
+            for result_path in result_paths:
+                with open(result_path, 'r', encoding='utf-8') as f:
                     for line in f:
-                        if line.strip():
-                            data = json.loads(line)
-                            page_text = data.get("text")
-                            if page_text is not None:
-                                 file_extracted_text += page_text + "\n\n"
+                        if not line.strip():
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError as e:
+                            logs += f"警告：无法解析 {os.path.basename(result_path)} 中的一行: {e}\n"
+                            continue
+                        source_file = record.get("metadata", {}).get("Source-File")
+                        rows_by_source.setdefault(source_file, []).append((line, record))
+
+        for i, current_file_name, safe_base_name, persistent_pdf_path in batch_files:
+            current_file_status_md = f"### 处理中 ({i+1}/{total_files}):\n{current_file_name}"
+            logs += f"\n===== 整理文件结果 {i+1}/{total_files}: {current_file_name} =====\n"
+
+            try:
+                rows = rows_by_source.get(persistent_pdf_path)
+                if not rows:
+                    if process_returncode != 0:
+                        raise RuntimeError(f"OLMOCR failed (Code: {process_returncode})")
+                    # The pipeline writes no row for a document without text (or an unreadable PDF)
+                    logs += f"**警告**：OLMOCR 没有为 {current_file_name} 生成任何结果。可能由于处理错误（请查看 OLMOCR 日志）。跳过此文件的文本提取和 HTML 预览。\n"
+                    logger.warning(f"[{current_file_name}] OLMOCR produced no output rows. Skipping text/HTML steps.")
+                    processed_files_count += 1 # Count as processed but with warnings.
+                    current_file_status_md = f"### ✓ 已完成 (有警告) ({i+1}/{total_files}):\n{current_file_name}"
+                    # Yield status but don't update text/HTML outputs
+                    yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
+                    continue # Skip to the next file in the loop
+
+                # 6. Save this PDF's rows as its own persistent JSONL
+                persistent_jsonl_filename = f"{safe_base_name}_output.jsonl"
+                persistent_jsonl_path = os.path.join(PROCESSED_JSONL_DIR, persistent_jsonl_filename)
+                with open(persistent_jsonl_path, 'w', encoding='utf-8') as f:
+                    f.writelines(line if line.endswith("\n") else line + "\n" for line, _ in rows)
+                logs += f"结果 JSONL 文件已保存到: {persistent_jsonl_path}\n"
+                logger.info(f"[{current_file_name}] Wrote JSONL file to persistent storage: {persistent_jsonl_path}")
+
+                # Extract text from the records already parsed above
+                file_extracted_text = "".join(record["text"] + "\n\n" for _, record in rows if record.get("text") is not None)
                 all_extracted_text += f"===== 文件: {current_file_name} =====\n\n" + file_extracted_text.strip() + "\n\n"
                 logs += f"成功提取 [{current_file_name}] 文本内容。\n"
-            except Exception as read_err:
-                 logs += f"**错误**：读取 JSONL 文件 {persistent_jsonl_path} 时出错: {read_err}\n"
-                 logger.error(f"[{current_file_name}] Error reading JSONL {persistent_jsonl_path}: {read_err}")
-                 # Decide how to handle this - maybe skip HTML too? For now, just log.
 
-            # Yield with updated combined text (even if HTML fails later)
-            yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
+                # Yield with updated combined text (even if HTML fails later)
+                yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
 
-            # 6. Generate HTML Preview
-            # <<< --- REMOVED: Wait loop for JSONL file --- >>>
-            # The check for empty file is done before copy now.
-
-            # Proceed with viewer command directly as the file should exist and be non-empty
-            viewer_cmd = [
-                "python", "-m", "olmocr.viewer.dolmaviewer",
-                persistent_jsonl_path,
-                "--output_dir", PROCESSED_PREVIEW_DIR
-             ]
-            logs += f"执行预览生成命令 [{current_file_name}] (目标目录: {PROCESSED_PREVIEW_DIR}): {' '.join(viewer_cmd)}\n"
-            viewer_process = subprocess.run(viewer_cmd, capture_output=True, text=True, check=False)
-            logs += f"--- Viewer STDOUT [{current_file_name}] ---\n{viewer_process.stdout}\n--- Viewer STDERR ---\n{viewer_process.stderr}\n"
-
-            if viewer_process.returncode == 0:
-                # <<< START: Construct expected HTML filename and wait >>>
-                html_found = False
-                final_html_path_persistent = None
-                try:
-                    # Construct the expected filename based on the PDF path
-                    # Assumes app runs from the parent dir of GRADIO_WORKSPACE_DIR
-                    path_for_html_name = persistent_pdf_path.replace(os.sep, '_').replace('.', '_')
-                    expected_html_filename = path_for_html_name + ".html"
-                    expected_html_path = os.path.join(PROCESSED_PREVIEW_DIR, expected_html_filename)
-                    logs += f"调试：预期的 HTML 文件名: {expected_html_filename}\n"
-                    logger.info(f"[{current_file_name}] Expected HTML filename: {expected_html_filename}")
-
-                    # Wait briefly for the specific file to appear
-                    max_wait_html = 5 # seconds
-                    wait_interval_html = 0.5
-                    start_wait_html = time.time()
-                    while time.time() - start_wait_html < max_wait_html:
+                # 7. Generate HTML Preview
+                expected_html_filename = preview_filename(safe_base_name)
+                logs += f"生成 HTML 预览 [{current_file_name}] (目标目录: {PROCESSED_PREVIEW_DIR}): {expected_html_filename}\n"
+                viewer_returncode, viewer_stdout, viewer_stderr = run_viewer(persistent_jsonl_path, PROCESSED_PREVIEW_DIR, expected_html_filename)
+                reset_preview_listing() # The preview may have replaced an existing file, which leaves the directory mtime as is
+                logs += f"--- Viewer STDOUT [{current_file_name}] ---\n{viewer_stdout}\n--- Viewer STDERR ---\n{viewer_stderr}\n"
+
+                if viewer_returncode == 0:
+                    # <<< START: Construct expected HTML filename and wait >>>
+                    html_found = False
+                    final_html_path_persistent = None
+                    try:
+                        # The viewer was told to write expected_html_filename
+                        expected_html_path = os.path.join(PROCESSED_PREVIEW_DIR, expected_html_filename)
+                        logs += f"调试：预期的 HTML 文件名: {expected_html_filename}\n"
+                        logger.info(f"[{current_file_name}] Expected HTML filename: {expected_html_filename}")
+
+                        # The viewer has exited, so the file is either complete or will never appear: check once, no waiting
                         if os.path.exists(expected_html_path):
                             logs += f"确认预期的 HTML 文件存在: {expected_html_path}\n"
                             logger.info(f"[{current_file_name}] Found expected HTML file: {expected_html_path}")
                             final_html_path_persistent = expected_html_path
                             html_found = True
-                            break
-                        time.sleep(wait_interval_html)
-
-                    if not html_found:
-                        logs += f"警告：等待预期的 HTML 文件 {expected_html_filename} 超时。\n"
-                        logger.warning(f"[{current_file_name}] Timeout waiting for expected HTML file: {expected_html_filename}")
-
-                except Exception as name_err:
-                    logs += f"警告：构造或检查预期 HTML 文件名时出错: {name_err}\n"
-                    logger.error(f"[{current_file_name}] Error constructing/checking expected HTML filename: {name_err}")
-                # <<< END: Construct expected HTML filename and wait >>>
-
-                # <<< START: Fallback to glob if specific file not found >>>
-                if not html_found:
-                    logs += f"尝试使用 glob 查找 *.html 作为后备方案...\n"
-                    logger.info(f"[{current_file_name}] Falling back to glob search for *.html")
-                    try:
-                        # Log directory contents before globbing
-                        dir_contents = os.listdir(PROCESSED_PREVIEW_DIR)
-                        logs += f"调试：后备查找前目录内容 ({PROCESSED_PREVIEW_DIR}): {dir_contents}\n"
-                        logger.info(f"[{current_file_name}] Contents before fallback glob {PROCESSED_PREVIEW_DIR}: {dir_contents}")
-
-                        viewer_html_files = glob.glob(os.path.join(PROCESSED_PREVIEW_DIR, "*.html"))
-                        logs += f"后备查找 *.html 找到: {len(viewer_html_files)} 个文件\n"
-                        if viewer_html_files:
-                            viewer_html_files.sort()
-                            final_html_path_persistent = viewer_html_files[0] # Pick first one
-                            html_found = True
-                            logs += f"后备查找选中 HTML 文件: {final_html_path_persistent}\n"
-                            logger.info(f"[{current_file_name}] Fallback glob found and selected: {final_html_path_persistent}")
-
-                    except Exception as glob_err:
-                        logs += f"警告：后备 glob 查找 HTML 文件时出错: {glob_err}\n"
-                        logger.error(f"[{current_file_name}] Error during fallback glob search: {glob_err}")
-                # <<< END: Fallback to glob >>>
-
-                # Now check if we found an HTML file either way
-                if html_found and final_html_path_persistent:
-                    # File should already be in the correct location
-                    # Sort to get a predictable file if multiple exist, e.g., alphabetically
-                    # viewer_html_files.sort()
-                    # final_html_path_persistent = viewer_html_files[0] # Pick the first one
-                    # logs += f"预览文件已在目标目录生成，选用: {final_html_path_persistent}\n"
-
-                    # Load content for immediate display
-                    try:
-                        with open(final_html_path_persistent, 'r', encoding='utf-8') as f: html_content = f.read()
-                        last_successful_html = f"<iframe srcdoc='{html.escape(html_content)}' width='100%' height='800px' style='border: 1px solid #ccc;'></iframe>"
-                        logs += f"[{current_file_name}] HTML 预览内容已加载。\n"
-                    except Exception as read_err:
-                        logs += f"错误：无法读取最终 HTML 文件 {final_html_path_persistent}: {read_err}\n"
-                        logger.error(f"[{current_file_name}] Failed to read final HTML file {final_html_path_persistent}: {read_err}")
-                        # Keep previous preview if read fails
+                        else:
+                            logs += f"警告：未找到预期的 HTML 文件 {expected_html_filename}。\n"
+                            logger.warning(f"[{current_file_name}] Expected HTML file not found: {expected_html_filename}")
+
+                    except Exception as name_err:
+                        logs += f"警告：构造或检查预期 HTML 文件名时出错: {name_err}\n"
+                        logger.error(f"[{current_file_name}] Error constructing/checking expected HTML filename: {name_err}")
+                    # <<< END: Construct expected HTML filename and wait >>>
+
+                    # No directory-wide fallback: the viewer writes exactly expected_html_filename, and any other
+                    # *.html in PROCESSED_PREVIEW_DIR belongs to a different PDF
+                    if html_found and final_html_path_persistent:
+                        # File should already be in the correct location
+                        # Sort to get a predictable file if multiple exist, e.g., alphabetically
+                        # viewer_html_files.sort()
+                        # final_html_path_persistent = viewer_html_files[0] # Pick the first one
+                        # logs += f"预览文件已在目标目录生成，选用: {final_html_path_persistent}\n"
+
+                        # Load content for immediate display
+                        try:
+                            with open(final_html_path_persistent, 'r', encoding='utf-8') as f: html_content = f.read()
+                            last_successful_html = f"<iframe srcdoc='{html.escape(html_content)}' width='100%' height='800px' style='border: 1px solid #ccc;'></iframe>"
+                            logs += f"[{current_file_name}] HTML 预览内容已加载。\n"
+                        except Exception as read_err:
+                            logs += f"错误：无法读取最终 HTML 文件 {final_html_path_persistent}: {read_err}\n"
+                            logger.error(f"[{current_file_name}] Failed to read final HTML file {final_html_path_persistent}: {read_err}")
+                            # Keep previous preview if read fails
+                    else:
+                        logs += f"警告：[{current_file_name}] 在目标目录 {PROCESSED_PREVIEW_DIR} 中最终未找到或选中任何 HTML 预览文件。\n"
+                        # Keep the previous last_successful_html
                 else:
-                    logs += f"警告：[{current_file_name}] 在目标目录 {PROCESSED_PREVIEW_DIR} 中最终未找到或选中任何 HTML 预览文件。\n"
-                    # Keep the previous last_successful_html
-            else:
-                logs += f"警告：[{current_file_name}] 生成 HTML 预览失败。返回码: {viewer_process.returncode}\n"
+                    logs += f"警告：[{current_file_name}] 生成 HTML 预览失败。返回码: {viewer_returncode}\n"
 
-            # Update status for successful file
-            processed_files_count += 1
-            current_file_status_md = f"### ✓ 已完成 ({i+1}/{total_files}):\n{current_file_name}"
-            # Yield final state for this successful file (including updated file list)
-            yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
+                # Update status for successful file
+                processed_files_count += 1
+                current_file_status_md = f"### ✓ 已完成 ({i+1}/{total_files}):\n{current_file_name}"
+                # Yield final state for this successful file (including updated file list)
+                yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
 
-        except Exception as e:
-            failed_files_count += 1
-            error_message = f"\n**处理文件 {current_file_name} 时发生错误:** {e}\n"
-            logs += error_message
-            logger.exception(f"Error processing file {current_file_name}")
-            current_file_status_md = f"### ✗ 失败 ({i+1}/{total_files}):\n{current_file_name} - 跳过"
-            # Yield error status, keep previous successful outputs
-            yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
-            continue # Move to the next file
-
-        finally:
-            # Cleanup the temporary run directory for this file
-            if run_dir and os.path.exists(run_dir):
-                try:
-                    shutil.rmtree(run_dir)
-                    logger.info(f"[{current_file_name}] Cleaned up temporary run directory: {run_dir}")
-                except OSError as e:
-                    logger.error(f"[{current_file_name}] Failed to remove temporary run directory {run_dir}: {e}")
-                    logs += f"警告：无法删除临时运行目录 {run_dir}: {e}\n"
+            except Exception as e:
+                failed_files_count += 1
+                error_message = f"\n**处理文件 {current_file_name} 时发生错误:** {e}\n"
+                logs += error_message
+                logger.exception(f"Error processing file {current_file_name}")
+                current_file_status_md = f"### ✗ 失败 ({i+1}/{total_files}):\n{current_file_name} - 跳过"
+                # Yield error status, keep previous successful outputs
+                yield all_extracted_text, logs, last_successful_html, list_processed_files(), current_file_status_md
+                continue # Move to the next file
+
+    except Exception as e:
+        # A batch-level failure (run directory, pipeline start, reading results): files not yet finished fail
+        failed_files_count = total_files - processed_files_count
+        logs += f"\n**批处理时发生错误:** {e}\n"
+        logger.exception("Error processing batch")
+
+    finally:
+        # Cleanup the temporary run directory for this batch
+        if run_dir and os.path.exists(run_dir):
+            try:
+                shutil.rmtree(run_dir)
+                logger.info(f"Cleaned up temporary run directory: {run_dir}")
+            except OSError as e:
+                logger.error(f"Failed to remove temporary run directory {run_dir}: {e}")
+                logs += f"警告：无法删除临时运行目录 {run_dir}: {e}\n"
 
     # Final status update after the loop finishes
     final_status_message = f"### **批处理完成**\n成功: {processed_files_count}, 失败: {failed_files_count} / 总计: {total_files}"
@@ -336,29 +358,45 @@ def run_olmocr_on_pdf(pdf_file_list, target_dim, anchor_len, error_rate, max_con
     yield all_extracted_text.strip(), logs, last_successful_html, list_processed_files(), final_status_message
 
 def clear_temp_workspace():
-    """Clears only the temporary run directories (olmocr_run_*) from the Gradio workspace."""
+    """Clears only the temporary run directories from SCRATCH_BASE (and older olmocr_run_* ones in the workspace)."""
     cleared_count = 0
     error_count = 0
     messages = []
-    logger.info(f"Attempting to clear temporary run directories in: {GRADIO_WORKSPACE_DIR}")
+    # (directory, prefix): current run directories, then ones created before they moved to SCRATCH_BASE
+    scan_dirs = [(SCRATCH_BASE, RUN_DIR_PREFIX), (GRADIO_WORKSPACE_DIR, "olmocr_run_")]
+    logger.info(f"Attempting to clear temporary run directories in: {[d for d, _ in scan_dirs]}")
     messages.append(f"开始清理临时运行目录...")
 
     try:
-        for item in os.listdir(GRADIO_WORKSPACE_DIR):
-            item_path = os.path.join(GRADIO_WORKSPACE_DIR, item)
-            if os.path.isdir(item_path) and item.startswith("olmocr_run_"): # Specific prefix
-                try:
-                    shutil.rmtree(item_path)
-                    messages.append(f"已删除: {item_path}")
-                    logger.info(f"Removed directory: {item_path}")
-                    cleared_count += 1
-                except OSError as e:
-                    messages.append(f"错误：无法删除 {item_path}: {e}")
-                    logger.error(f"Failed to remove directory {item_path}: {e}")
-                    error_count += 1
+        run_dirs = []
+        for scan_dir, prefix in scan_dirs:
+            # scandir: the entry type comes from readdir, so non-matching entries cost no stat
+            with os.scandir(scan_dir) as it:
+                run_dirs.extend(entry.path for entry in it
+                                if entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False))
+
+        def remove_dir(item_path):
+            try:
+                shutil.rmtree(item_path)
+                return None
+            except OSError as e:
+                return e
+
+        # Remove run directories in parallel; rmtree is dominated by per-file unlink syscalls (GIL released)
+        if run_dirs:
+            with ThreadPoolExecutor(max_workers=min(8, len(run_dirs))) as executor:
+                for item_path, err in zip(run_dirs, executor.map(remove_dir, run_dirs)):
+                    if err is None:
+                        messages.append(f"已删除: {item_path}")
+                        logger.info(f"Removed directory: {item_path}")
+                        cleared_count += 1
+                    else:
+                        messages.append(f"错误：无法删除 {item_path}: {err}")
+                        logger.error(f"Failed to remove directory {item_path}: {err}")
+                        error_count += 1
     except Exception as e:
         messages.append(f"清理临时目录时发生错误: {e}")
-        logger.exception(f"Error during temporary workspace cleanup of {GRADIO_WORKSPACE_DIR}")
+        logger.exception(f"Error during temporary workspace cleanup of {scan_dirs}")
         error_count += 1
 
     final_message = f"清理完成。删除 {cleared_count} 个临时运行目录。"
@@ -376,20 +414,26 @@ def clear_all_processed_data():
     logger.info(f"Attempting to clear processed data directories: {dirs_to_clear}")
     messages.append(f"开始清理已处理文件缓存...")
 
-    for dir_path in dirs_to_clear:
-        if os.path.exists(dir_path):
-            try:
-                shutil.rmtree(dir_path)
-                os.makedirs(dir_path, exist_ok=True) # Recreate after clearing
-                messages.append(f"已清空目录: {dir_path}")
-                logger.info(f"Successfully cleared and recreated directory: {dir_path}")
-            except OSError as e:
-                messages.append(f"错误：无法清空目录 {dir_path}: {e}")
-                logger.error(f"Failed to clear directory {dir_path}: {e}")
-                error_count += 1
-        else:
-            messages.append(f"目录不存在，无需清理: {dir_path}")
+    def clear_one(dir_path):
+        """Clears and recreates one directory; returns (ok, message)."""
+        if not os.path.exists(dir_path):
             logger.info(f"Directory does not exist, skipping cleanup: {dir_path}")
+            return True, f"目录不存在，无需清理: {dir_path}"
+        try:
+            shutil.rmtree(dir_path)
+            os.makedirs(dir_path, exist_ok=True) # Recreate after clearing
+            logger.info(f"Successfully cleared and recreated directory: {dir_path}")
+            return True, f"已清空目录: {dir_path}"
+        except OSError as e:
+            logger.error(f"Failed to clear directory {dir_path}: {e}")
+            return False, f"错误：无法清空目录 {dir_path}: {e}"
+
+    # The directories are independent, and rmtree spends its time in unlink syscalls (GIL released)
+    with ThreadPoolExecutor(max_workers=len(dirs_to_clear)) as executor:
+        for ok, message in executor.map(clear_one, dirs_to_clear):
+            messages.append(message)
+            if not ok:
+                error_count += 1
 
     final_message = "已处理文件缓存清理完成。"
     if error_count > 0:
@@ -398,48 +442,85 @@ def clear_all_processed_data():
     # Return message and empty list to clear the gr.Files component
     return "\n".join(messages), []
 
+# (directory st_mtime_ns, newest-first paths); list_processed_files runs on every UI update of a batch
+_preview_listing = (None, [])
+
+def reset_preview_listing():
+    """Forces the next list_processed_files() call to rescan the preview directory."""
+    global _preview_listing
+    _preview_listing = (None, [])
+
 def list_processed_files():
-    """Lists HTML files in the persistent preview directory."""
-    preview_files = []
+    """
+    Lists HTML files in the persistent preview directory.
+
+    The listing is kept in memory and only rebuilt when the directory's mtime changes (any
+    create/rename/delete inside it bumps it), so repeated calls cost one stat. Rewriting an
+    existing preview in place does not, so run_olmocr_on_pdf resets it after each preview.
+    """
+    global _preview_listing
+    try:
+        dir_mtime = os.stat(PROCESSED_PREVIEW_DIR).st_mtime_ns
+    except OSError:
+        return []
+    if _preview_listing[0] == dir_mtime:
+        return list(_preview_listing[1])
+
+    preview_files = [] # (mtime, path)
     if os.path.exists(PROCESSED_PREVIEW_DIR):
         try:
-            for filename in os.listdir(PROCESSED_PREVIEW_DIR):
-                if filename.lower().endswith(".html"):
-                    # Return only the filename for display, Gradio handles serving from the dir
-                    preview_files.append(os.path.join(PROCESSED_PREVIEW_DIR, filename))
+            with os.scandir(PROCESSED_PREVIEW_DIR) as it:
+                for entry in it:
+                    if entry.name.lower().endswith(".html"):
+                        try:
+                            mtime = entry.stat().st_mtime
+                        except OSError:
+                            continue # Removed while listing
+                        # Return only the filename for display, Gradio handles serving from the dir
+                        preview_files.append((mtime, entry.path))
         except Exception as e:
             logger.error(f"Error listing preview files in {PROCESSED_PREVIEW_DIR}: {e}")
-    # Sort files, maybe by modification time (newest first) or alphabetically
-    try:
-        preview_files.sort(key=os.path.getmtime, reverse=True)
-    except OSError:
-        preview_files.sort() # Fallback to alphabetical sort
-    return preview_files
+    # Newest first, using the mtimes gathered above instead of a getmtime per file during the sort
+    preview_files.sort(reverse=True)
+    paths = [path for _, path in preview_files]
+    _preview_listing = (dir_mtime, paths)
+    return list(paths)
 
 # --- Helper function for zipping ---
-def create_zip_from_dir(dir_path, zip_path):
-    """Creates a zip archive from a directory."""
+def create_zip(entries, zip_path):
+    """
+    Creates a zip archive from (arcname, source) pairs, where source is a file path or the entry's bytes.
+    In-memory entries are written as they are, so nothing has to be staged on disk first.
+
+    Entries are read and deflated in parallel by olmocr.app_utils and written in completion order,
+    so one large preview does not hold up the small ones behind it.
+    """
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(dir_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Arcname is the path inside the zip file
-                    arcname = os.path.relpath(file_path, start=dir_path)
-                    zipf.write(file_path, arcname=arcname)
+        write_zip(((source, arcname) for arcname, source in entries), zip_path)
         logger.info(f"Successfully created zip file: {zip_path}")
         return True
     except Exception as e:
-        logger.error(f"Error creating zip file {zip_path} from {dir_path}: {e}")
+        logger.error(f"Error creating zip file {zip_path}: {e}")
         return False
 
+def create_zip_from_dir(dir_path, zip_path):
+    """Creates a zip archive from a directory."""
+    # Arcname is the path inside the zip file
+    return create_zip(((os.path.relpath(os.path.join(root, file), start=dir_path), os.path.join(root, file))
+                       for root, _, files in os.walk(dir_path) for file in files), zip_path)
+
 # --- Export Functions ---
+def _is_empty_dir(path):
+    """True if path has no entries; stops after the first one instead of listing the whole directory."""
+    with os.scandir(path) as it:
+        return next(it, None) is None
+
 def export_html_archive():
     """Zips all HTML files from the processed preview directory."""
     status = ""
     zip_file_path = None
     try:
-        if not os.listdir(PROCESSED_PREVIEW_DIR):
+        if _is_empty_dir(PROCESSED_PREVIEW_DIR):
              status = "没有 HTML 预览文件可打包。"
              logger.warning(status)
              return status, None
@@ -460,21 +541,18 @@ def export_html_archive():
         logger.exception("Error during HTML export.")
         return status, None
 
-def run_conversion_script(script_name, input_dir, output_dir):
-    """Helper to run a conversion script."""
-    script_path = os.path.join("scripts", script_name) # Assumes scripts are in a 'scripts' subdir
-    if not os.path.exists(script_path):
-        raise FileNotFoundError(f"转换脚本未找到: {script_path}")
-
-    cmd = ["python", script_path, input_dir, output_dir]
-    logger.info(f"运行转换脚本: {' '.join(cmd)}")
-    process = subprocess.run(cmd, capture_output=True, text=True, check=False)
-    logger.info(f"脚本 {script_name} STDOUT:\n{process.stdout}")
-    logger.error(f"脚本 {script_name} STDERR:\n{process.stderr}")
-    if process.returncode != 0:
-        raise RuntimeError(f"脚本 {script_name} 执行失败 (Code: {process.returncode}): {process.stderr}")
-    logger.info(f"脚本 {script_name} 执行成功。")
+def run_conversion_script(script_name, input_dir):
+    """Converts every JSONL file in input_dir in memory; returns [(output_filename, data), ...]."""
+    conversion_module = load_conversion_script(SCRIPTS_DIR, script_name)
 
+    # Run the script in-process instead of starting a new interpreter per export
+    logger.info(f"运行转换脚本: {script_name} {input_dir}")
+    try:
+        generated = conversion_module.convert_to_memory(input_dir, workers=CONVERSION_WORKERS)
+    except Exception as e:
+        raise RuntimeError(f"脚本 {script_name} 执行失败: {e}") from e
+    logger.info(f"脚本 {script_name} 执行成功。")
+    return generated
 
 def export_combined_archive(export_format):
     """
@@ -488,63 +566,44 @@ def export_combined_archive(export_format):
     """
     status = f"开始导出 {export_format.upper()} (包含 HTML)..."
     logger.info(status)
-    export_temp_dir = None
     zip_file_path = None
 
     if export_format not in ['md', 'docx']:
         return "无效的导出格式。", None
 
-    if not os.listdir(PROCESSED_JSONL_DIR):
+    if _is_empty_dir(PROCESSED_JSONL_DIR):
         status = "没有 JSONL 文件可供转换。"
         logger.warning(status)
         return status, None
 
     try:
-        # Create a unique temporary directory for this export
-        export_temp_dir = tempfile.mkdtemp(dir=EXPORT_TEMP_DIR_BASE, prefix=f"{export_format}_export_")
-        status += f"\n创建临时导出目录: {export_temp_dir}"
-        logger.info(f"Created temporary export directory: {export_temp_dir}")
-
-        # Run the appropriate conversion script
+        # Run the appropriate conversion script; its output stays in memory and goes straight into the zip
         script_name = "local_jsonl_to_md.py" if export_format == 'md' else "jsonl_to_docx.py"
         status += f"\n运行 {script_name}..."
-        run_conversion_script(script_name, PROCESSED_JSONL_DIR, export_temp_dir)
+        generated_files = [(name, data) for name, data in run_conversion_script(script_name, PROCESSED_JSONL_DIR)
+                           if name.endswith(f".{export_format}")]
         status += f"\n{export_format.upper()} 文件已生成。"
 
-        # Copy corresponding HTML files
-        copied_html_count = 0
-        status += f"\n复制 HTML 预览文件..."
-        logger.info("Copying HTML files...")
-        generated_files = glob.glob(os.path.join(export_temp_dir, f"*.{export_format}"))
-        for gen_file_path in generated_files:
-            base_name = os.path.splitext(os.path.basename(gen_file_path))[0]
-            # <<< START: Construct expected HTML filename based on presumed PDF path >>>
-            # Assume the original PDF had the same base_name and was in PROCESSED_PDF_DIR
-            presumed_pdf_path = os.path.join(PROCESSED_PDF_DIR, base_name + ".pdf")
-            # Construct the HTML filename using the dolmaviewer convention
-            expected_html_filename = presumed_pdf_path.replace(os.sep, '_').replace('.', '_') + ".html"
-            logger.info(f"Trying to find HTML file: {expected_html_filename} for {gen_file_path}")
-            # <<< END: Construct expected HTML filename >>>
-
-            # Use the constructed expected filename
-            html_file_name = expected_html_filename # Assign to the variable used later
+        # Collect corresponding HTML files; they are zipped straight from the preview directory, not copied
+        html_files = []
+        status += f"\n查找 HTML 预览文件..."
+        logger.info("Collecting HTML files...")
+        # Set membership against the preview listing, which list_processed_files() caches until the
+        # directory changes, instead of a stat (or a fresh listing) per generated file
+        available_html = {os.path.basename(path) for path in list_processed_files()}
+        for gen_file_name, _ in generated_files:
+            # The conversion scripts name their output after the same sanitized PDF base name as the preview
+            html_file_name = preview_filename(os.path.splitext(gen_file_name)[0])
             html_src_path = os.path.join(PROCESSED_PREVIEW_DIR, html_file_name)
 
-            if os.path.exists(html_src_path):
-                html_dest_path = os.path.join(export_temp_dir, html_file_name) # Use correct name for destination too
-                try:
-                    shutil.copy(html_src_path, html_dest_path)
-                    copied_html_count += 1
-                    logger.info(f"Copied HTML: {html_file_name}")
-                except Exception as copy_e:
-                    logger.warning(f"无法复制 HTML 文件 {html_src_path}: {copy_e}")
-                    status += f"\n警告：无法复制 {html_file_name}"
+            if html_file_name in available_html:
+                html_files.append((html_file_name, html_src_path))
             else:
                  logger.warning(f"未找到对应的 HTML 文件: {html_file_name} at path {html_src_path}")
                  status += f"\n警告：未找到 {html_file_name}"
 
-        status += f"\n已复制 {copied_html_count} 个 HTML 文件。"
-        logger.info(f"Copied {copied_html_count} HTML files.")
+        status += f"\n已找到 {len(html_files)} 个 HTML 文件。"
+        logger.info(f"Found {len(html_files)} HTML files.")
 
         # Create the zip archive
         timestamp = time.strftime("%Y%m%d_%H%M%S")
@@ -553,7 +612,7 @@ def export_combined_archive(export_format):
         zip_file_path = os.path.join(EXPORT_TEMP_DIR_BASE, zip_filename)
         status += f"\n创建 Zip 文件: {zip_filename}..."
 
-        if create_zip_from_dir(export_temp_dir, zip_file_path):
+        if create_zip(generated_files + html_files, zip_file_path):
             status += f"\n导出成功完成。"
             return status, zip_file_path
         else:
@@ -564,14 +623,6 @@ def export_combined_archive(export_format):
         status += f"\n导出过程中发生错误: {e}"
         logger.exception(f"Error during {export_format} export.")
         return status, None
-    finally:
-        # Clean up the temporary export directory
-        if export_temp_dir and os.path.exists(export_temp_dir):
-            try:
-                shutil.rmtree(export_temp_dir)
-                logger.info(f"Cleaned up temporary export directory: {export_temp_dir}")
-            except OSError as e:
-                logger.error(f"Failed to remove temporary export directory {export_temp_dir}: {e}")
 
 
 # --- Gradio Interface ---
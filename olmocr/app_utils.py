@@ -0,0 +1,427 @@
+"""
+Helpers shared by the web front ends (app.py, Flask/api_utils.py and OPENAPI/openai_processor.py).
+
+Only the standard library is needed here (libdeflate is used when installed), so the front ends
+can import this module without pulling in the pipeline's dependencies.
+"""
+
+import collections
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+try:
+    import deflate  # libdeflate bindings; roughly 2x zlib's DEFLATE throughput at the same level
+
+    LIBDEFLATE_AVAILABLE = True
+except ImportError:
+    LIBDEFLATE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+# --- Scratch Space ---
+# Per-task/per-request OLMOCR run directories. Prefer RAM-backed tmpfs so intermediate pipeline files
+# never hit the disk; OLMOCR_TMPDIR overrides it (e.g. when /dev/shm is small)
+SCRATCH_BASE = os.environ.get("OLMOCR_TMPDIR") or ("/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir())
+
+
+# --- File Copies ---
+COPY_CHUNK_SIZE = 1 << 30  # Per kernel copy call; the loop handles larger files
+COPY_BUFFER_SIZE = 256 * 1024  # Userspace fallback only
+
+
+def fast_copy(src, dst):
+    """
+    Copies src to dst in the kernel where possible: os.copy_file_range (a reflink on btrfs/xfs),
+    then os.sendfile, then a readinto loop over one reused buffer. Each step continues from the
+    file offsets the previous one reached. Mode bits are copied, like shutil.copy.
+    """
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        kernel_copies = []
+        if hasattr(os, "copy_file_range"):
+            kernel_copies.append(lambda: os.copy_file_range(src_fd, dst_fd, COPY_CHUNK_SIZE))
+        if hasattr(os, "sendfile"):
+            kernel_copies.append(lambda: os.sendfile(dst_fd, src_fd, None, COPY_CHUNK_SIZE))
+        for kernel_copy in kernel_copies:
+            try:
+                while kernel_copy() > 0:
+                    pass
+                break
+            except OSError:
+                continue  # Cross-device, unsupported filesystem or old kernel; try the next method
+        else:
+            buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+            while True:
+                read = fsrc.readinto(buffer)
+                if not read:
+                    break
+                # Unbuffered writes may be partial, so write until the whole read is out
+                pending = buffer[:read]
+                while pending:
+                    pending = pending[fdst.write(pending) :]
+    shutil.copymode(src, dst)
+
+
+def link_or_copy(src, dst):
+    """
+    Places src at dst without moving data when possible: a hardlink on the same filesystem,
+    otherwise fast_copy. An existing dst is replaced, matching shutil.copy.
+    """
+    try:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+        return
+    except OSError:
+        pass  # Cross-device, or the filesystem has no hardlinks; copy instead
+    fast_copy(src, dst)
+
+
+# --- HTML Previews ---
+VIEWER_TEMPLATE = "dolmaviewer_template.html"  # dolmaviewer's default, relative to its module
+
+
+def run_viewer(jsonl_path, output_dir, output_filename):
+    """
+    Renders jsonl_path to output_dir/output_filename with olmocr.viewer.dolmaviewer in this process
+    instead of a new interpreter per PDF. Returns (returncode, stdout, stderr) like subprocess.run.
+
+    The viewer's messages are collected through its log argument; redirecting sys.stdout would
+    swap it for every thread of the process, so concurrent previews would capture each other's output.
+    """
+    from olmocr.viewer import dolmaviewer  # boto3, jinja2, ...: only the first preview pays for the import
+
+    messages = []
+    try:
+        rendered = dolmaviewer.main([jsonl_path], output_dir, VIEWER_TEMPLATE, None, output_filename=output_filename, log=messages.append)
+    except Exception as e:
+        return 1, "\n".join(messages), f"Viewer failed: {e}"
+    return 0 if rendered else 1, "\n".join(messages), ""
+
+
+# --- Conversion Scripts ---
+# Worker start method when the caller passes no mp_context. Callers are typically threaded servers,
+# where a forked worker can inherit a lock (e.g. logging's) held by another thread and hang forever;
+# forkserver and spawn start from a single-threaded process instead
+CONVERSION_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def load_conversion_script(scripts_dir, script_name):
+    """
+    Imports scripts_dir/script_name as a top-level module (cached in sys.modules after the first call).
+    scripts_dir goes on sys.path so the script can be imported by name in worker processes too.
+    Raises FileNotFoundError if there is no such script.
+    """
+    if scripts_dir not in sys.path:
+        sys.path.append(scripts_dir)
+    module_name = os.path.splitext(script_name)[0]
+    try:
+        return importlib.import_module(module_name)
+    except ModuleNotFoundError as e:
+        if e.name != module_name:
+            raise  # A dependency of the script is missing, not the script itself
+        raise FileNotFoundError(f"转换脚本未找到: {os.path.join(scripts_dir, script_name)}") from e
+
+
+def _render_jsonl_file(script_path, jsonl_path):
+    """
+    Worker side of render_jsonl_files: runs the script's render_one, which returns
+    (output_filename, data) or None. The script is loaded here rather than pickled by reference:
+    a forkserver started before scripts_dir went on sys.path would not find it by name.
+    """
+    return load_conversion_script(*os.path.split(script_path)).render_one(jsonl_path)
+
+
+def _convert_jsonl_file(script_path, jsonl_path, output_dir):
+    """Worker side of convert_jsonl_files: renders one file and writes the result into output_dir."""
+    rendered = _render_jsonl_file(script_path, jsonl_path)
+    if rendered is None:
+        return
+    output_filename, data = rendered
+    output_path = os.path.join(output_dir, output_filename)
+    try:
+        with open(output_path, "wb") as f_out:
+            f_out.write(data)
+        logger.info(f"Successfully wrote {output_path}")
+    except OSError as e:
+        logger.error(f"Failed to write {output_path}: {e}")
+
+
+def _map_jsonl_files(func, script_path, jsonl_dir, *args, workers=None, mp_context=None):
+    """
+    Runs func(script_path, jsonl_path, *args) for every JSONL file in jsonl_dir and returns the results
+    in file order. Files are independent, so with more than one they run on up to workers processes
+    (cpu_count if None), started with mp_context (CONVERSION_START_METHOD if None).
+    """
+    # Find all JSONL files in the input directory; dotfiles are skipped, as glob did
+    try:
+        with os.scandir(jsonl_dir) as it:
+            jsonl_files = [entry.path for entry in it if entry.name.endswith(".jsonl") and not entry.name.startswith(".") and entry.is_file()]
+    except FileNotFoundError:
+        jsonl_files = []
+    logger.info(f"Found {len(jsonl_files)} JSONL files in {jsonl_dir}")
+
+    if not jsonl_files:
+        print("No JSONL files found in the specified directory.")
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, len(jsonl_files))
+    if workers > 1:
+        mp_context = mp_context or multiprocessing.get_context(CONVERSION_START_METHOD)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            return list(executor.map(func, itertools.repeat(script_path), jsonl_files, *(itertools.repeat(arg) for arg in args)))
+    return [func(script_path, jsonl_path, *args) for jsonl_path in jsonl_files]
+
+
+def convert_jsonl_files(script_path, jsonl_dir, output_dir, workers=None, mp_context=None):
+    """
+    Renders every JSONL file in jsonl_dir with the render_one of the conversion script at
+    script_path and writes the results into output_dir (see _map_jsonl_files for the pool).
+    """
+    # Ensure local output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+    logger.info(f"Output directory set to: {output_dir}")
+
+    _map_jsonl_files(_convert_jsonl_file, script_path, jsonl_dir, output_dir, workers=workers, mp_context=mp_context)
+    logger.info("Done processing all JSONL files.")
+
+
+def render_jsonl_files(script_path, jsonl_dir, workers=None, mp_context=None):
+    """Like convert_jsonl_files, but returns [(output_filename, data), ...] instead of writing anything to disk."""
+    rendered = _map_jsonl_files(_render_jsonl_file, script_path, jsonl_dir, workers=workers, mp_context=mp_context)
+    logger.info("Done processing all JSONL files.")
+    return [result for result in rendered if result is not None]
+
+
+# --- Zip Archives ---
+ZIP_COMPRESS_WORKERS = os.cpu_count() or 1
+# Fastest level: previews are mostly base64 page images, where higher levels cost noticeably more
+# CPU for a few percent of size. Valid for both zlib (1-9) and libdeflate (1-12)
+ZIP_COMPRESS_LEVEL = 1
+# Stored rather than deflated: formats that are already compressed, and files too small to gain anything
+ZIP_STORE_EXTENSIONS = frozenset((".docx", ".zip", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".pdf"))
+ZIP_STORE_MAX_SIZE = 256  # bytes
+ZLIB_MIN_LOOKAHEAD = 262  # zlib keeps this much of its window free, so matches reach back window - 262 bytes
+
+# Record layouts from the zip specification (APPNOTE.TXT), all little-endian
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF  # Sizes and offsets from here on only fit in the zip64 records
+ZIP64_COUNT_LIMIT = 0xFFFF  # Likewise for the number of entries
+ZIP64_MARKER = 0xFFFFFFFF  # Stands in for a 32-bit field whose value is in the zip64 records
+ZIP64_COUNT_MARKER = 0xFFFF
+ZIP_VERSION_MADE_BY = (3 << 8) | 45  # Unix, so external_attr carries the file mode
+ZIP_UTF8_FLAG = 0x800
+
+# An entry ready to be written: payload is the deflated data, or the data itself when stored
+ZipEntry = collections.namedtuple("ZipEntry", ["arcname", "mtime", "mode", "size", "crc", "payload", "deflated"])
+
+
+def _zlib_window_bits(size):
+    """
+    Smallest raw-DEFLATE window that still covers a size-byte input. Matches can never reach
+    further back than the input itself, so the output is unchanged, but zlib allocates its
+    window buffers for the given size instead of the full 32 KiB for every small file.
+    """
+    return -min(max((size + ZLIB_MIN_LOOKAHEAD).bit_length(), 9), zlib.MAX_WBITS)
+
+
+def deflate_data(data, name):
+    """
+    Raw-DEFLATEs data (as stored in zip entries) using libdeflate when installed and zlib
+    otherwise; both release the GIL while compressing. Returns None for entries that should be stored.
+    """
+    size = len(data)
+    if size <= ZIP_STORE_MAX_SIZE or os.path.splitext(name)[1].lower() in ZIP_STORE_EXTENSIONS:
+        return None
+    if LIBDEFLATE_AVAILABLE:
+        return deflate.deflate_compress(data, ZIP_COMPRESS_LEVEL)
+    compressor = zlib.compressobj(ZIP_COMPRESS_LEVEL, zlib.DEFLATED, _zlib_window_bits(size))
+    return compressor.compress(data) + compressor.flush()
+
+
+def load_zip_entry(source, arcname):
+    """
+    Reads (if source is a path) and deflates one zip entry; source is a file path or the entry's bytes.
+    In-memory entries are timestamped now, like ZipFile.writestr.
+
+    Files are read, not mapped: previews are rewritten in place by the viewer, and truncating a
+    mapped file under a reader raises SIGBUS instead of an exception.
+    """
+    if isinstance(source, bytes):
+        mtime, mode, data = time.time(), 0o100644, source
+    else:
+        with open(source, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        mtime, mode = st.st_mtime, st.st_mode
+    deflated = deflate_data(data, arcname)
+    return ZipEntry(arcname, mtime, mode, len(data), zlib.crc32(data), data if deflated is None else deflated, deflated is not None)
+
+
+def iter_zip_entries(sources, workers=ZIP_COMPRESS_WORKERS):
+    """
+    Loads (source, arcname) pairs with load_zip_entry on a thread pool and yields the ZipEntry
+    of each in completion order, so a large file does not hold up the small ones behind it
+    (the central directory records each entry's offset, so the archive order does not matter).
+    At most 2 * workers entries are in memory at once.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        for source, arcname in sources:
+            in_flight.add(executor.submit(load_zip_entry, source, arcname))
+            if len(in_flight) >= 2 * workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(in_flight):
+            yield future.result()
+
+
+def _dos_date_time(mtime):
+    """DOS date and time fields of a timestamp, clamped to the range zip can represent."""
+    year, month, day, hour, minute, second = time.localtime(mtime)[:6]
+    if year < 1980:
+        return (1 << 5) | 1, 0
+    if year > 2107:
+        return (127 << 9) | (12 << 5) | 31, (23 << 11) | (59 << 5) | 29
+    return ((year - 1980) << 9) | (month << 5) | day, (hour << 11) | (minute << 5) | (second // 2)
+
+
+def _zip32(value):
+    """value for a 32-bit size or offset field, or the marker saying it is in the zip64 records."""
+    return ZIP64_MARKER if value >= ZIP64_LIMIT else value
+
+
+class ZipWriter:
+    """
+    Lays out a zip archive front to back from entries whose CRC and (compressed) data are
+    already known, so every header is final when it is written: nothing is seeked back to,
+    and no data descriptors are needed. add() and finish() return the bytes to write.
+
+    Zip64 records are added only where a size, offset or the entry count needs them.
+    """
+
+    def __init__(self):
+        self._offset = 0
+        self._central_directory = []
+        self._count = 0
+
+    def add(self, entry):
+        """Returns the chunks (local header, then payload) that store entry at the current offset."""
+        name = entry.arcname.encode("utf-8")
+        flags = 0 if entry.arcname.isascii() else ZIP_UTF8_FLAG
+        method = zlib.DEFLATED if entry.deflated else 0
+        date, time_ = _dos_date_time(entry.mtime)
+        payload_size = len(entry.payload)
+
+        sizes_zip64 = entry.size >= ZIP64_LIMIT or payload_size >= ZIP64_LIMIT
+        local_extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, entry.size, payload_size) if sizes_zip64 else b""
+        version = 45 if sizes_zip64 else 20
+        header = ZIP_LOCAL_HEADER.pack(
+            0x04034B50,
+            version,
+            flags,
+            method,
+            time_,
+            date,
+            entry.crc,
+            ZIP64_MARKER if sizes_zip64 else payload_size,
+            ZIP64_MARKER if sizes_zip64 else entry.size,
+            len(name),
+            len(local_extra),
+        )
+
+        # The central directory's zip64 field holds only the values that overflow, in this order
+        zip64_values = [value for value in (entry.size, payload_size, self._offset) if value >= ZIP64_LIMIT]
+        central_extra = struct.pack(f"<HH{len(zip64_values)}Q", ZIP64_EXTRA_ID, 8 * len(zip64_values), *zip64_values) if zip64_values else b""
+        self._central_directory.append(
+            ZIP_CENTRAL_HEADER.pack(
+                0x02014B50,
+                ZIP_VERSION_MADE_BY,
+                45 if zip64_values else 20,
+                flags,
+                method,
+                time_,
+                date,
+                entry.crc,
+                _zip32(payload_size),
+                _zip32(entry.size),
+                len(name),
+                len(central_extra),
+                0,
+                0,
+                0,
+                (entry.mode & 0xFFFF) << 16,
+                _zip32(self._offset),
+            )
+            + name
+            + central_extra
+        )
+        self._count += 1
+
+        header += name + local_extra
+        self._offset += len(header) + payload_size
+        return [header, entry.payload]
+
+    def finish(self):
+        """Returns the central directory and end records; call once, after the last add()."""
+        directory = b"".join(self._central_directory)
+        directory_offset = self._offset
+        trailer = [directory]
+        if self._count >= ZIP64_COUNT_LIMIT or len(directory) >= ZIP64_LIMIT or directory_offset >= ZIP64_LIMIT:
+            zip64_end_offset = directory_offset + len(directory)
+            trailer.append(
+                ZIP64_END_RECORD.pack(
+                    0x06064B50, ZIP64_END_RECORD.size - 12, ZIP_VERSION_MADE_BY, 45, 0, 0, self._count, self._count, len(directory), directory_offset
+                )
+            )
+            trailer.append(ZIP64_END_LOCATOR.pack(0x07064B50, 0, zip64_end_offset, 1))
+        trailer.append(
+            ZIP_END_RECORD.pack(
+                0x06054B50,
+                0,
+                0,
+                ZIP64_COUNT_MARKER if self._count >= ZIP64_COUNT_LIMIT else self._count,
+                ZIP64_COUNT_MARKER if self._count >= ZIP64_COUNT_LIMIT else self._count,
+                _zip32(len(directory)),
+                _zip32(directory_offset),
+                0,
+            )
+        )
+        return b"".join(trailer)
+
+
+def write_zip(sources, zip_path):
+    """Zips (source, arcname) pairs into zip_path (see load_zip_entry for what a source can be)."""
+    writer = ZipWriter()
+    with open(zip_path, "wb") as f:
+        for entry in iter_zip_entries(sources):
+            f.writelines(writer.add(entry))
+        f.write(writer.finish())
+
+
+def iter_zip(sources):
+    """
+    Generates a zip of (source, arcname) pairs chunk by chunk as entries finish, so a response
+    can start sending before the archive is complete and nothing is written to disk.
+    """
+    writer = ZipWriter()
+    for entry in iter_zip_entries(sources):
+        yield from writer.add(entry)
+    yield writer.finish()
@@ -5,6 +5,7 @@ import json
 import os
 import tempfile
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cache
 
 import boto3
 import markdown2
@@ -17,7 +18,7 @@ from olmocr.data.renderpdf import render_pdf_to_base64webp
 from olmocr.s3_utils import get_s3_bytes, parse_s3_path
 
 
-def read_jsonl(paths):
+def read_jsonl(paths, log=print):
     """
     Generator that yields lines from multiple JSONL files.
     Supports both local and S3 paths.
@@ -28,21 +29,35 @@ def read_jsonl(paths):
                 for line in f:
                     yield line.strip()
         except Exception as e:
-            print(f"Error reading {path}: {e}")
+            log(f"Error reading {path}: {e}")
 
 
-def generate_presigned_url(s3_client, bucket_name, key_name):
+def generate_presigned_url(s3_client, bucket_name, key_name, log=print):
     try:
         response = s3_client.generate_presigned_url(
             "get_object", Params={"Bucket": bucket_name, "Key": key_name}, ExpiresIn=3600 * 24 * 7 - 100  # Link expires in 1 week
         )
         return response
     except (NoCredentialsError, PartialCredentialsError) as e:
-        print(f"Error generating presigned URL: {e}")
+        log(f"Error generating presigned URL: {e}")
         return None
 
 
-def process_document(data, s3_client, template, output_dir):
+@cache
+def load_template(template_path):
+    """Loads and compiles the Jinja template once per process; later calls of main() reuse it."""
+    with open(os.path.join(os.path.dirname(__file__), template_path), "r", encoding="utf-8") as template_file:
+        return Template(template_file.read())
+
+
+@cache
+def get_s3_client(s3_profile_name):
+    """Creates the S3 client once per profile and process (boto3 clients are thread-safe)."""
+    workspace_session = boto3.Session(profile_name=s3_profile_name)
+    return workspace_session.client("s3")
+
+
+def process_document(data, s3_client, template, output_dir, output_filename=None, log=print):
     id_ = data.get("id")
     text = data.get("text", "")
     attributes = data.get("attributes", {})
@@ -55,7 +70,7 @@ def process_document(data, s3_client, template, output_dir):
     try:
         pdf_bytes = get_s3_bytes(s3_client, source_file)
         if pdf_bytes is None:
-            print(f"Failed to retrieve PDF from {source_file}")
+            log(f"Failed to retrieve PDF from {source_file}")
             return
         local_pdf.write(pdf_bytes)
         local_pdf.flush()
@@ -74,7 +89,7 @@ def process_document(data, s3_client, template, output_dir):
             pages.append({"page_num": page_num, "text": page_text, "image": base64_image})
 
     except Exception as e:
-        print(f"Error processing document ID {id_}: {e}")
+        log(f"Error processing document ID {id_}: {e}")
         return
     finally:
         local_pdf.close()
@@ -84,27 +99,37 @@ def process_document(data, s3_client, template, output_dir):
     s3_link = None
     if source_file and source_file.startswith("s3://"):
         bucket_name, key_name = parse_s3_path(source_file)
-        s3_link = generate_presigned_url(s3_client, bucket_name, key_name)
+        s3_link = generate_presigned_url(s3_client, bucket_name, key_name, log)
 
     # Render the HTML using the Jinja template
     try:
         html_content = template.render(id=id_, pages=pages, s3_link=s3_link)
     except Exception as e:
-        print(f"Error rendering HTML for document ID {id_}: {e}")
+        log(f"Error rendering HTML for document ID {id_}: {e}")
         return
 
     # Write the HTML content to a file
     try:
-        safe_source = source_file.replace("s3://", "").replace("/", "_").replace(".", "_") if source_file else f"id_{id_}"
-        filename = f"{safe_source}.html"
+        if output_filename:
+            filename = output_filename
+        else:
+            safe_source = source_file.replace("s3://", "").replace("/", "_").replace(".", "_") if source_file else f"id_{id_}"
+            filename = f"{safe_source}.html"
         filepath = os.path.join(output_dir, filename)
         with open(filepath, "w", encoding="utf-8") as f:
             f.write(html_content)
     except Exception as e:
-        print(f"Error writing HTML file for document ID {id_}: {e}")
+        log(f"Error writing HTML file for document ID {id_}: {e}")
 
 
-def main(jsonl_paths, output_dir, template_path, s3_profile_name):
+def main(jsonl_paths, output_dir, template_path, s3_profile_name, output_filename=None, log=print):
+    """
+    Renders every document in jsonl_paths to an HTML page in output_dir.
+
+    Messages go to log (one string per call) instead of stdout when a caller wants to collect them,
+    e.g. a server rendering several previews at once. Returns False if nothing was rendered because
+    of an error before the documents were processed, True otherwise.
+    """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -116,48 +141,47 @@ def main(jsonl_paths, output_dir, template_path, s3_profile_name):
         else:
             matched = glob.glob(path)
             if not matched:
-                print(f"No files matched the pattern: {path}")
+                log(f"No files matched the pattern: {path}")
             expanded_paths.extend(matched)
 
     if not expanded_paths:
-        print("No JSONL files to process.")
-        return
+        log("No JSONL files to process.")
+        return False
 
     # Load the Jinja template
     try:
-        with open(os.path.join(os.path.dirname(__file__), template_path), "r", encoding="utf-8") as template_file:
-            template_content = template_file.read()
-            template = Template(template_content)
+        template = load_template(template_path)
     except Exception as e:
-        print(f"Error loading template: {e}")
-        return
+        log(f"Error loading template: {e}")
+        return False
 
     # Initialize S3 client for generating presigned URLs
     try:
-        workspace_session = boto3.Session(profile_name=s3_profile_name)
-        s3_client = workspace_session.client("s3")
+        s3_client = get_s3_client(s3_profile_name)
     except Exception as e:
-        print(f"Error initializing S3 client: {e}")
-        return
+        log(f"Error initializing S3 client: {e}")
+        return False
 
     # Create ThreadPoolExecutor
     with ThreadPoolExecutor() as executor:
         futures = []
-        for line in read_jsonl(expanded_paths):
+        for line in read_jsonl(expanded_paths, log):
             if not line:
                 continue
             try:
                 data = json.loads(line)
             except json.JSONDecodeError as e:
-                print(f"Invalid JSON line: {e}")
+                log(f"Invalid JSON line: {e}")
                 continue
-            future = executor.submit(process_document, data, s3_client, template, output_dir)
+            future = executor.submit(process_document, data, s3_client, template, output_dir, output_filename, log)
             futures.append(future)
 
-        for _ in tqdm(as_completed(futures), total=len(futures), desc="Processing documents"):
+        # The progress bar is for the command line; callers collecting the messages get none
+        for _ in tqdm(as_completed(futures), total=len(futures), desc="Processing documents", disable=log is not print):
             pass  # Progress bar updates automatically
 
-    print(f"Output HTML-viewable pages to directory: {args.output_dir}")
+    log(f"Output HTML-viewable pages to directory: {output_dir}")
+    return True
 
 
 if __name__ == "__main__":
@@ -166,6 +190,11 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", default="dolma_previews", help="Directory to save HTML files")
     parser.add_argument("--template_path", default="dolmaviewer_template.html", help="Path to the Jinja2 template file")
     parser.add_argument("--s3_profile", default=None, help="S3 profile to use for accessing the source documents to render them in the viewer.")
+    parser.add_argument(
+        "--output_filename",
+        default=None,
+        help="Write the HTML page to this file name in output_dir instead of one derived from the source file (for single-document input).",
+    )
     args = parser.parse_args()
 
-    main(args.jsonl_paths, args.output_dir, args.template_path, args.s3_profile)
+    main(args.jsonl_paths, args.output_dir, args.template_path, args.s3_profile, args.output_filename)
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import argparse
+import io
 import json
 import os
-import glob
 import logging
 import re
+import multiprocessing
+from olmocr.app_utils import convert_jsonl_files, render_jsonl_files
 from docx import Document
 from docx.shared import Pt
 
@@ -25,6 +27,9 @@ def parse_args():
     )
     return parser.parse_args()
 
+# Characters replaced with "_" in file names: anything but word characters (Unicode letters/digits, "_") and "-"
+UNSAFE_FILENAME_CHARS = re.compile(r"[^\w-]")
+
 def sanitize_for_xml(text):
     """
     Removes characters that are invalid in XML 1.0, except for tab, newline, and carriage return.
@@ -40,74 +45,70 @@ def sanitize_for_xml(text):
     invalid_xml_chars_re = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\x84\x86-\x9F]')
     return invalid_xml_chars_re.sub('', text)
 
-def main():
-    args = parse_args()
-
-    # Ensure local output directory exists
-    os.makedirs(args.output_dir, exist_ok=True)
-    logger.info(f"Output directory set to: {args.output_dir}")
-
-    # Find all JSONL files in the input directory
-    jsonl_files = glob.glob(os.path.join(args.jsonl_dir, "*.jsonl"))
-    logger.info(f"Found {len(jsonl_files)} JSONL files in {args.jsonl_dir}")
-
-    if not jsonl_files:
-        print("No JSONL files found in the specified directory.")
-        return
-
-    for jsonl_path in jsonl_files:
-        logger.info(f"Processing JSONL file: {jsonl_path}")
-        source_file_base = os.path.splitext(os.path.basename(jsonl_path))[0].replace('_output', '') # Default base name
-
-        try:
-            document = Document()
-            # Optional: Set default font (if needed)
-            # style = document.styles['Normal']
-            # font = style.font
-            # font.name = 'Arial' # Or another preferred font
-            # font.size = Pt(11)
-
-            with open(jsonl_path, 'r', encoding='utf-8') as f_in:
-                for i, line in enumerate(f_in):
-                    if not line.strip():
-                        continue
-                    try:
-                        record = json.loads(line)
-                        text_content = record.get("text", "")
-                        metadata = record.get("metadata", {})
-                        # Use source file from metadata if available for better naming
-                        source_file_meta = metadata.get("Source-File")
-                        if source_file_meta:
-                             source_file_base = os.path.splitext(os.path.basename(source_file_meta))[0]
-                             source_file_base = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in source_file_base) # Sanitize
-
-                        if text_content:
-                            # Add paragraph for each non-empty page text
-                            sanitized_content = sanitize_for_xml(text_content)
-                            document.add_paragraph(sanitized_content)
-                            # Add a page break after each page's content? Optional.
-                            # document.add_page_break()
-
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to decode JSON line {i+1} in {jsonl_path}")
-                        continue
-
-            if len(document.paragraphs) > 0: # Only save if content was added
-                output_filename = f"{source_file_base}.docx"
-                output_path = os.path.join(args.output_dir, output_filename)
+def render_one(jsonl_path):
+    """Converts a single JSONL file in memory. Returns (output_filename, data), or None if there is no text."""
+    logger.info(f"Processing JSONL file: {jsonl_path}")
+    source_file_base = os.path.splitext(os.path.basename(jsonl_path))[0].replace('_output', '') # Default base name
+
+    try:
+        document = Document()
+        # Optional: Set default font (if needed)
+        # style = document.styles['Normal']
+        # font = style.font
+        # font.name = 'Arial' # Or another preferred font
+        # font.size = Pt(11)
+
+        with open(jsonl_path, 'r', encoding='utf-8') as f_in:
+            for i, line in enumerate(f_in):
+                if not line.strip():
+                    continue
                 try:
-                    document.save(output_path)
-                    logger.info(f"Successfully wrote DOCX to {output_path}")
-                except Exception as e:
-                    logger.error(f"Failed to save DOCX file {output_path}: {e}")
-            else:
-                 logger.info(f"No text content found in {jsonl_path}, skipping DOCX creation.")
-
+                    record = json.loads(line)
+                    text_content = record.get("text", "")
+                    metadata = record.get("metadata", {})
+                    # Use source file from metadata if available for better naming
+                    source_file_meta = metadata.get("Source-File")
+                    if source_file_meta:
+                         source_file_base = os.path.splitext(os.path.basename(source_file_meta))[0]
+                         source_file_base = UNSAFE_FILENAME_CHARS.sub('_', source_file_base) # Sanitize
+
+                    if text_content:
+                        # Add paragraph for each non-empty page text
+                        sanitized_content = sanitize_for_xml(text_content)
+                        document.add_paragraph(sanitized_content)
+                        # Add a page break after each page's content? Optional.
+                        # document.add_page_break()
+
+                except json.JSONDecodeError:
+                    logger.warning(f"Failed to decode JSON line {i+1} in {jsonl_path}")
+                    continue
+
+        if len(document.paragraphs) > 0: # Only save if content was added
+            buffer = io.BytesIO()
+            document.save(buffer)
+            return f"{source_file_base}.docx", buffer.getvalue()
+        else:
+             logger.info(f"No text content found in {jsonl_path}, skipping DOCX creation.")
+
+    except Exception as e:
+        logger.error(f"Failed to process file {jsonl_path}: {e}")
+    return None
+
+def convert(jsonl_dir, output_dir, workers=None, mp_context=None):
+    """
+    Converts every JSONL file in jsonl_dir to a .docx file in output_dir. Importable, so callers can skip the CLI.
+    Files are converted on a process pool (see olmocr.app_utils.convert_jsonl_files).
+    """
+    convert_jsonl_files(os.path.abspath(__file__), jsonl_dir, output_dir, workers=workers, mp_context=mp_context)
 
-        except Exception as e:
-            logger.error(f"Failed to process file {jsonl_path}: {e}")
+def convert_to_memory(jsonl_dir, workers=None, mp_context=None):
+    """Like convert, but returns [(output_filename, data), ...] instead of writing anything to disk."""
+    return render_jsonl_files(os.path.abspath(__file__), jsonl_dir, workers=workers, mp_context=mp_context)
 
-    logger.info("Done processing all JSONL files.")
+def main():
+    args = parse_args()
+    # Single-threaded here, so the platform default (fork on Linux) is safe and starts fastest
+    convert(args.jsonl_dir, args.output_dir, mp_context=multiprocessing.get_context())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
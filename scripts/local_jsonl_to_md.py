@@ -2,9 +2,10 @@
 import argparse
 import json
 import os
-import glob
 import logging
 import re
+import multiprocessing
+from olmocr.app_utils import convert_jsonl_files, render_jsonl_files
 
 # Basic logging setup
 log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -23,6 +24,9 @@ def parse_args():
     )
     return parser.parse_args()
 
+# Characters replaced with "_" in file names: anything but word characters (Unicode letters/digits, "_") and "-"
+UNSAFE_FILENAME_CHARS = re.compile(r"[^\w-]")
+
 def sanitize_for_xml(text):
     """
     Removes characters that are invalid in XML 1.0, except for tab, newline, and carriage return.
@@ -42,66 +46,59 @@ def sanitize_for_xml(text):
     invalid_xml_chars_re = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\x84\x86-\x9F]')
     return invalid_xml_chars_re.sub('', text)
 
-def main():
-    args = parse_args()
+def render_one(jsonl_path):
+    """Converts a single JSONL file in memory. Returns (output_filename, data), or None if there is no text."""
+    logger.info(f"Processing JSONL file: {jsonl_path}")
+    output_md_content = ""
+    source_file_base = os.path.splitext(os.path.basename(jsonl_path))[0].replace('_output', '') # Try to get original base name
+
+    try:
+        with open(jsonl_path, 'r', encoding='utf-8') as f_in:
+            for i, line in enumerate(f_in):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    text_content = record.get("text", "")
+                    metadata = record.get("metadata", {})
+                    # Use source file from metadata if available for better naming
+                    source_file_meta = metadata.get("Source-File")
+                    if source_file_meta:
+                         source_file_base = os.path.splitext(os.path.basename(source_file_meta))[0]
+                         source_file_base = UNSAFE_FILENAME_CHARS.sub('_', source_file_base) # Sanitize
 
-    # Ensure local output directory exists
-    os.makedirs(args.output_dir, exist_ok=True)
-    logger.info(f"Output directory set to: {args.output_dir}")
-
-    # Find all JSONL files in the input directory
-    jsonl_files = glob.glob(os.path.join(args.jsonl_dir, "*.jsonl"))
-    logger.info(f"Found {len(jsonl_files)} JSONL files in {args.jsonl_dir}")
-
-    if not jsonl_files:
-        print("No JSONL files found in the specified directory.")
-        return
-
-    for jsonl_path in jsonl_files:
-        logger.info(f"Processing JSONL file: {jsonl_path}")
-        output_md_content = ""
-        source_file_base = os.path.splitext(os.path.basename(jsonl_path))[0].replace('_output', '') # Try to get original base name
-
-        try:
-            with open(jsonl_path, 'r', encoding='utf-8') as f_in:
-                for i, line in enumerate(f_in):
-                    if not line.strip():
-                        continue
-                    try:
-                        record = json.loads(line)
-                        text_content = record.get("text", "")
-                        metadata = record.get("metadata", {})
-                        # Use source file from metadata if available for better naming
-                        source_file_meta = metadata.get("Source-File")
-                        if source_file_meta:
-                             source_file_base = os.path.splitext(os.path.basename(source_file_meta))[0]
-                             source_file_base = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in source_file_base) # Sanitize
-
-                        sanitized_text = sanitize_for_xml(text_content)
-
-                        # Append page break or separator? Maybe just double newline.
-                        output_md_content += sanitized_text + "\n\n"
-
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to decode JSON line {i+1} in {jsonl_path}")
-                        continue
-
-            if output_md_content.strip():
-                # Use the derived base name for the output markdown file
-                output_filename = f"{source_file_base}.md"
-                output_path = os.path.join(args.output_dir, output_filename)
+                    sanitized_text = sanitize_for_xml(text_content)
 
-                try:
-                    with open(output_path, "w", encoding="utf-8") as f_out:
-                        f_out.write(output_md_content.strip())
-                    logger.info(f"Successfully wrote Markdown to {output_path}")
-                except IOError as e:
-                     logger.error(f"Failed to write Markdown file {output_path}: {e}")
+                    # Append page break or separator? Maybe just double newline.
+                    output_md_content += sanitized_text + "\n\n"
+
+                except json.JSONDecodeError:
+                    logger.warning(f"Failed to decode JSON line {i+1} in {jsonl_path}")
+                    continue
+
+        if output_md_content.strip():
+            # Use the derived base name for the output markdown file
+            return f"{source_file_base}.md", output_md_content.strip().encode("utf-8")
 
-        except Exception as e:
-            logger.error(f"Failed to process file {jsonl_path}: {e}")
+    except Exception as e:
+        logger.error(f"Failed to process file {jsonl_path}: {e}")
+    return None
 
-    logger.info("Done processing all JSONL files.")
+def convert(jsonl_dir, output_dir, workers=None, mp_context=None):
+    """
+    Converts every JSONL file in jsonl_dir to a .md file in output_dir. Importable, so callers can skip the CLI.
+    Files are converted on a process pool (see olmocr.app_utils.convert_jsonl_files).
+    """
+    convert_jsonl_files(os.path.abspath(__file__), jsonl_dir, output_dir, workers=workers, mp_context=mp_context)
+
+def convert_to_memory(jsonl_dir, workers=None, mp_context=None):
+    """Like convert, but returns [(output_filename, data), ...] instead of writing anything to disk."""
+    return render_jsonl_files(os.path.abspath(__file__), jsonl_dir, workers=workers, mp_context=mp_context)
+
+def main():
+    args = parse_args()
+    # Single-threaded here, so the platform default (fork on Linux) is safe and starts fastest
+    convert(args.jsonl_dir, args.output_dir, mp_context=multiprocessing.get_context())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
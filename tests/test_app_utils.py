@@ -0,0 +1,267 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from unittest import mock
+
+from olmocr import app_utils
+
+
+class TestFileCopies(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.data = os.urandom(3 * app_utils.COPY_BUFFER_SIZE + 123)
+        self.src = os.path.join(self.tmp.name, "src.pdf")
+        with open(self.src, "wb") as f:
+            f.write(self.data)
+        os.chmod(self.src, 0o640)
+        self.dst = os.path.join(self.tmp.name, "dst.pdf")
+
+    def assert_copied(self):
+        with open(self.dst, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.stat(self.dst).st_mode & 0o777, 0o640)
+
+    def test_fast_copy(self):
+        app_utils.fast_copy(self.src, self.dst)
+        self.assert_copied()
+
+    def test_fast_copy_userspace_fallback(self):
+        def unsupported(*args):
+            raise OSError("unsupported")
+
+        with mock.patch.object(os, "copy_file_range", unsupported, create=True), mock.patch.object(os, "sendfile", unsupported, create=True):
+            app_utils.fast_copy(self.src, self.dst)
+        self.assert_copied()
+
+    def test_link_or_copy_replaces_existing_file(self):
+        with open(self.dst, "wb") as f:
+            f.write(b"stale")
+        app_utils.link_or_copy(self.src, self.dst)
+        self.assert_copied()
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+
+    def test_link_or_copy_copies_when_linking_fails(self):
+        with mock.patch.object(os, "link", side_effect=OSError("cross-device")):
+            app_utils.link_or_copy(self.src, self.dst)
+        self.assert_copied()
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+
+
+class TestLoadConversionScript(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for patcher in (mock.patch.object(sys, "path", list(sys.path)), mock.patch.dict(sys.modules)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_script(self, name, source):
+        with open(os.path.join(self.tmp.name, name), "w") as f:
+            f.write(source)
+
+    def test_loads_script_as_module(self):
+        self.write_script("olmocr_test_converter.py", "def convert(jsonl_dir, output_dir):\n    return [jsonl_dir, output_dir]\n")
+        module = app_utils.load_conversion_script(self.tmp.name, "olmocr_test_converter.py")
+        self.assertEqual(module.convert("in", "out"), ["in", "out"])
+        self.assertIn(self.tmp.name, sys.path)
+        self.assertIs(app_utils.load_conversion_script(self.tmp.name, "olmocr_test_converter.py"), module)
+
+    def test_missing_script(self):
+        with self.assertRaises(FileNotFoundError):
+            app_utils.load_conversion_script(self.tmp.name, "olmocr_test_missing.py")
+
+    def test_missing_dependency_is_not_reported_as_missing_script(self):
+        self.write_script("olmocr_test_needs_dep.py", "import olmocr_test_no_such_dependency\n")
+        with self.assertRaises(ModuleNotFoundError) as cm:
+            app_utils.load_conversion_script(self.tmp.name, "olmocr_test_needs_dep.py")
+        self.assertEqual(cm.exception.name, "olmocr_test_no_such_dependency")
+
+
+class TestRunViewer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write_jsonl(self, name, doc_id):
+        path = os.path.join(self.tmp.name, name)
+        row = {"id": doc_id, "text": "text", "attributes": {"pdf_page_numbers": [[0, 4, 1]]}, "metadata": {"Source-File": os.path.join(self.tmp.name, f"{doc_id}.pdf")}}
+        with open(path, "w") as f:
+            f.write(json.dumps(row) + "\n")
+        return path
+
+    def test_missing_input_fails(self):
+        returncode, stdout, _ = app_utils.run_viewer(os.path.join(self.tmp.name, "missing.jsonl"), self.tmp.name, "missing.html")
+        self.assertEqual(returncode, 1)
+        self.assertIn("No JSONL files to process.", stdout)
+
+    def test_concurrent_previews_keep_their_own_output(self):
+        paths = {f"doc{i}": self.write_jsonl(f"doc{i}.jsonl", f"doc{i}") for i in range(8)}
+        results = {}
+        stdout_before = sys.stdout
+
+        def render(doc_id):
+            results[doc_id] = app_utils.run_viewer(paths[doc_id], self.tmp.name, f"{doc_id}.html")
+
+        threads = [threading.Thread(target=render, args=(doc_id,)) for doc_id in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIs(sys.stdout, stdout_before)
+        for doc_id, (returncode, stdout, stderr) in results.items():
+            self.assertEqual(returncode, 0)
+            self.assertEqual(stderr, "")
+            # The PDF does not exist, so the viewer reports this document (and only this one)
+            self.assertIn(f"Error processing document ID {doc_id}:", stdout)
+            self.assertEqual(stdout.count("Error processing document ID"), 1)
+
+
+CONVERSION_SCRIPT = """
+import os
+
+def render_one(jsonl_path):
+    with open(jsonl_path) as f:
+        text = f.read()
+    return (os.path.basename(jsonl_path) + ".txt", text.upper().encode()) if "skip" not in text else None
+"""
+
+
+class TestConvertJsonlFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.scripts_dir = os.path.join(self.tmp.name, "scripts")
+        self.jsonl_dir = os.path.join(self.tmp.name, "jsonl")
+        self.output_dir = os.path.join(self.tmp.name, "out")
+        for path in (self.scripts_dir, self.jsonl_dir, self.output_dir):
+            os.makedirs(path)
+        self.script_path = os.path.join(self.scripts_dir, "fake_conversion.py")
+        with open(self.script_path, "w") as f:
+            f.write(CONVERSION_SCRIPT)
+        for name in ("a", "b", "c", "skip"):
+            with open(os.path.join(self.jsonl_dir, f"{name}.jsonl"), "w") as f:
+                f.write(f'{{"text": "{name}"}}')
+        for name in ("notes.txt", ".hidden.jsonl"):
+            with open(os.path.join(self.jsonl_dir, name), "w") as f:
+                f.write("not a conversion input")
+        for patcher in (mock.patch.object(sys, "path", list(sys.path)), mock.patch.dict(sys.modules)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assert_converted(self):
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["a.jsonl.txt", "b.jsonl.txt", "c.jsonl.txt"])
+        with open(os.path.join(self.output_dir, "b.jsonl.txt")) as f:
+            self.assertEqual(f.read(), '{"TEXT": "B"}')
+
+    def test_serial(self):
+        app_utils.convert_jsonl_files(self.script_path, self.jsonl_dir, self.output_dir, workers=1)
+        self.assert_converted()
+
+    def test_process_pool_imports_the_script_in_the_workers(self):
+        # The default (forkserver/spawn) workers only see the script if they import it themselves
+        app_utils.convert_jsonl_files(self.script_path, self.jsonl_dir, self.output_dir, workers=2)
+        self.assert_converted()
+
+    def test_render_in_memory(self):
+        rendered = app_utils.render_jsonl_files(self.script_path, self.jsonl_dir, workers=2)
+        self.assertEqual(sorted(rendered), [("a.jsonl.txt", b'{"TEXT": "A"}'), ("b.jsonl.txt", b'{"TEXT": "B"}'), ("c.jsonl.txt", b'{"TEXT": "C"}')])
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_no_jsonl_files(self):
+        self.assertEqual(app_utils.render_jsonl_files(self.script_path, self.output_dir, workers=2), [])
+
+    def test_missing_directory(self):
+        self.assertEqual(app_utils.render_jsonl_files(self.script_path, os.path.join(self.tmp.name, "missing")), [])
+
+
+class TestZipWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_file(self, name, data, mode=0o644):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        os.chmod(path, mode)
+        return path
+
+    def sample_sources(self):
+        return [
+            (self.make_file("page.html", b"<html>" + b"text " * 20000 + b"</html>"), "page.html"),
+            (self.make_file("tiny.txt", b"small"), "nested/tiny.txt"),
+            (self.make_file("run.sh", b"#!/bin/sh\n" * 100, mode=0o755), "run.sh"),
+            (os.urandom(5000), "already.docx"),
+            ("文档 ".encode() * 1000, "文档.md"),
+            (b"", "empty.md"),
+        ]
+
+    def expected_contents(self, sources):
+        contents = {}
+        for source, arcname in sources:
+            if isinstance(source, bytes):
+                contents[arcname] = source
+            else:
+                with open(source, "rb") as f:
+                    contents[arcname] = f.read()
+        return contents
+
+    def assert_round_trip_contents(self, zipf, sources):
+        self.assertIsNone(zipf.testzip())
+        contents = {info.filename: zipf.read(info) for info in zipf.infolist()}
+        self.assertEqual(contents, self.expected_contents(sources))
+
+    def assert_round_trip(self, zip_file, sources):
+        with zipfile.ZipFile(zip_file) as zipf:
+            self.assert_round_trip_contents(zipf, sources)
+            infos = {info.filename: info for info in zipf.infolist()}
+        self.assertEqual(infos["page.html"].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertLess(infos["page.html"].compress_size, infos["page.html"].file_size)
+        self.assertEqual(infos["already.docx"].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(infos["nested/tiny.txt"].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual((infos["run.sh"].external_attr >> 16) & 0o777, 0o755)
+
+    def write_zip(self, sources):
+        zip_path = os.path.join(self.tmp.name, "out.zip")
+        app_utils.write_zip(sources, zip_path)
+        return zip_path
+
+    def test_write_zip_round_trip(self):
+        sources = self.sample_sources()
+        self.assert_round_trip(self.write_zip(sources), sources)
+
+    def test_iter_zip_matches_write_zip(self):
+        sources = self.sample_sources()
+        streamed = b"".join(app_utils.iter_zip(sources))
+        self.assert_round_trip(io.BytesIO(streamed), sources)
+
+    def test_zip64_records(self):
+        sources = self.sample_sources()
+        # Every size, offset and count counts as overflowing, so each zip64 record is written
+        with mock.patch.object(app_utils, "ZIP64_LIMIT", 0), mock.patch.object(app_utils, "ZIP64_COUNT_LIMIT", 0):
+            zip_path = self.write_zip(sources)
+        self.assert_round_trip(zip_path, sources)
+
+    def test_empty_archive(self):
+        with zipfile.ZipFile(self.write_zip([])) as zipf:
+            self.assertEqual(zipf.infolist(), [])
+
+    def test_many_entries_use_a_bounded_pool(self):
+        sources = [(self.make_file(f"{i}.txt", f"entry {i}\n".encode() * 100), f"{i}.txt") for i in range(50)]
+        with zipfile.ZipFile(self.write_zip(sources)) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), sorted(arcname for _, arcname in sources))
+            self.assert_round_trip_contents(zipf, sources)
+
+    def test_old_timestamps_are_clamped(self):
+        path = self.make_file("old.txt", b"old" * 200)
+        os.utime(path, (0, 0))
+        with zipfile.ZipFile(self.write_zip([(path, "old.txt")])) as zipf:
+            self.assertEqual(zipf.getinfo("old.txt").date_time, (1980, 1, 1, 0, 0, 0))
+            self.assertEqual(zipf.read("old.txt"), b"old" * 200)
@@ -0,0 +1,463 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Flask"))
+
+import api_utils  # noqa: E402
+
+
+class RecordingCallback:
+    """update_callback that records every (task_id, updates) write and can wait for them."""
+
+    def __init__(self, fail_first=False):
+        self.calls = []
+        self.fail_first = fail_first
+        self.condition = threading.Condition()
+
+    def __call__(self, task_id, updates):
+        with self.condition:
+            self.calls.append((task_id, updates))
+            self.condition.notify_all()
+            if self.fail_first and len(self.calls) == 1:
+                raise RuntimeError("database is locked")
+
+    def wait_for(self, count, timeout=5):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.calls) >= count, timeout)
+
+
+class TestUpdateCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = api_utils._UpdateCoalescer()
+
+    def test_no_thread_until_used(self):
+        self.assertIsNone(self.coalescer._thread)
+        self.coalescer.flush()
+        self.assertTrue(self.coalescer._thread.is_alive())
+
+    def test_updates_of_a_task_are_merged(self):
+        callback = RecordingCallback()
+        with mock.patch.object(api_utils, "UPDATE_FLUSH_INTERVAL", 60):
+            self.coalescer.submit("t1", {"status": "processing", "append_log": (0, "first")}, callback)
+            self.coalescer.submit("t1", {"status": "processing", "process_pid": 42}, callback)
+            self.coalescer.submit("t1", {"status": "warning", "append_log": (1, "second")}, callback)
+            self.coalescer.flush()
+
+        self.assertEqual(len(callback.calls), 1)
+        task_id, updates = callback.calls[0]
+        self.assertEqual(task_id, "t1")
+        self.assertEqual(updates["status"], "warning")  # Last writer wins
+        self.assertEqual(updates["process_pid"], 42)
+        self.assertEqual(len(updates["append_log"]), 2)
+        self.assertTrue(updates["append_log"][0].endswith(" - first"))
+        self.assertTrue(updates["append_log"][1].endswith(" - second"))
+        self.assertTrue(updates["append_log"][0].startswith(time.strftime(api_utils.LOG_TIME_FORMAT, time.localtime(0))))
+
+    def test_tasks_are_written_separately(self):
+        callback = RecordingCallback()
+        with mock.patch.object(api_utils, "UPDATE_FLUSH_INTERVAL", 60):
+            self.coalescer.submit("t1", {"status": "processing"}, callback)
+            self.coalescer.submit("t2", {"status": "processing"}, callback)
+            self.coalescer.flush()
+        self.assertEqual(sorted(task_id for task_id, _ in callback.calls), ["t1", "t2"])
+
+    def test_terminal_state_is_written_without_waiting(self):
+        callback = RecordingCallback()
+        with mock.patch.object(api_utils, "UPDATE_FLUSH_INTERVAL", 60):
+            self.coalescer.submit("t1", {"status": "processing", "append_log": (0, "running")}, callback)
+            self.coalescer.submit("t1", {"status": "completed"}, callback)
+            self.assertTrue(callback.wait_for(1))
+        self.assertEqual(callback.calls[0][1]["status"], "completed")
+        self.assertEqual(len(callback.calls[0][1]["append_log"]), 1)
+
+    def test_pending_updates_are_written_after_the_interval(self):
+        callback = RecordingCallback()
+        with mock.patch.object(api_utils, "UPDATE_FLUSH_INTERVAL", 0.01):
+            self.coalescer.submit("t1", {"status": "processing"}, callback)
+            self.assertTrue(callback.wait_for(1))
+
+    def test_failed_write_does_not_stop_the_coalescer(self):
+        callback = RecordingCallback(fail_first=True)
+        self.coalescer.submit("t1", {"status": "failed"}, callback)
+        self.coalescer.submit("t2", {"status": "completed"}, callback)
+        self.coalescer.flush()
+        self.assertEqual([task_id for task_id, _ in callback.calls], ["t1", "t2"])
+
+
+class FakePipelineProcess:
+    """
+    Stands in for the pipeline worker process. On start() it calls behaviour(run_dir, pdf_paths),
+    which writes result files and returns the exit code, or None to keep "running" until it is
+    terminated (as a cancelled pipeline would be).
+    """
+
+    def __init__(self, behaviour, args):
+        self.behaviour = behaviour
+        self.pipeline_args = args[0]
+        self.exitcode = None
+        self.pid = 999999
+        self.started = threading.Event()
+
+    def start(self):
+        run_dir = self.pipeline_args[0]
+        pdfs_start = self.pipeline_args.index("--pdfs") + 1
+        pdfs_end = next(i for i in range(pdfs_start, len(self.pipeline_args)) if self.pipeline_args[i].startswith("--"))
+        self.exitcode = self.behaviour(run_dir, self.pipeline_args[pdfs_start:pdfs_end])
+        self.started.set()
+
+    def join(self, timeout=None):
+        if self.exitcode is None and timeout:
+            time.sleep(min(timeout, 0.01))
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+class TestRunOlmocrBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        dirs = {}
+        for name in ("PROCESSED_PDF_DIR", "PROCESSED_JSONL_DIR", "PROCESSED_PREVIEW_DIR", "SCRATCH_BASE", "UPLOAD_TEMP_DIR"):
+            dirs[name] = os.path.join(self.tmp.name, name.lower())
+            os.makedirs(dirs[name])
+        self.dirs = dirs
+        self.processes = []
+        self.rendered = []
+
+        def fake_render_preview(jsonl_path, safe_base_name, log_dir, task_id):
+            self.rendered.append(safe_base_name)
+            return 0, "", True
+
+        patchers = [mock.patch.multiple(api_utils, **dirs), mock.patch.object(api_utils, "_render_preview", fake_render_preview)]
+        patchers.append(mock.patch.object(api_utils, "terminate_process_tree", self.terminate))
+        patchers.append(mock.patch.object(api_utils, "CANCEL_POLL_INTERVAL", 0.01))
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def terminate(self, pid):
+        for process in self.processes:
+            if process.pid == pid and process.exitcode is None:
+                process.exitcode = -15
+
+    def run_batch(self, names, behaviour, on_start=None):
+        items = []
+        for i, name in enumerate(names):
+            task_id = f"task{i}"
+            upload_path = os.path.join(self.dirs["UPLOAD_TEMP_DIR"], f"{name}_{task_id}.pdf")
+            with open(upload_path, "wb") as f:
+                f.write(b"%PDF-1.4 " + name.encode())
+            items.append((upload_path, task_id))
+
+        def make_process(target, args, name):
+            process = FakePipelineProcess(behaviour, args)
+            self.processes.append(process)
+            if on_start:
+                threading.Thread(target=on_start, args=(process,), daemon=True).start()
+            return process
+
+        callback = RecordingCallback()
+        with mock.patch.object(api_utils.PIPELINE_MP_CONTEXT, "Process", make_process):
+            api_utils.run_olmocr_batch(items, {"error_rate": 0.1, "max_retries": 1}, callback)
+        final = {}
+        for task_id, updates in callback.calls:
+            final.setdefault(task_id, {}).update(updates)
+        return final
+
+    def pdf_path(self, name):
+        return os.path.join(self.dirs["PROCESSED_PDF_DIR"], f"{name}.pdf")
+
+    @staticmethod
+    def write_results(run_dir, rows, filename="output_0.jsonl"):
+        os.makedirs(os.path.join(run_dir, "results"), exist_ok=True)
+        with open(os.path.join(run_dir, "results", filename), "w", encoding="utf-8") as f:
+            f.writelines(row if isinstance(row, str) else json.dumps(row) + "\n" for row in rows)
+
+    @staticmethod
+    def row(source_file, text):
+        return {"id": text, "text": text, "metadata": {"Source-File": source_file}}
+
+    def read_jsonl(self, name):
+        with open(os.path.join(self.dirs["PROCESSED_JSONL_DIR"], f"{name}_output.jsonl"), encoding="utf-8") as f:
+            return [json.loads(line)["text"] for line in f]
+
+    def test_rows_are_routed_to_their_file(self):
+        def behaviour(run_dir, pdf_paths):
+            self.assertEqual(pdf_paths, [self.pdf_path("a"), self.pdf_path("b")])
+            self.write_results(run_dir, [self.row(pdf_paths[1], "b1"), self.row(pdf_paths[0], "a1")])
+            self.write_results(run_dir, [self.row(pdf_paths[0], "a2")], "output_1.jsonl")
+            return 0
+
+        final = self.run_batch(["a", "b"], behaviour)
+        self.assertEqual(final["task0"]["status"], "completed")
+        self.assertEqual(final["task1"]["status"], "completed")
+        self.assertEqual(sorted(self.read_jsonl("a")), ["a1", "a2"])
+        self.assertEqual(self.read_jsonl("b"), ["b1"])
+        self.assertEqual(sorted(self.rendered), ["a", "b"])
+        self.assertEqual(final["task0"]["html_path"], os.path.join(self.dirs["PROCESSED_PREVIEW_DIR"], "a.html"))
+
+    def test_malformed_rows_are_skipped(self):
+        def behaviour(run_dir, pdf_paths):
+            self.write_results(run_dir, ["{not json\n", json.dumps([1, 2]) + "\n", '{"metadata": {}}\n', self.row(pdf_paths[0], "a1"), "\n"])
+            return 0
+
+        final = self.run_batch(["a"], behaviour)
+        self.assertEqual(final["task0"]["status"], "completed")
+        self.assertEqual(self.read_jsonl("a"), ["a1"])
+
+    def test_partial_failure(self):
+        def behaviour(run_dir, pdf_paths):
+            self.write_results(run_dir, [self.row(pdf_paths[0], "a1")])
+            return 1
+
+        final = self.run_batch(["a", "b"], behaviour)
+        # a's pages made it out before the pipeline failed; b has nothing
+        self.assertEqual(final["task0"]["status"], "completed_with_warnings")
+        self.assertEqual(final["task1"]["status"], "failed")
+        self.assertIn("OLMOCR failed (Code: 1)", final["task1"]["error"])
+        self.assertEqual(self.read_jsonl("a"), ["a1"])
+
+    def test_file_without_rows_is_completed_with_warnings(self):
+        def behaviour(run_dir, pdf_paths):
+            self.write_results(run_dir, [self.row(pdf_paths[0], "a1")])
+            return 0
+
+        final = self.run_batch(["a", "b"], behaviour)
+        self.assertEqual(final["task0"]["status"], "completed")
+        self.assertEqual(final["task1"]["status"], "completed_with_warnings")
+        self.assertFalse(os.path.exists(os.path.join(self.dirs["PROCESSED_JSONL_DIR"], "b_output.jsonl")))
+        self.assertEqual(self.rendered, ["a"])
+
+    def test_cancelling_one_task_cancels_the_batch(self):
+        def cancel_second_task(process):
+            process.started.wait(5)
+            self.assertTrue(api_utils.request_task_cancel("task1"))
+
+        final = self.run_batch(["a", "b", "c"], lambda run_dir, pdf_paths: None, on_start=cancel_second_task)
+        self.assertEqual({task_id: updates["status"] for task_id, updates in final.items()},
+                         {"task0": "cancelled", "task1": "cancelled", "task2": "cancelled"})
+        self.assertEqual(self.processes[0].exitcode, -15)
+        self.assertEqual(self.rendered, [])
+        self.assertEqual(api_utils._RUNNING_TASKS, {})
+        self.assertEqual(os.listdir(self.dirs["SCRATCH_BASE"]), [])  # run_dir removed
+
+    def test_waits_for_a_running_task_with_the_same_name(self):
+        releasing = threading.Event()
+        started_after_release = []
+
+        def behaviour(run_dir, pdf_paths):
+            started_after_release.append(releasing.is_set())
+            self.write_results(run_dir, [self.row(pdf_paths[0], "a1")])
+            return 0
+
+        def release():
+            releasing.set()
+            api_utils._release_base_names(["a"])
+
+        self.assertTrue(api_utils._claim_base_names(["a"], threading.Event()))
+        timer = threading.Timer(0.1, release)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        final = self.run_batch(["a", "b"], behaviour)
+        # The pipeline could only start once the other task let go of "a"
+        self.assertEqual(started_after_release, [True])
+        self.assertEqual(final["task0"]["status"], "completed")
+        self.assertEqual(api_utils._CLAIMED_BASE_NAMES, set())
+
+    def test_route_result_rows(self):
+        results_dir = os.path.join(self.tmp.name, "results")
+        self.assertEqual(api_utils._route_result_rows(results_dir), {})
+        self.write_results(self.tmp.name, ['{"metadata": {"Source-File": "a.pdf"}, "text": "last line"}'])
+        self.write_results(self.tmp.name, [self.row("a.pdf", "ignored")], "pipeline.log")
+        rows = api_utils._route_result_rows(results_dir)
+        self.assertEqual(list(rows), ["a.pdf"])
+        self.assertEqual(rows["a.pdf"], ['{"metadata": {"Source-File": "a.pdf"}, "text": "last line"}\n'])
+
+
+class FakeProcess:
+    """Stands in for a pipeline or viewer worker process: start() runs the target on the calling thread."""
+
+    def __init__(self, target, args, name):
+        self.target = target
+        self.args = args
+        self.exitcode = None
+        self.pid = 999999
+
+    def start(self):
+        self.target(*self.args)
+        self.exitcode = 0
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return False
+
+
+class TestSameNameTasks(unittest.TestCase):
+    """Two workers (one per GPU) picking up uploads with the same file name."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        dirs = {}
+        for name in ("PROCESSED_PDF_DIR", "PROCESSED_JSONL_DIR", "PROCESSED_PREVIEW_DIR", "SCRATCH_BASE", "UPLOAD_TEMP_DIR"):
+            dirs[name] = os.path.join(self.tmp.name, name.lower())
+            os.makedirs(dirs[name])
+        self.dirs = dirs
+        self.lock = threading.Lock()
+        self.in_flight = 0  # Tasks between pipeline start and preview end
+        self.max_in_flight = 0
+        self.rendered = []
+
+        patchers = [
+            mock.patch.multiple(api_utils, **dirs),
+            mock.patch.object(api_utils, "_run_pipeline_inproc", self.fake_pipeline),
+            mock.patch.object(api_utils, "_run_viewer_inproc", self.fake_viewer),
+            mock.patch.object(api_utils.PIPELINE_MP_CONTEXT, "Process", FakeProcess),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fake_pipeline(self, pipeline_args, output_path, gpu_index):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        with open(pipeline_args[pipeline_args.index("--pdfs") + 1], "rb") as f:
+            text = f.read().decode()
+        time.sleep(0.1)  # Long enough for the other worker to start its task meanwhile
+        os.makedirs(os.path.join(pipeline_args[0], "results"))
+        with open(os.path.join(pipeline_args[0], "results", "output_0.jsonl"), "w") as f:
+            f.write(json.dumps({"id": text, "text": text}) + "\n")
+
+    def fake_viewer(self, jsonl_path, output_dir, output_filename, output_path):
+        with open(jsonl_path) as f:
+            text = json.loads(f.readline())["text"]
+        time.sleep(0.05)
+        with open(os.path.join(output_dir, output_filename), "w") as f:
+            f.write(text)
+        with self.lock:
+            self.rendered.append(text)
+            self.in_flight -= 1
+
+    def test_tasks_with_the_same_name_run_one_after_the_other(self):
+        callback = RecordingCallback()
+        task_ids = ["task0", "task1"]
+        for task_id in task_ids:
+            with open(os.path.join(self.dirs["UPLOAD_TEMP_DIR"], f"report_{task_id}.pdf"), "w") as f:
+                f.write(f"upload of {task_id}")
+
+        def worker(gpu_index, task_id):
+            upload_path = os.path.join(self.dirs["UPLOAD_TEMP_DIR"], f"report_{task_id}.pdf")
+            api_utils.run_olmocr_on_single_pdf(upload_path, task_id, {"error_rate": 0.1, "max_retries": 1}, callback, gpu_index=gpu_index)
+
+        workers = [threading.Thread(target=worker, args=(i, task_id)) for i, task_id in enumerate(task_ids)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        def final_statuses():
+            statuses = {}
+            for task_id, updates in callback.calls:
+                statuses[task_id] = updates.get("status", statuses.get(task_id))
+            return statuses
+
+        with callback.condition:
+            self.assertTrue(callback.condition.wait_for(lambda: all(final_statuses().get(t) == "completed" for t in task_ids), 5))
+        self.assertEqual(self.max_in_flight, 1)
+        # Each task rendered its own upload, not the other task's PDF or JSONL
+        self.assertEqual(sorted(self.rendered), ["upload of task0", "upload of task1"])
+
+
+class TestExportCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_dir = os.path.join(self.tmp.name, "export_cache")
+        self.input_dir = os.path.join(self.tmp.name, "previews")
+        os.makedirs(self.cache_dir)
+        os.makedirs(self.input_dir)
+        patcher = mock.patch.object(api_utils, "EXPORT_CACHE_DIR", self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.write_input("a.html", b"a")
+
+    def write_input(self, name, data):
+        with open(os.path.join(self.input_dir, name), "wb") as f:
+            f.write(data)
+
+    def fingerprint(self):
+        return api_utils._export_fingerprint("html", [self.input_dir])
+
+    def tee(self, chunks, fingerprint):
+        return api_utils._tee_to_export_cache(iter(chunks), "html", fingerprint, self.fingerprint)
+
+    def read_cached(self, fingerprint):
+        cached = api_utils._cached_export("html", fingerprint)
+        if cached is None:
+            return None
+        path, chunks = cached
+        self.assertEqual(path, os.path.join(self.cache_dir, f"html_{fingerprint}.zip"))
+        return b"".join(chunks)
+
+    def test_fingerprint_follows_inputs(self):
+        fingerprint = self.fingerprint()
+        self.assertEqual(self.fingerprint(), fingerprint)
+        self.assertNotEqual(api_utils._export_fingerprint("md", [self.input_dir]), fingerprint)
+        self.write_input("b.html", b"b")
+        self.assertNotEqual(self.fingerprint(), fingerprint)
+        self.assertNotEqual(api_utils._export_fingerprint("html", [os.path.join(self.tmp.name, "missing")]), fingerprint)
+
+    def test_miss_then_hit(self):
+        fingerprint = self.fingerprint()
+        self.assertIsNone(self.read_cached(fingerprint))
+        self.assertEqual(b"".join(self.tee([b"zip ", b"bytes"], fingerprint)), b"zip bytes")
+        self.assertEqual(self.read_cached(fingerprint), b"zip bytes")
+        self.assertEqual(os.listdir(self.cache_dir), [f"html_{fingerprint}.zip"])
+
+    def test_new_export_replaces_the_old_one(self):
+        old_fingerprint = self.fingerprint()
+        b"".join(self.tee([b"old"], old_fingerprint))
+        self.write_input("b.html", b"b")
+        new_fingerprint = self.fingerprint()
+        b"".join(self.tee([b"new"], new_fingerprint))
+        self.assertIsNone(self.read_cached(old_fingerprint))
+        self.assertEqual(self.read_cached(new_fingerprint), b"new")
+        self.assertEqual(os.listdir(self.cache_dir), [f"html_{new_fingerprint}.zip"])
+
+    def test_input_changed_mid_stream_is_not_cached(self):
+        fingerprint = self.fingerprint()
+
+        def chunks():
+            yield b"zip "
+            self.write_input("b.html", b"added while zipping")
+            yield b"bytes"
+
+        self.assertEqual(b"".join(api_utils._tee_to_export_cache(chunks(), "html", fingerprint, self.fingerprint)), b"zip bytes")
+        self.assertIsNone(self.read_cached(fingerprint))
+        self.assertIsNone(self.read_cached(self.fingerprint()))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_client_disconnect_removes_part_file(self):
+        fingerprint = self.fingerprint()
+        stream = self.tee([b"zip ", b"bytes"], fingerprint)
+        self.assertEqual(next(stream), b"zip ")
+        self.assertEqual(len([name for name in os.listdir(self.cache_dir) if name.endswith(".part")]), 1)
+        stream.close()  # What the server does when the client goes away
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertIsNone(self.read_cached(fingerprint))
+
+    def test_unusable_cache_dir_still_streams(self):
+        fingerprint = self.fingerprint()
+        with mock.patch.object(api_utils, "EXPORT_CACHE_DIR", os.path.join(self.tmp.name, "missing")):
+            self.assertEqual(b"".join(self.tee([b"zip ", b"bytes"], fingerprint)), b"zip bytes")
+        self.assertIsNone(self.read_cached(fingerprint))
@@ -0,0 +1,79 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Flask"))
+
+import flask_app  # noqa: E402
+
+
+class TestPruneFinishedTasks(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(flask_app, "DATABASE_PATH", os.path.join(self.tmp.name, "tasks.db"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        flask_app.init_db()
+        self.conn = flask_app.get_db_conn()
+        self.addCleanup(self.conn.close)
+        self.now = time.time()
+
+    def add_task(self, task_id, status, submitted_ago, started_after=None, elapsed=None):
+        """Adds a task submitted submitted_ago seconds ago that started started_after seconds later and ran for elapsed."""
+        start_time = self.now - submitted_ago
+        processing_start_time = None if started_after is None else start_time + started_after
+        self.conn.execute("INSERT INTO tasks (task_id, status, start_time, processing_start_time, final_elapsed_time) VALUES (?, ?, ?, ?, ?)",
+                          (task_id, status, start_time, processing_start_time, elapsed))
+        self.conn.execute("INSERT INTO task_logs (task_id, message) VALUES (?, ?)", (task_id, f"{task_id} log"))
+
+    def prune(self):
+        with mock.patch.object(flask_app.time, "time", return_value=self.now):
+            pruned = flask_app.prune_finished_tasks(self.conn.cursor())
+        self.conn.commit()
+        return pruned
+
+    def task_ids(self, table="tasks"):
+        return sorted(row[0] for row in self.conn.execute(f"SELECT DISTINCT task_id FROM {table}"))
+
+    def test_expiry_uses_finish_time(self):
+        day = flask_app.TASK_RETENTION_SECONDS
+        self.add_task("recent", "completed", 60, started_after=0, elapsed=30)
+        self.add_task("expired", "completed", day + 120, started_after=0, elapsed=60)
+        # Queued for a day, finished a minute ago: kept
+        self.add_task("long_queued", "completed", day + 120, started_after=day, elapsed=60)
+        # Ran for a day, finished a minute ago: kept
+        self.add_task("long_running", "failed", day + 120, started_after=0, elapsed=day + 60)
+        # Cancelled before it started: only the submission time is known
+        self.add_task("never_started", "cancelled", day + 1)
+        self.assertEqual(self.prune(), 2)
+        self.assertEqual(self.task_ids(), ["long_queued", "long_running", "recent"])
+        self.assertEqual(self.task_ids("task_logs"), ["long_queued", "long_running", "recent"])
+
+    def test_unfinished_tasks_are_kept(self):
+        day = flask_app.TASK_RETENTION_SECONDS
+        self.add_task("queued", "queued", day * 3)
+        self.add_task("processing", "processing", day * 2, started_after=0)
+        self.assertEqual(self.prune(), 0)
+        self.assertEqual(self.task_ids(), ["processing", "queued"])
+
+    def test_only_the_newest_records_are_kept(self):
+        with mock.patch.object(flask_app, "MAX_TASK_RECORDS", 3):
+            self.add_task("oldest", "completed", 50, started_after=0, elapsed=1)
+            self.add_task("old_running", "processing", 40, started_after=0)
+            self.add_task("newer", "completed", 30, started_after=0, elapsed=1)
+            self.add_task("newest", "failed", 20, started_after=0, elapsed=1)
+            self.add_task("latest", "queued", 10)
+            self.assertEqual(self.prune(), 1)
+        # Unfinished tasks count toward the limit but are never dropped
+        self.assertEqual(self.task_ids(), ["latest", "newer", "newest", "old_running"])
+
+    def test_init_db_prunes(self):
+        self.add_task("expired", "completed", flask_app.TASK_RETENTION_SECONDS * 2, started_after=0, elapsed=1)
+        self.conn.commit()
+        flask_app.init_db()
+        self.assertEqual(self.task_ids(), [])
+        self.assertEqual(self.task_ids("task_logs"), [])